@@ -16,6 +16,13 @@ class DefaultConfig(object):
     JSON_SORT_KEYS = False
     CSRF_ENABLED = True  # cross-site forgery protection
     HOST = '0.0.0.0'
+    TRACKABLE_REGISTRY_POLICY = None  # unbounded
+    TRACKABLE_REGISTRY_LIMIT = None
+    GEO_SEARCH_INDEX = False  # in-process index for geo matching
+    GEO_SEARCH_INDEX_SNAPSHOT = None  # path to load/save index snapshot
+    GEO_SNAPSHOT = None  # path to columnar geo snapshot to memory map
+    RESPONSE_CACHE_LIMIT = None  # JSON API response cache disabled
+    RESPONSE_CACHE_TTL = 300  # seconds other processes may serve stale
 
 
 class DevelopmentConfig(DefaultConfig):
@@ -47,6 +54,10 @@ class DeployableConfig(DefaultConfig):
     SECRET_KEY = uuid4().bytes
     PERMANENT_SESSION_LIFETIME = 60 * 120  # 2 hours: in seconds
     JSON_SORT_KEYS = False
+    TRACKABLE_REGISTRY_POLICY = 'lru'
+    TRACKABLE_REGISTRY_LIMIT = 10000  # per Trackable class
+    GEO_SEARCH_INDEX = True
+    RESPONSE_CACHE_LIMIT = 1000  # responses per process
 
 
 class ProductionConfig(DeployableConfig):
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Loads geo data into Intertwine in parallel, by batches of states'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+from alchy import Manager
+from alchy.model import extend_declarative_base
+from sqlalchemy import create_engine, func, inspect, select
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from config import DevConfig
+from data.data_process import DataSessionManager
+from data.geos.geo_data_process import (
+    bulk_save_geos, load_cbsa_geos, load_country_geos, load_manual_fixes,
+    load_parent_data, load_place_geos, load_subdivision1_geos,
+    load_subdivision2_geos, load_subdivision3_geos, sync_id_sequence)
+from data.geos.geo_snapshot import export_snapshot
+from data.geos.models import BaseGeoDataModel, GHRP, State
+from intertwine.trackable import Trackable
+from intertwine.geos.models import (
+    BaseGeoModel, Geo, GeoData, GeoLevel, GeoID, bump_geo_revision,
+    geo_alias_association_table, geo_parent_child_association_table)
+
+# Batches per process, so batches of large states do not hold up others
+BATCHES_PER_PROCESS = 2
+
+# Stages loaded independently for each batch of states
+STATE_STAGES = (load_subdivision2_geos, load_subdivision3_geos,
+                load_place_geos)
+
+
+def load_geos_in_parallel(geo_session, session, geo_db_config, work_dir,
+                          processes=None):
+    '''
+    Load geos for the US in parallel
+
+    Country and subdivision1 (state) geos are loaded and saved first.
+    The county, cousub, and place stages are then fanned out across a
+    process pool by batch of states (see load_state_batch), each worker
+    emitting an intermediate SQLite file in the work directory. These
+    are merged by a single writer (see merge_geo_files), so ids are the
+    same regardless of the order in which workers finish. The CBSA/CSA
+    stage, which spans states, and manual fixes run after the merge
+    against the merged geos, followed by the CBSA/CSA data rollup.
+
+    I/O:
+    geo_session: session for geo.db, which contains the geo source data
+    session: session for the Intertwine database
+    geo_db_config: geo.db connection string, for use by workers
+    work_dir: directory in which workers emit intermediate files
+    processes=None: number of worker processes; cpu count if None
+    return: dict of merged row counts keyed by table name
+    '''
+    processes = processes or multiprocessing.cpu_count()
+
+    load_country_geos(geo_session, session)
+    load_subdivision1_geos(geo_session, session)
+    bulk_save_geos(session, Trackable.catalog_updates())
+    session.commit()
+
+    batches = batch_states(geo_session, processes * BATCHES_PER_PROCESS)
+    print('Loading {count} batches of states in {processes} processes...'
+          .format(count=len(batches), processes=processes))
+
+    # Connections must not be shared with forked workers
+    session.close()
+    session.get_bind(inspect(Geo)).dispose()
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        paths = pool.map(
+            load_state_batch,
+            [(number, sub1keys, geo_db_config, work_dir)
+             for number, sub1keys in enumerate(batches)],
+            chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    counts = merge_geo_files(session, paths)
+    session.commit()
+    print('Merged: {}'.format(', '.join(
+        '{table}: {count:,}'.format(table=table, count=count)
+        for table, count in sorted(counts.items()))))
+
+    # Cross-state stages run against the merged geos
+    Trackable.clear_all()
+    session.expunge_all()
+    Trackable.register_existing(
+        session, Geo, GeoData, GeoLevel, GeoID, preload=True)
+    Trackable.clear_updates()
+    load_cbsa_geos(geo_session, session)
+    load_manual_fixes(geo_session, session)
+    bulk_save_geos(session, Trackable.catalog_updates())
+    load_parent_data(geo_session, session)
+    session.commit()
+
+    return counts
+
+
+def batch_states(geo_session, num_batches):
+    '''
+    Batch states
+
+    Divide states (plus DC and territories) into batches of similar
+    workloads, weighted by the number of geo header records in each.
+    Each state is assigned in turn, largest first, to the batch with
+    the least work, so batches are the same on every run.
+
+    I/O:
+    geo_session: session for geo.db, which contains the geo source data
+    num_batches: maximum number of batches
+    return: list of tuples of state abbrevs (e.g. ('TX', 'VT'))
+    '''
+    record_counts = dict(
+        geo_session.query(GHRP.statefp, func.count(GHRP.statefp))
+                   .group_by(GHRP.statefp))
+    states = sorted(
+        ((record_counts.get(statefp) or 1, stusps) for stusps, statefp in
+         geo_session.query(State.stusps, State.statefp)),
+        key=lambda state: (-state[0], state[1]))
+
+    batches = [[0, []] for _ in range(min(num_batches, len(states)))]
+    for weight, stusps in states:
+        batch = min(batches, key=lambda batch: batch[0])
+        batch[0] += weight
+        batch[1].append(stusps)
+
+    return [tuple(sorted(sub1keys)) for _, sub1keys in batches]
+
+
+def load_state_batch(args):
+    '''
+    Load state batch
+
+    Worker that loads the county, cousub, and place geos for a batch of
+    states into a new intermediate SQLite file, along with the country
+    and subdivision1 geos needed as their parents. The worker starts
+    with an empty Trackable registry and its own connections, so it
+    builds its subgraph independently of other workers.
+
+    I/O:
+    args: tuple of batch number, sequence of state abbrevs, geo.db
+        connection string, and directory in which to emit the file
+    return: path of the intermediate file
+    '''
+    number, sub1keys, geo_db_config, work_dir = args
+    path = os.path.join(work_dir, 'geos_{}.db'.format(number))
+    if os.path.exists(path):
+        os.remove(path)
+
+    Trackable.clear_all()
+
+    geo_engine = create_engine(geo_db_config)
+    geo_session = scoped_session(sessionmaker(bind=geo_engine))
+    extend_declarative_base(BaseGeoDataModel, session=geo_session)
+
+    engine = create_engine('sqlite:///{}'.format(path))
+    BaseGeoModel.metadata.create_all(engine)
+    session = scoped_session(sessionmaker(bind=engine))
+    extend_declarative_base(BaseGeoModel, session=session)
+
+    try:
+        load_country_geos(geo_session, session)
+        load_subdivision1_geos(geo_session, session, sub1keys)
+        for stage in STATE_STAGES:
+            stage(geo_session, session, sub1keys=sub1keys)
+        bulk_save_geos(session, Trackable.catalog_updates())
+        session.commit()
+    finally:
+        session.remove()
+        geo_session.remove()
+        engine.dispose()
+        geo_engine.dispose()
+
+    return path
+
+
+def merge_geo_files(session, paths):
+    '''
+    Merge geo files
+
+    Load geos from intermediate files emitted by load_state_batch into
+    the Intertwine database. Geos are matched by human_id, geo levels
+    by geo and level, geo IDs by standard and code, and geo data by
+    geo. Rows not already in the database are inserted with ids
+    assigned in order of these natural keys (parents before children)
+    and their foreign keys remapped, so the result does not depend on
+    which worker loaded which state. Rows already in the database (e.g.
+    country and subdivision1 geos) are not overwritten. Parent/child
+    and alias associations are deduplicated and the hierarchy closure
+    is rebuilt. The geo revision is bumped, as the writes bypass the
+    ORM.
+
+    I/O:
+    session: session for the Intertwine database
+    paths: paths of intermediate files, in batch order; where more than
+        one file contains a new row, the first is used
+    return: dict of inserted row counts keyed by table name
+    '''
+    bump_geo_revision(session, bulk=True)
+    geo_table, data_table, level_table, id_table = (
+        model.__table__ for model in (Geo, GeoData, GeoLevel, GeoID))
+    association_tables = OrderedDict((
+        (geo_parent_child_association_table, ('parent_id', 'child_id')),
+        (geo_alias_association_table, ('alias_target_id', 'alias_id'))))
+
+    # Natural keys of rows already in the database
+    geo_ids = dict(session.execute(
+        select([geo_table.c.human_id, geo_table.c.id])).fetchall())
+    level_ids = {(geo_id, level): level_id for level_id, geo_id, level in
+                 session.execute(select([level_table.c.id,
+                                         level_table.c.geo_id,
+                                         level_table.c.level]))}
+    id_keys = {tuple(row) for row in session.execute(
+        select([id_table.c.standard, id_table.c.code]))}
+    data_geo_ids = {geo_id for geo_id, in session.execute(
+        select([data_table.c.geo_id]))}
+    association_pairs = {
+        table: {tuple(row) for row in session.execute(
+            select([table.c[column] for column in columns]))}
+        for table, columns in association_tables.items()}
+
+    files = [_read_geo_file(path) for path in paths]
+
+    # Geos, keyed by human_id; path parents are remapped via human_id
+    new_geos = OrderedDict()
+    for rows, geo_huids, _ in files:
+        for row in rows[geo_table]:
+            human_id = row['human_id']
+            if human_id in geo_ids or human_id in new_geos:
+                continue
+            row = dict(row)
+            row['path_parent_id'] = geo_huids.get(row['path_parent_id'])
+            new_geos[human_id] = row
+    geo_rows = sorted(new_geos.values(), key=_derive_geo_merge_key)
+    _assign_merge_ids(session, Geo, geo_rows)
+    for row in geo_rows:
+        geo_ids[row['human_id']] = row['id']
+        row['path_parent_id'] = geo_ids.get(row['path_parent_id'])
+
+    # Geo levels, keyed by geo and level
+    new_levels = OrderedDict()
+    for rows, geo_huids, _ in files:
+        for row in rows[level_table]:
+            key = (geo_ids[geo_huids[row['geo_id']]], row['level'])
+            if key in level_ids or key in new_levels:
+                continue
+            new_levels[key] = dict(row, geo_id=key[0])
+    level_rows = sorted(new_levels.values(),
+                        key=lambda row: (row['geo_id'], row['level']))
+    _assign_merge_ids(session, GeoLevel, level_rows)
+    for key, row in new_levels.items():
+        level_ids[key] = row['id']
+
+    # Geo IDs, keyed by standard and code
+    new_ids = OrderedDict()
+    for rows, geo_huids, level_keys in files:
+        for row in rows[id_table]:
+            key = (row['standard'], row['code'])
+            if key in id_keys or key in new_ids:
+                continue
+            geo_huid, level = level_keys[row['level_id']]
+            level_id = level_ids[(geo_ids[geo_huid], level)]
+            new_ids[key] = dict(row, level_id=level_id)
+    id_rows = sorted(new_ids.values(), key=lambda row: (
+        row['level_id'], row['standard'], row['code']))
+    _assign_merge_ids(session, GeoID, id_rows)
+
+    # Geo data, keyed by geo
+    new_data = OrderedDict()
+    for rows, geo_huids, _ in files:
+        for row in rows[data_table]:
+            geo_id = geo_ids[geo_huids[row['geo_id']]]
+            if geo_id in data_geo_ids or geo_id in new_data:
+                continue
+            new_data[geo_id] = dict(row, geo_id=geo_id)
+    data_rows = [new_data[geo_id] for geo_id in sorted(new_data)]
+    _assign_merge_ids(session, GeoData, data_rows)
+
+    counts = {}
+    for model, model_rows in ((Geo, geo_rows), (GeoLevel, level_rows),
+                              (GeoID, id_rows), (GeoData, data_rows)):
+        if model_rows:
+            session.execute(model.__table__.insert(), model_rows)
+        sync_id_sequence(session, model)
+        counts[model.__tablename__] = len(model_rows)
+
+    for table, columns in association_tables.items():
+        pairs = association_pairs[table]
+        new_pairs = set()
+        for rows, geo_huids, _ in files:
+            for a_id, b_id in rows[table]:
+                pair = (geo_ids[geo_huids[a_id]], geo_ids[geo_huids[b_id]])
+                if pair not in pairs:
+                    new_pairs.add(pair)
+        if new_pairs:
+            session.execute(table.insert(), [
+                dict(zip(columns, pair)) for pair in sorted(new_pairs)])
+        counts[table.name] = len(new_pairs)
+
+    Geo.refresh_closure(session)
+    return counts
+
+
+def _read_geo_file(path):
+    '''
+    Read rows from an intermediate geo file
+
+    Returns rows keyed by table, along with human_ids keyed by geo id
+    and (geo human_id, level) tuples keyed by geo level id, as ids are
+    local to the file.
+    '''
+    tables = [model.__table__ for model in (Geo, GeoData, GeoLevel, GeoID)]
+    tables += [geo_parent_child_association_table,
+               geo_alias_association_table]
+    engine = create_engine('sqlite:///{}'.format(path))
+    try:
+        with engine.connect() as connection:
+            rows = {table: connection.execute(
+                select([table]).order_by(*table.c)).fetchall()
+                for table in tables}
+    finally:
+        engine.dispose()
+
+    geo_huids = {row['id']: row['human_id'] for row in rows[Geo.__table__]}
+    level_keys = {row['id']: (geo_huids[row['geo_id']], row['level'])
+                  for row in rows[GeoLevel.__table__]}
+    return rows, geo_huids, level_keys
+
+
+def _derive_geo_merge_key(row):
+    '''Sort key placing path parents before their path children'''
+    human_id = row['human_id']
+    return human_id.count('/'), human_id
+
+
+def _assign_merge_ids(session, model, rows):
+    '''Assign sequential ids to merged rows after the max id'''
+    max_id = session.query(func.max(model.id)).scalar() or 0
+    for i, row in enumerate(rows, start=max_id + 1):
+        row['id'] = i
+
+
+if __name__ == '__main__':
+    # Session for geo.db, which contains the geo source data
+    geo_dsm = DataSessionManager(db_config=DevConfig.GEO_DATABASE,
+                                 ModelBases=[BaseGeoDataModel])
+    geo_session = geo_dsm.session
+    extend_declarative_base(BaseGeoDataModel, session=geo_session)
+
+    # Session for main Intertwine db, where geo data is loaded
+    db = Manager(Model=BaseGeoModel, config=DevConfig)
+    session = db.session
+    extend_declarative_base(BaseGeoModel, session=session)
+    db.create_all()
+
+    work_dir = tempfile.mkdtemp(prefix='geos_')
+    try:
+        load_geos_in_parallel(geo_session, session,
+                              geo_db_config=DevConfig.GEO_DATABASE,
+                              work_dir=work_dir)
+    finally:
+        shutil.rmtree(work_dir)
+
+    if DevConfig.GEO_SNAPSHOT:
+        export_snapshot(DevConfig.GEO_SNAPSHOT, session)
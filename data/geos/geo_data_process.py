@@ -1,17 +1,31 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-'''Loads geo data into Intertwine'''
+'''Loads geo data into Intertwine
+
+Usage:
+    geo_data_process.py [options]
+
+Options:
+    -h --help       This message
+    -r --resume     Resume from the last checkpoint, skipping completed work
+'''
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
-from collections import Counter, defaultdict, namedtuple
+import time
+from collections import Counter, OrderedDict, defaultdict, namedtuple
 
-from sqlalchemy import desc
+from sqlalchemy import (Column, MetaData, Table, and_, bindparam, desc, func,
+                        inspect, select, text, types)
+from sqlalchemy.orm import (attributes, make_transient_to_detached,
+                            scoped_session)
 from alchy import Manager
 from alchy.model import extend_declarative_base
 
 from config import DevConfig
 from data.data_process import DataSessionManager
+from data.geos.geo_data_rollup import rollup_geo_data
+from data.geos.geo_snapshot import export_snapshot
 from data.geos.models import (BaseGeoDataModel, LSAD, GHRP,
                               State, CBSA, County, Cousub, Place)
 from intertwine.trackable import Trackable
@@ -20,21 +34,64 @@ from intertwine.trackable.exceptions import (KeyMissingFromRegistry,
 from intertwine.utils.structures import PeekableIterator
 from intertwine.utils.tools import add_leading_zeros
 from intertwine.geos.models import (
-    BaseGeoModel, Geo, GeoData, GeoLevel, GeoID,
+    BaseGeoModel, Geo, GeoData, GeoLevel, GeoID, bump_geo_revision,
+    geo_alias_association_table, geo_parent_child_association_table,
     PARENTS, CHILDREN,  # PATH_CHILDREN, ALIASES, ALIAS_TARGETS,
     COUNTRY, SUBDIVISION1, SUBDIVISION2, SUBDIVISION3, PLACE, SUBPLACE,
     CORE_AREA, COMBINED_AREA,
     FIPS, ANSI, ISO_A2, ISO_A3, ISO_N3, CSA_2010, CBSA_2010)
-from intertwine.utils.space import Area, GeoLocation
+from intertwine.trackable.utils import peak_memory
+from intertwine.utils.space import Area, GeoLocation, WeightedCentroid
 
 COUNTY_LSAD_AS_QUALIFIER = False
 
+# Save loaded geos via bulk inserts rather than the ORM (see bulk_save_geos)
+BULK_SAVE = True
+
 GHRP_DATA_FIELDS = GeoData.Record(*GHRP.DATA_FIELDS)
 PREFIXED_GHRP_DATA_FIELDS = GeoData.Record(
     *('_'.join((GHRP.__name__.lower(), f)) for f in GHRP_DATA_FIELDS))
 
 invalid_cousub_name = Cousub.invalid_name_pattern.search
 
+# Stages of a staged geo load; stages by state are run (and checkpointed)
+# one state at a time, in order of state abbrev
+GeoLoadStage = namedtuple('GeoLoadStage', 'name, load, by_state')
+
+GeoLoadStats = namedtuple(
+    'GeoLoadStats',
+    'stage, key, records, created, modified, seconds, rate, memory')
+
+# Checkpoints of staged geo loads, kept apart from the geo models
+checkpoint_metadata = MetaData()
+
+geo_load_checkpoint_table = Table(
+    'geo_load_checkpoint', checkpoint_metadata,
+    Column('stage', types.String(30), primary_key=True),
+    Column('key', types.String(30)),  # last state loaded, if by state
+    Column('completed', types.Boolean, nullable=False),
+    Column('records', types.Integer, nullable=False),
+    Column('created', types.Integer, nullable=False),
+    Column('modified', types.Integer, nullable=False),
+    Column('seconds', types.Float, nullable=False),
+    Column('memory', types.Integer)  # peak resident memory in KB
+)
+
+
+class RecordCounter(object):
+    '''Counts source records read by loaders as they are iterated'''
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, records):
+        for record in records:
+            self.count += 1
+            yield record
+
+
+count_records = RecordCounter()
+
 
 def define_record(name, *fields):
     '''
@@ -129,8 +186,17 @@ def find_non_place_cousubs(geo=None, include_all=False):
     return geos
 
 
-def load_geos(geo_session, session):
-    '''Load geos for the US'''
+def load_geos(geo_session, session, bulk=False):
+    '''
+    Load geos for the US
+
+    Loaded geos remain outside the session while loading, so they are
+    not flushed one at a time. Once all stages are complete, they are
+    saved via bulk inserts if bulk (see bulk_save_geos) or else added to
+    the session and flushed via the ORM. Either way, CBSA/CSA data is
+    then rolled up from the saved geos (see load_parent_data). Updates
+    are returned, uncommitted.
+    '''
     load_country_geos(geo_session, session)
     load_subdivision1_geos(geo_session, session)
     load_subdivision2_geos(geo_session, session)
@@ -139,7 +205,365 @@ def load_geos(geo_session, session):
     load_cbsa_geos(geo_session, session)
     load_manual_fixes(geo_session, session)
 
-    return Trackable.catalog_updates()
+    updates = Trackable.catalog_updates()
+    if bulk:
+        counts = bulk_save_geos(session, updates)
+        print('Bulk saved: {}'.format(', '.join(
+            '{table}: {count:,}'.format(table=table, count=count)
+            for table, count in sorted(counts.items()))))
+    else:
+        for instances in updates.values():
+            session.add_all(instances)
+        session.flush()
+    load_parent_data(geo_session, session)
+
+    return updates
+
+
+def load_geos_in_stages(geo_session, session, resume=False, sub1keys=None,
+                        stages=None):
+    '''
+    Load geos for the US in checkpointed stages
+
+    Each stage is saved and committed along with a checkpoint in the
+    geo_load_checkpoint table, so a failed load may be resumed without
+    starting over. Stages by state (counties, cousubs, and places) are
+    committed and checkpointed after each state, recording the last
+    state loaded. Existing geos must be registered (e.g. via
+    Trackable.register_existing) before resuming.
+
+    Checkpoints also record cumulative stats for each stage: source
+    records read, geos created and modified, elapsed seconds, and peak
+    resident memory. Unlike load_geos, geos are persistent once their
+    stage is committed, so later stages flush new geos attached to them.
+    Commits do not expire instances while loading, as the registry holds
+    them across units and would otherwise reload each one as accessed.
+
+    I/O:
+    geo_session: session for geo.db, which contains the geo source data
+    session: session for the Intertwine database
+    resume=False: if True, skip stages and states already checkpointed;
+        otherwise, clear any existing checkpoints
+    sub1keys=None: state abbrevs to load by state; all states if None
+    stages=None: sequence of GeoLoadStage namedtuples; all if None
+    return: OrderedDict of cumulative GeoLoadStats keyed by stage name
+    '''
+    stages = stages or (
+        GeoLoadStage('country', load_country_geos, False),
+        GeoLoadStage('subdivision1', load_subdivision1_geos, False),
+        GeoLoadStage('subdivision2', load_subdivision2_geos, True),
+        GeoLoadStage('subdivision3', load_subdivision3_geos, True),
+        GeoLoadStage('place', load_place_geos, True),
+        GeoLoadStage('cbsa', load_cbsa_geos, False),
+        GeoLoadStage('parent_data', load_parent_data, False),
+        GeoLoadStage('manual_fixes', load_manual_fixes, False))
+
+    table = geo_load_checkpoint_table
+    checkpoint_metadata.create_all(session.get_bind(inspect(Geo)))
+    if not resume:
+        session.execute(table.delete())
+        session.commit()
+    checkpoints = {row['stage']: row for row in session.execute(
+        select([table]))}
+
+    stage_stats = OrderedDict()
+    base_session = (session() if isinstance(session, scoped_session)
+                    else session)
+    expire_on_commit = base_session.expire_on_commit
+    base_session.expire_on_commit = False
+    try:
+        for stage in stages:
+            checkpoint = checkpoints.get(stage.name)
+            if checkpoint is not None and checkpoint['completed']:
+                print('Skipping completed stage: {}'.format(stage.name))
+            else:
+                keys = [None]
+                if stage.by_state:
+                    if sub1keys is None:
+                        sub1keys = [stusps for stusps,
+                                    in geo_session.query(State.stusps)]
+                    keys = sorted(sub1keys)
+                last_key = (checkpoint['key'] if checkpoint is not None
+                            else None)
+                pending_keys = [key for key in keys
+                                if last_key is None or key > last_key]
+                for i, key in enumerate(pending_keys):
+                    checkpoint = _load_geo_stage_unit(
+                        geo_session, session, stage, key, checkpoint,
+                        completed=(i == len(pending_keys) - 1))
+
+            stage_stats[stage.name] = _derive_geo_load_stats(checkpoint)
+    finally:
+        base_session.expire_on_commit = expire_on_commit
+
+    return stage_stats
+
+
+def _load_geo_stage_unit(geo_session, session, stage, key, checkpoint,
+                         completed):
+    '''
+    Load geo stage unit
+
+    Load a stage (for a single state if key is given), save it, and
+    commit it along with its checkpoint. Prints stats for the unit and
+    returns the checkpoint, with stats accumulated over the stage.
+    '''
+    Trackable.clear_updates()
+    num_geos = session.query(func.count(Geo.id)).scalar()
+    start_records, start_time = count_records.count, time.time()
+
+    try:
+        if key is None:
+            stage.load(geo_session, session)
+        else:
+            stage.load(geo_session, session, sub1keys=(key,))
+
+        updates = Trackable.catalog_updates()
+        if BULK_SAVE:
+            bulk_save_geos(session, updates)
+        else:
+            for instances in updates.values():
+                session.add_all(instances)
+            session.flush()
+
+        created = session.query(func.count(Geo.id)).scalar() - num_geos
+        modified = max(len(updates.get(Geo.__name__, ())) - created, 0)
+        seconds = time.time() - start_time
+        records = count_records.count - start_records
+        memory = peak_memory()
+
+        values = dict(stage=stage.name, key=key, completed=completed,
+                      records=records, created=created, modified=modified,
+                      seconds=seconds, memory=memory)
+        table = geo_load_checkpoint_table
+        if checkpoint is None:
+            session.execute(table.insert(), values)
+        else:
+            for field in ('records', 'created', 'modified', 'seconds'):
+                values[field] += checkpoint[field]
+            session.execute(table.update().where(
+                table.c.stage == stage.name), values)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        Trackable.clear_updates()
+
+    print(_format_geo_load_stats(GeoLoadStats(
+        stage=stage.name, key=key, records=records, created=created,
+        modified=modified, seconds=seconds,
+        rate=records / seconds if seconds else None, memory=memory)))
+
+    return session.execute(select([table]).where(
+        table.c.stage == stage.name)).first()
+
+
+def _derive_geo_load_stats(checkpoint):
+    '''Derive cumulative GeoLoadStats from a checkpoint row'''
+    if checkpoint is None:
+        return None
+    seconds = checkpoint['seconds']
+    return GeoLoadStats(
+        stage=checkpoint['stage'], key=checkpoint['key'],
+        records=checkpoint['records'], created=checkpoint['created'],
+        modified=checkpoint['modified'], seconds=seconds,
+        rate=checkpoint['records'] / seconds if seconds else None,
+        memory=checkpoint['memory'])
+
+
+def _format_geo_load_stats(stats):
+    '''Format GeoLoadStats for printing'''
+    return ('{stage}{key}: {records:,} records, {created:,} geos created, '
+            '{modified:,} modified in {seconds:.2f}s ({rate} records/s); '
+            'peak RSS: {memory} KB'.format(
+                stage=stats.stage,
+                key=' ({})'.format(stats.key) if stats.key else '',
+                records=stats.records, created=stats.created,
+                modified=stats.modified, seconds=stats.seconds,
+                rate=('{:,.0f}'.format(stats.rate)
+                      if stats.rate is not None else 'n/a'),
+                memory=('{:,}'.format(stats.memory)
+                        if stats.memory is not None else 'n/a')))
+
+
+def bulk_save_geos(session, updates):
+    '''
+    Bulk save geos
+
+    Write geos, geo data, geo levels, and geo IDs created by the loaders
+    with executemany inserts in dependency order, rather than having the
+    ORM unit of work insert and synchronize them one at a time. The
+    loaders have already resolved all relations in memory (via the
+    Trackable registry), so primary keys are assigned in memory and
+    foreign keys are derived from the many-to-one relationships.
+    Parent/child and alias associations added or removed for any
+    tracked or dirty geo are written directly and the hierarchy closure
+    is refreshed once at the end.
+
+    New instances are then attached to the session as persistent and
+    any remaining changes to existing instances (e.g. updated data) are
+    flushed via the ORM, so the resulting database is the same as when
+    saving via the ORM. Instances already flushed (e.g. by autoflush
+    during loading) are left to the ORM. Rebuild any installed search
+    index afterward (GeoSearchIndex.build), as bulk inserts bypass
+    flush events. The geo revision is bumped, so snapshots and search
+    indexes in other processes are detected as stale.
+
+    I/O:
+    session: session for the Intertwine database
+    updates: dict of instance sets keyed by class name (from load_geos)
+    return: dict of bulk inserted row counts keyed by table name
+    '''
+    new_instances = OrderedDict()
+    for model in (Geo, GeoData, GeoLevel, GeoID):
+        new_instances[model] = [
+            inst for inst in updates.get(model.__name__, ())
+            if inspect(inst).key is None]
+    all_new_instances = [inst for instances in new_instances.values()
+                         for inst in instances]
+    if not all_new_instances:
+        session.flush()
+        return {}
+
+    counts = {}
+    bump_geo_revision(session, bulk=True)
+    with session.no_autoflush:
+        # New instances may be pending via backref cascades
+        for inst in all_new_instances:
+            if inst in session:
+                session.expunge(inst)
+
+        for model, sort_key in (
+                (Geo, _derive_geo_sort_key),
+                (GeoData, lambda gd: gd.geo.id),
+                (GeoLevel, lambda gl: (gl.geo.id, gl.level)),
+                (GeoID, lambda gid: (gid.level.id, gid.standard, gid.code))):
+            instances = sorted(new_instances[model], key=sort_key)
+            _assign_ids(session, model, instances)
+            mappings = [_derive_mapping(inst) for inst in instances]
+            session.bulk_insert_mappings(model, mappings)
+            sync_id_sequence(session, model)
+            counts[model.__tablename__] = len(mappings)
+
+        changed_geos = set(updates.get(Geo.__name__, ()))
+        changed_geos.update(g for g in session.dirty if isinstance(g, Geo))
+        association_counts, associated_geos = _bulk_save_geo_associations(
+            session, changed_geos)
+        counts.update(association_counts)
+
+        # Attach new instances as persistent, without pending changes
+        for inst in all_new_instances:
+            make_transient_to_detached(inst)
+        session.add_all(all_new_instances)
+
+    session.flush()
+    Geo.refresh_closure(session, {g.id for g in associated_geos})
+    return counts
+
+
+def _derive_geo_sort_key(geo):
+    '''Sort key placing path parents before their path children'''
+    depth = 0
+    path_parent = geo.path_parent
+    while path_parent is not None:
+        depth += 1
+        path_parent = path_parent.path_parent
+    return depth, geo.human_id
+
+
+def _assign_ids(session, model, instances):
+    '''Assign sequential ids to new instances after the max id'''
+    max_id = session.query(func.max(model.id)).scalar() or 0
+    for i, inst in enumerate(instances, start=max_id + 1):
+        inst.id = i
+
+
+def sync_id_sequence(session, model):
+    '''Advance the id sequence past ids assigned in memory (PostgreSQL)'''
+    if session.get_bind(inspect(model)).dialect.name != 'postgresql':
+        return
+    table = model.__tablename__
+    session.execute(text(
+        "SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+        "coalesce(max(id), 1)) FROM {table}".format(table=table)))
+
+
+def _derive_mapping(inst):
+    '''
+    Derive mapping of column attribute values for a new instance
+
+    Foreign keys are taken from many-to-one relationships, as they are
+    only populated from these upon ORM flush.
+    '''
+    mapper = inspect(inst).mapper
+    inst_dict = inst.__dict__
+    mapping = {prop.key: inst_dict[prop.key] for prop in mapper.column_attrs
+               if inst_dict.get(prop.key) is not None}
+    for rel in mapper.relationships:
+        if rel.direction.name != 'MANYTOONE':
+            continue
+        related = inst_dict.get(rel.key)
+        if related is None:
+            continue
+        for local, remote in rel.local_remote_pairs:
+            local_key = mapper.get_property_by_column(local).key
+            remote_key = rel.mapper.get_property_by_column(remote).key
+            mapping[local_key] = getattr(related, remote_key)
+    return mapping
+
+
+def _bulk_save_geo_associations(session, geos):
+    '''
+    Bulk save geo associations
+
+    Write parent/child and alias associations added to or removed from
+    the given geos and discard them as pending changes. Pairs are
+    gathered from both sides of each relationship, so each is written
+    once. Returns row counts keyed by table name and the set of geos
+    with parent/child changes, whose closure must be refreshed.
+    '''
+    passive = attributes.PASSIVE_NO_INITIALIZE
+    associations = (
+        (geo_parent_child_association_table, 'parent_id', 'child_id',
+         ((Geo.PARENTS, False), (Geo.CHILDREN, True))),
+        (geo_alias_association_table, 'alias_target_id', 'alias_id',
+         (('_alias_targets', False), ('_aliases', True))))
+
+    counts = {}
+    hierarchy_geos = set()
+    for table, a_column, b_column, relations in associations:
+        added, deleted = set(), set()
+        for geo in geos:
+            for relation, geo_is_a in relations:
+                history = attributes.get_history(geo, relation, passive)
+                for pairs, related_geos in ((added, history.added),
+                                            (deleted, history.deleted)):
+                    pairs.update((geo, g) if geo_is_a else (g, geo)
+                                 for g in related_geos or ())
+        added, deleted = added - deleted, deleted - added
+
+        if deleted:
+            session.execute(
+                table.delete().where(and_(
+                    table.c[a_column] == bindparam('a_id'),
+                    table.c[b_column] == bindparam('b_id'))),
+                [dict(a_id=a.id, b_id=b.id) for a, b in deleted])
+        if added:
+            session.execute(table.insert(), sorted(
+                ({a_column: a.id, b_column: b.id} for a, b in added),
+                key=lambda row: (row[a_column], row[b_column])))
+        counts[table.name] = len(added)
+        if table is geo_parent_child_association_table:
+            for pairs in (added, deleted):
+                hierarchy_geos.update(g for pair in pairs for g in pair)
+
+        # Discard pending association changes on existing geos
+        for geo in geos:
+            if inspect(geo).key is not None and geo in session:
+                session.expire(geo, [relation for relation, _ in relations])
+
+    return counts, hierarchy_geos
 
 
 def load_country_geos(geo_session, session):
@@ -186,7 +610,7 @@ def load_states(geo_session, session, sub1keys=None):
     us = Geo['us']
     print('Loading states, DC, and Puerto Rico...')
 
-    for r in records:
+    for r in count_records(records):
         state = r.state
         print('{usps} - {name}'.format(usps=state.stusps, name=state.name))
 
@@ -246,7 +670,7 @@ def load_territories(geo_session, session, sub1keys=None):
     us = Geo['us']
     print('Loading remaining territories...')
 
-    for r in records:
+    for r in count_records(records):
         print('{state} - {name}'.format(state=r.stusps,
                                         name=r.name))
         geo = Geo(name=r.name, abbrev=r.stusps, path_parent=us, parents=[us])
@@ -308,7 +732,7 @@ def load_state_counties(geo_session, session, sub1keys=None):
     geos_with_unusual_affixes = []
 
     print('Loading counties and equivalents...')
-    for r in (CountyRecord(*record) for record in records):
+    for r in (CountyRecord(*record) for record in count_records(records)):
 
         stusps = State.get_by('statefp', r.ghrp_statefp).stusps
         if stusps != prior_stusps:
@@ -418,7 +842,7 @@ def load_territory_counties(geo_session, session, sub1keys=None):
     stusps = prior_stusps = None
     geos_with_unusual_affixes = []
 
-    for fips, ansi, stusps, lsad_code, full_name in records:
+    for fips, ansi, stusps, lsad_code, full_name in count_records(records):
 
         if stusps != prior_stusps:
             territory = us[stusps]
@@ -524,7 +948,7 @@ def load_subdivision3_geos(geo_session, session, sub1keys=None, sub2keys=None):
         base_query.order_by(GHRP.statefp, GHRP.cousubns)
                   .values(*columns))
 
-    records = PeekableIterator(records)
+    records = PeekableIterator(count_records(records))
 
     us = Geo['us']
     state = None
@@ -536,8 +960,8 @@ def load_subdivision3_geos(geo_session, session, sub1keys=None, sub2keys=None):
     counties = set()
     fips_county_map = {}
     total_pop = urban_pop = 0
-    total_area = land_area = water_area = 0
-    coordinate_tuple = latitude = longitude = None
+    land_area = water_area = 0  # Dequantized, in sq. meters
+    centroid = WeightedCentroid()
 
     tracker = defaultdict(list)
 
@@ -578,31 +1002,23 @@ def load_subdivision3_geos(geo_session, session, sub1keys=None, sub2keys=None):
             counties.clear()
             fips_county_map.clear()
             total_pop = urban_pop = 0
-            total_area = land_area = water_area = 0
-            coordinate_tuple = latitude = longitude = None
+            land_area = water_area = 0
+            centroid = WeightedCentroid()
             prior_cousubns = cousubns
 
         record_number += 1
         counties.add(county)
         fips_county_map[cousubid] = county
 
-        new_geo_location = GeoLocation(r.ghrp_intptlat, r.ghrp_intptlon)
-        new_land_area = Area(r.ghrp_arealand, requantize=True)
-        new_water_area = Area(r.ghrp_areawatr, requantize=True)
-        new_total_area = new_land_area + new_water_area
-
-        if coordinate_tuple is None:
-            coordinate_tuple = new_geo_location.values
-        else:
-            coordinate_tuple = GeoLocation.combine_coordinates(
-                (coordinate_tuple, total_area),
-                (new_geo_location.values, new_total_area))
+        # Combine coordinates weighted by area as integers, sans Decimals
+        latitude, longitude = GeoLocation(
+            r.ghrp_intptlat, r.ghrp_intptlon).dequantize()
+        centroid.add(latitude, longitude, r.ghrp_arealand + r.ghrp_areawatr)
 
         total_pop += r.ghrp_p0020001
         urban_pop += r.ghrp_p0020002
-        land_area += new_land_area
-        water_area += new_water_area
-        total_area = land_area + water_area
+        land_area += r.ghrp_arealand
+        water_area += r.ghrp_areawatr
 
         if (records.has_next() and
                 CousubRecord(*records.peek()).ghrp_cousubns == cousubns):
@@ -612,10 +1028,13 @@ def load_subdivision3_geos(geo_session, session, sub1keys=None, sub2keys=None):
         print("\t{name}, {state} ({standard}, '{code}')"
               .format(name=name, state=stusps, standard=ANSI, code=cousubns))
 
-        latitude, longitude = GeoLocation(*coordinate_tuple)
+        latitude, longitude = GeoLocation(*centroid.coordinates,
+                                          requantize=True)
 
         data_record = GeoData.Record(
-            total_pop, urban_pop, latitude, longitude, land_area, water_area)
+            total_pop, urban_pop, latitude, longitude,
+            Area(land_area, requantize=True),
+            Area(water_area, requantize=True))
 
         parents = list(counties | {state, us})
 
@@ -716,7 +1135,7 @@ def load_place_geos(geo_session, session, sub1keys=None, placeids=None):
                             GHRP.countyid, GHRP.cousubid)
                   .values(*columns))
 
-    records = PeekableIterator(records)
+    records = PeekableIterator(count_records(records))
 
     us = Geo['us']
     state = None
@@ -811,8 +1230,8 @@ def load_place_geos(geo_session, session, sub1keys=None, placeids=None):
         cousubs.add(cousub)
         total_pop += r.ghrp_p0020001
         urban_pop += r.ghrp_p0020002
-        land_area += Area(r.ghrp_arealand, requantize=True)
-        water_area += Area(r.ghrp_areawatr, requantize=True)
+        land_area += r.ghrp_arealand
+        water_area += r.ghrp_areawatr
 
         if (records.has_next() and
                 PlaceRecord(*records.peek()).ghrp_placeid == placeid):
@@ -826,7 +1245,9 @@ def load_place_geos(geo_session, session, sub1keys=None, placeids=None):
         latitude, longitude = geo_location.coordinates
 
         data_record = GeoData.Record(
-            total_pop, urban_pop, latitude, longitude, land_area, water_area)
+            total_pop, urban_pop, latitude, longitude,
+            Area(land_area, requantize=True),
+            Area(water_area, requantize=True))
 
         data_match_dict = data_record._asdict()
         del data_match_dict['latitude']
@@ -1449,6 +1870,15 @@ def deaffix_place(full_name, lsad_code, placens):
 
 
 def load_cbsa_geos(geo_session, session, sub1keys=None, cbsa_keys=None):
+    '''
+    Load CBSA (core area) and CSA (combined area) geos
+
+    CBSA and CSA data is not aggregated as geos are created; instead,
+    it is rolled up from counties and CBSAs in bulk by rollup_geo_data
+    once the geos are saved, so callers saving the geos themselves must
+    then run load_parent_data (as load_geos and the staged and parallel
+    loaders do).
+    '''
 
     CBSARecord, columns = define_record(
         'CBSARecord',
@@ -1478,7 +1908,7 @@ def load_cbsa_geos(geo_session, session, sub1keys=None, cbsa_keys=None):
         base_query.order_by(CBSA.csa_code, CBSA.cbsa_code, desc(GHRP.p0020001))
                   .values(*columns))
 
-    records = PeekableIterator(records)
+    records = PeekableIterator(count_records(records))
 
     us = Geo['us']
     cbsa_code = prior_cbsa_code = ''
@@ -1494,6 +1924,7 @@ def load_cbsa_geos(geo_session, session, sub1keys=None, cbsa_keys=None):
     cbsa_county_children = set()
     csa_county_children = set()
     csa_cbsa_main_places = {}  # main places indexed by CBSA geo
+    cbsa_pops = {}  # CBSA pop (sum of county pops), indexed by CBSA geo
 
     cbsas_with_unnamed_main_places = {}
     cbsas_without_main_places = {}
@@ -1576,8 +2007,9 @@ def load_cbsa_geos(geo_session, session, sub1keys=None, cbsa_keys=None):
                        uses_the=True,
                        path_parent=us,
                        parents=cbsa_states.keys(),
-                       children=set(cbsa_counties) | cbsa_county_children,
-                       child_data_level=SUBDIVISION2)  # Sum from counties
+                       children=set(cbsa_counties) | cbsa_county_children)
+            # Data is summed from counties by rollup_geo_data once saved
+            cbsa_pops[cbsa] = sum(cbsa_counties.values())
 
             cbsa_glvl = GeoLevel(geo=cbsa,
                                  level=CORE_AREA,
@@ -1652,10 +2084,10 @@ def load_cbsa_geos(geo_session, session, sub1keys=None, cbsa_keys=None):
 
                 # Find top 2 CBSAs in CSA
                 if (csa_cbsa_1 is None or
-                        cbsa.data.total_pop > csa_cbsa_1.data.total_pop):
+                        cbsa_pops[cbsa] > cbsa_pops[csa_cbsa_1]):
                     csa_cbsa_1, csa_cbsa_2 = cbsa, csa_cbsa_1
                 elif (csa_cbsa_2 is None or
-                        cbsa.data.total_pop > csa_cbsa_2.data.total_pop):
+                        cbsa_pops[cbsa] > cbsa_pops[csa_cbsa_2]):
                     csa_cbsa_2 = cbsa
 
                 # We're on the last record for a valid CSA, so create geo
@@ -1673,8 +2105,8 @@ def load_cbsa_geos(geo_session, session, sub1keys=None, cbsa_keys=None):
                               parents=csa_states.keys(),
                               children=(set(csa_cbsa_main_places) |
                                         set(csa_counties) |
-                                        csa_county_children),
-                              child_data_level=CORE_AREA)  # Sum from cbsas
+                                        csa_county_children))
+                    # Data is summed from CBSAs by rollup_geo_data
 
                     csa_glvl = GeoLevel(geo=csa,
                                         level=COMBINED_AREA,
@@ -1682,8 +2114,8 @@ def load_cbsa_geos(geo_session, session, sub1keys=None, cbsa_keys=None):
                     GeoID(level=csa_glvl, standard=CSA_2010, code=csa_code)
 
                     if (csa_cbsa_2 is None or
-                        csa_cbsa_1.data.total_pop >
-                            csa_cbsa_2.data.total_pop * 1):
+                        cbsa_pops[csa_cbsa_1] >
+                            cbsa_pops[csa_cbsa_2] * 1):
                         csa_main_cbsa = csa_cbsa_1
 
                     # CSA aliases
@@ -1845,6 +2277,20 @@ def load_cbsa_geos(geo_session, session, sub1keys=None, cbsa_keys=None):
                 p2_total=p2_total) if p2_pop != p2_total else ''))
 
 
+def load_parent_data(geo_session, session):
+    '''
+    Roll up data for saved parent geos (e.g. CBSAs) from children
+
+    The rollup bypasses the ORM, so instances in the session are then
+    expired, as commits may not expire them (see load_geos_in_stages).
+    '''
+    for stats in rollup_geo_data(session):
+        print('Rolled up {level} data from {child_level}: {created:,} '
+              'created, {updated:,} updated in {seconds:.2f}s'
+              .format(**stats._asdict()))
+    session.expire_all()
+
+
 def load_manual_fixes(geo_session, session):
     '''Load manual fixes'''
     # TODO: Add verbose state aliases, prevent us/washington DC alias,
@@ -1866,6 +2312,10 @@ def load_manual_fixes(geo_session, session):
 
 
 if __name__ == '__main__':
+    from docopt import docopt
+
+    options = {k.lstrip('-'): v for k, v in docopt(__doc__).items()}
+
     # Session for geo.db, which contains the geo source data
     geo_dsm = DataSessionManager(db_config=DevConfig.GEO_DATABASE,
                                  ModelBases=[BaseGeoDataModel])
@@ -1878,7 +2328,19 @@ if __name__ == '__main__':
     extend_declarative_base(BaseGeoModel, session=session)
     db.create_all()
 
-    Trackable.register_existing(session, Geo, GeoData, GeoLevel, GeoID)
+    preload_stats = Trackable.register_existing(
+        session, Geo, GeoData, GeoLevel, GeoID, preload=True)
+    for class_name, stats in preload_stats.items():
+        print('Preloaded {count:,} {cls} in {seconds:.2f}s ({memory} KB)'
+              .format(cls=class_name, count=stats.count,
+                      seconds=stats.seconds, memory=stats.memory))
     Trackable.clear_updates()
 
-    load_geos(geo_session, session)
+    stage_stats = load_geos_in_stages(geo_session, session,
+                                      resume=options['resume'])
+    for stats in stage_stats.values():
+        if stats is not None:
+            print(_format_geo_load_stats(stats))
+
+    if DevConfig.GEO_SNAPSHOT:
+        export_snapshot(DevConfig.GEO_SNAPSHOT, session)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Rolls up geo data from children to parents across the hierarchy
+
+Usage:
+    geo_data_rollup.py [options]
+
+Options:
+    -h --help       This message
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import bindparam, select
+
+from intertwine.geos.models import (
+    GeoData, GeoLevel, bump_geo_revision, geo_parent_child_association_table,
+    COMBINED_AREA, CORE_AREA, SUBDIVISION2)
+from intertwine.utils.space import WeightedCentroid
+
+# Child level from which data is rolled up, keyed by parent level and
+# ordered bottom-up, so parents are current before rolling up further
+ROLLUPS = OrderedDict((
+    (CORE_AREA, SUBDIVISION2),  # CBSAs from counties
+    (COMBINED_AREA, CORE_AREA),  # CSAs from CBSAs
+))
+
+GeoDataRollupStats = namedtuple(
+    'GeoDataRollupStats', 'level, child_level, created, updated, seconds')
+
+
+def rollup_geo_data(session, rollups=None):
+    '''
+    Roll up geo data
+
+    Bulk counterpart of GeoData.create_parent_data for the whole
+    hierarchy. Rather than loading children as models one parent at a
+    time, child data and parent/child edges are read as integer column
+    arrays and aggregated by parent in a single pass per level, and
+    all parents' data is then written back via executemany. Summed
+    fields are grouped sums and coordinates are area-weighted centroids
+    (see WeightedCentroid), all on the stored integers.
+
+    Levels are rolled up in order, so parents rolled up at one level
+    (e.g. CBSAs) are current as children at the next (e.g. CSAs).
+    Parents with data have it updated and those without have it
+    created. Parents without children with data at the child level
+    are left unchanged. Writes bypass the ORM, so instances loaded
+    beforehand are stale until expired (e.g. upon commit), and the geo
+    revision is bumped.
+
+    I/O:
+    session: session for the Intertwine database
+    rollups=None: ordered dict of child levels keyed by parent level,
+        ordered bottom-up; ROLLUPS if None
+    return: list of GeoDataRollupStats, one per parent level
+    '''
+    rollups = ROLLUPS if rollups is None else rollups
+    levels = set(rollups) | set(rollups.values())
+    bump_geo_revision(session, bulk=True)
+
+    level_table = GeoLevel.__table__
+    geo_ids_by_level = {level: set() for level in levels}
+    for geo_id, level in session.execute(
+            select([level_table.c.geo_id, level_table.c.level])
+            .where(level_table.c.level.in_(levels))):
+        geo_ids_by_level[level].add(geo_id)
+
+    # Data as column arrays, indexed by row
+    columns = GeoData.DequantizedRecord._fields
+    data_table = GeoData.__table__
+    data_columns = [data_table.c[key] for key in _derive_data_keys()]
+    rows, arrays = {}, [[] for _ in columns]
+    level_geo_ids = (select([level_table.c.geo_id])
+                     .where(level_table.c.level.in_(levels)))
+    for values in session.execute(
+            select([data_table.c.geo_id] + data_columns)
+            .where(data_table.c.geo_id.in_(level_geo_ids))):
+        rows[values[0]] = len(rows)
+        for array, value in zip(arrays, values[1:]):
+            array.append(value)
+
+    # Edges by parent, with parents at any level being rolled up
+    association = geo_parent_child_association_table
+    parent_geo_ids = (select([level_table.c.geo_id])
+                      .where(level_table.c.level.in_(rollups)))
+    edges = sorted(tuple(edge) for edge in session.execute(
+        select([association.c.parent_id, association.c.child_id])
+        .where(association.c.parent_id.in_(parent_geo_ids))))
+
+    all_stats = []
+    created, updated = OrderedDict(), OrderedDict()
+    for level, child_level in rollups.items():
+        start_time = time.time()
+        aggregates = _aggregate(edges, geo_ids_by_level[level],
+                                geo_ids_by_level[child_level], rows, arrays)
+        num_created = num_updated = 0
+        for geo_id, record in aggregates.items():
+            row = rows.get(geo_id)
+            if row is None:
+                rows[geo_id] = len(arrays[0])
+                for array, value in zip(arrays, record):
+                    array.append(value)
+                created[geo_id] = record
+                num_created += 1
+            else:
+                for array, value in zip(arrays, record):
+                    array[row] = value
+                if geo_id in created:
+                    created[geo_id] = record
+                else:
+                    updated[geo_id] = record
+                    num_updated += 1
+        all_stats.append(GeoDataRollupStats(
+            level=level, child_level=child_level, created=num_created,
+            updated=num_updated, seconds=time.time() - start_time))
+
+    _write_geo_data(session, data_columns, created, updated)
+    return all_stats
+
+
+def _derive_data_keys():
+    '''Derive GeoData column keys in DequantizedRecord order'''
+    return [field if field in (GeoData.TOTAL_POP, GeoData.URBAN_POP)
+            else '_' + field for field in GeoData.DequantizedRecord._fields]
+
+
+def _aggregate(edges, parent_ids, child_ids, rows, arrays):
+    '''
+    Aggregate
+
+    Aggregate child data arrays by parent in one pass over the edges,
+    which are sorted by parent. Returns an ordered dict of
+    DequantizedRecords keyed by parent geo id.
+    '''
+    (total_pops, urban_pops, latitudes, longitudes, land_areas,
+     water_areas) = arrays
+    aggregates = OrderedDict()
+    parent_id = sums = centroid = None
+    for edge_parent_id, child_id in edges:
+        row = rows.get(child_id)
+        if (row is None or edge_parent_id not in parent_ids or
+                child_id not in child_ids):
+            continue
+        if edge_parent_id != parent_id:
+            if sums is not None:
+                aggregates[parent_id] = _derive_record(sums, centroid)
+            parent_id, sums, centroid = edge_parent_id, [0] * 4, (
+                WeightedCentroid())
+        land_area, water_area = land_areas[row], water_areas[row]
+        sums[0] += total_pops[row]
+        sums[1] += urban_pops[row]
+        sums[2] += land_area
+        sums[3] += water_area
+        centroid.add(latitudes[row], longitudes[row], land_area + water_area)
+    if sums is not None:
+        aggregates[parent_id] = _derive_record(sums, centroid)
+    return aggregates
+
+
+def _derive_record(sums, centroid):
+    total_pop, urban_pop, land_area, water_area = sums
+    latitude, longitude = centroid.coordinates
+    return GeoData.DequantizedRecord(
+        total_pop, urban_pop, latitude, longitude, land_area, water_area)
+
+
+def _write_geo_data(session, data_columns, created, updated):
+    '''Write created and updated geo data rows via executemany'''
+    table = GeoData.__table__
+    keys = [column.key for column in data_columns]
+    if updated:
+        # Bind parameter names may not match column names in updates
+        session.execute(
+            table.update()
+                 .where(table.c.geo_id == bindparam('b_geo_id'))
+                 .values({key: bindparam('b_' + key) for key in keys}),
+            [dict(zip(['b_geo_id'] + ['b_' + key for key in keys],
+                      (geo_id,) + record))
+             for geo_id, record in sorted(updated.items())])
+    if created:
+        session.execute(
+            table.insert(),
+            [dict(zip(['geo_id'] + keys, (geo_id,) + record))
+             for geo_id, record in sorted(created.items())])
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    from alchy import Manager
+    from alchy.model import extend_declarative_base
+
+    from config import DevConfig
+    from data.geos.geo_snapshot import export_snapshot
+    from intertwine.geos.models import BaseGeoModel
+
+    docopt(__doc__)
+
+    db = Manager(Model=BaseGeoModel, config=DevConfig)
+    session = db.session
+    extend_declarative_base(BaseGeoModel, session=session)
+
+    all_stats = rollup_geo_data(session)
+    session.commit()
+    for stats in all_stats:
+        print('{level} from {child_level}: {created:,} created, '
+              '{updated:,} updated in {seconds:.2f}s'
+              .format(**stats._asdict()))
+
+    if DevConfig.GEO_SNAPSHOT:
+        export_snapshot(DevConfig.GEO_SNAPSHOT, session)
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Verifies consistency of geo data across the hierarchy
+
+Reports parents whose data differs from the sums of their children,
+alias anomalies, and orphans as JSON, exiting with status 1 if any are
+found.
+
+Usage:
+    geo_data_verify.py [options]
+
+Options:
+    -h --help                   This message
+    -o --output FILE            Write the report to FILE instead of stdout
+    -t --tolerance N            Absolute tolerance, in field units (e.g.
+                                people or sq km) [default: 0]
+    -r --relative-tolerance R   Relative tolerance, as a fraction of the
+                                parent value [default: 0]
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import io
+import json
+import sys
+from collections import OrderedDict
+
+from sqlalchemy import and_, func, null, or_, select
+
+from intertwine.geos.models import (
+    Geo, GeoData, GeoID, GeoLevel, geo_alias_association_table,
+    geo_parent_child_association_table,
+    COUNTRY, SUBDIVISION1, SUBDIVISION2, CORE_AREA, COMBINED_AREA)
+from intertwine.utils.space import Area
+
+REPORT_VERSION = 1
+
+# Child levels whose data should sum to that of parents, keyed by parent
+# level; e.g. counties partition states, but places do not
+PARTITIONS = OrderedDict((
+    (COUNTRY, (SUBDIVISION1,)),
+    (SUBDIVISION1, (SUBDIVISION2,)),
+    (CORE_AREA, (SUBDIVISION2,)),
+    (COMBINED_AREA, (CORE_AREA,)),
+))
+
+# Units of summed fields, as stored (see GeoData)
+AREA_UNITS = 'sq km * 10^{}'.format(Area.DEFAULT_PRECISION)
+FIELD_UNITS = OrderedDict(
+    (field, AREA_UNITS if field in GeoData.AREA_FIELDS else 'people')
+    for field in GeoData.SUMMED_FIELDS)
+
+
+def verify_geo_data(session, tolerance=0, relative_tolerance=0,
+                    partitions=None):
+    '''
+    Verify geo data
+
+    Check the whole geo hierarchy at once, as a batch alternative to
+    Geo.data_matches. Expected sums of each summed field are computed
+    for every parent and child level via grouped SQL and compared with
+    the parent's data, and alias anomalies and orphans are found via
+    set-based queries, so geos are never loaded as models.
+
+    A sum mismatches if it differs from the parent value by more than
+    both the absolute tolerance (in field units, as with the inexact
+    argument of GeoData.matches) and the relative tolerance (as a
+    fraction of the parent value). Parents without data but with
+    children with data are also reported as mismatches.
+
+    Alias anomalies are aliases of aliases, aliases of themselves, and
+    aliases with data, levels, parents, or children. Orphans are geos
+    that are neither aliases nor at the top level yet have no parents,
+    geos without levels that are not aliases, and data, levels, IDs,
+    and associations that refer to missing rows.
+
+    I/O:
+    session: session for the Intertwine database
+    tolerance=0: absolute tolerance, in field units
+    relative_tolerance=0: relative tolerance, as a fraction
+    partitions=None: ordered dict of child levels whose data sums to
+        that of parents, keyed by parent level; PARTITIONS if None
+    return: JSON-serializable ordered dict report, with summary,
+        tolerances, units, mismatches, alias_anomalies, and orphans
+    '''
+    partitions = PARTITIONS if partitions is None else partitions
+    human_ids = dict(tuple(row) for row in session.execute(
+        select([Geo.__table__.c.id, Geo.__table__.c.human_id])))
+
+    mismatches, num_checked = _find_mismatches(
+        session, human_ids, tolerance, relative_tolerance, partitions)
+    alias_anomalies = _find_alias_anomalies(session, human_ids)
+    orphans = _find_orphans(session, human_ids)
+
+    report = OrderedDict()
+    report['version'] = REPORT_VERSION
+    report['summary'] = OrderedDict((
+        ('ok', not (mismatches or alias_anomalies or orphans)),
+        ('geos', len(human_ids)),
+        ('sums_checked', num_checked),
+        ('mismatches', len(mismatches)),
+        ('alias_anomalies', len(alias_anomalies)),
+        ('orphans', len(orphans)),
+    ))
+    report['tolerances'] = OrderedDict((
+        ('absolute', tolerance), ('relative', relative_tolerance)))
+    report['units'] = FIELD_UNITS
+    report['mismatches'] = mismatches
+    report['alias_anomalies'] = alias_anomalies
+    report['orphans'] = orphans
+    return report
+
+
+def _derive_data_columns(table):
+    '''Derive columns of summed fields, as stored, in FIELD_UNITS order'''
+    return [table.c[field if field in (GeoData.TOTAL_POP, GeoData.URBAN_POP)
+                    else '_' + field] for field in FIELD_UNITS]
+
+
+def _find_mismatches(session, human_ids, tolerance, relative_tolerance,
+                     partitions):
+    '''Find parents whose data differs from sums of children by level'''
+    association = geo_parent_child_association_table
+    parent_level = GeoLevel.__table__.alias('parent_level')
+    child_level = GeoLevel.__table__.alias('child_level')
+    child_data = GeoData.__table__.alias('child_data')
+    parent_data = GeoData.__table__.alias('parent_data')
+
+    partition_clause = or_(*(
+        and_(parent_level.c.level == level,
+             child_level.c.level.in_(child_levels))
+        for level, child_levels in partitions.items()))
+    sums = (select([association.c.parent_id.label('parent_id'),
+                    parent_level.c.level.label('parent_level'),
+                    child_level.c.level.label('child_level'),
+                    func.count().label('children')] +
+                   [func.sum(column).label(field) for field, column in zip(
+                       FIELD_UNITS, _derive_data_columns(child_data))])
+            .select_from(
+                association
+                .join(parent_level,
+                      parent_level.c.geo_id == association.c.parent_id)
+                .join(child_level,
+                      child_level.c.geo_id == association.c.child_id)
+                .join(child_data,
+                      child_data.c.geo_id == association.c.child_id))
+            .where(partition_clause)
+            .group_by(association.c.parent_id, parent_level.c.level,
+                      child_level.c.level)
+            .alias('sums'))
+
+    query = (select([sums] + [column.label('actual_' + field)
+                              for field, column in zip(
+                                  FIELD_UNITS,
+                                  _derive_data_columns(parent_data))] +
+                    [parent_data.c.id.label('parent_data_id')])
+             .select_from(sums.outerjoin(
+                 parent_data, parent_data.c.geo_id == sums.c.parent_id))
+             .order_by(sums.c.parent_id, sums.c.parent_level,
+                       sums.c.child_level))
+
+    # Tolerances in field units, converted to stored units
+    multipliers = {field: (10 ** Area.DEFAULT_PRECISION
+                           if field in GeoData.AREA_FIELDS else 1)
+                   for field in FIELD_UNITS}
+    mismatches = []
+    num_checked = 0
+    for row in session.execute(query):
+        for field in FIELD_UNITS:
+            num_checked += 1
+            expected, actual = row[field], row['actual_' + field]
+            if row['parent_data_id'] is not None:
+                if expected is None or actual is None:
+                    if expected == actual:
+                        continue
+                else:
+                    difference = abs(expected - actual)
+                    if (difference <= tolerance * multipliers[field] or
+                            difference <= relative_tolerance * abs(actual)):
+                        continue
+            mismatches.append(OrderedDict((
+                ('parent', human_ids.get(row['parent_id'])),
+                ('parent_level', row['parent_level']),
+                ('child_level', row['child_level']),
+                ('children', row['children']),
+                ('field', field),
+                ('expected', _to_int(expected)),
+                ('actual', _to_int(actual)),
+                ('difference', (_to_int(actual - expected)
+                                if None not in (expected, actual) else None)),
+            )))
+    return mismatches, num_checked
+
+
+def _find_alias_anomalies(session, human_ids):
+    '''Find aliases of aliases or themselves and aliases with relations'''
+    aliases = geo_alias_association_table
+    alias_ids = select([aliases.c.alias_id])
+    association = geo_parent_child_association_table
+
+    checks = (
+        ('alias_of_alias',
+         select([aliases.c.alias_id, aliases.c.alias_target_id])
+         .where(aliases.c.alias_target_id.in_(alias_ids))),
+        ('alias_of_itself',
+         select([aliases.c.alias_id, aliases.c.alias_target_id])
+         .where(aliases.c.alias_id == aliases.c.alias_target_id)),
+        ('alias_with_data',
+         select([GeoData.__table__.c.geo_id, null()])
+         .where(GeoData.__table__.c.geo_id.in_(alias_ids))),
+        ('alias_with_level',
+         select([GeoLevel.__table__.c.geo_id, GeoLevel.__table__.c.level])
+         .where(GeoLevel.__table__.c.geo_id.in_(alias_ids))),
+        ('alias_with_parent',
+         select([association.c.child_id, association.c.parent_id])
+         .where(association.c.child_id.in_(alias_ids))),
+        ('alias_with_child',
+         select([association.c.parent_id, association.c.child_id])
+         .where(association.c.parent_id.in_(alias_ids))),
+    )
+    anomalies = []
+    for anomaly, query in checks:
+        for geo_id, related in sorted(
+                (tuple(row) for row in session.execute(query)),
+                key=lambda row: (row[0], '{}'.format(row[1]))):
+            # Related geos are given by human_id, and levels as is
+            if anomaly != 'alias_with_level':
+                related = human_ids.get(related)
+            anomalies.append(OrderedDict((
+                ('geo', human_ids.get(geo_id)),
+                ('anomaly', anomaly),
+                ('related', related),
+            )))
+    return anomalies
+
+
+def _find_orphans(session, human_ids):
+    '''Find unparented geos, geos without levels, and dangling rows'''
+    geo = Geo.__table__
+    levels = GeoLevel.__table__
+    association = geo_parent_child_association_table
+    aliases = geo_alias_association_table
+    alias_ids = select([aliases.c.alias_id])
+    top_level_ids = (select([levels.c.geo_id])
+                     .where(levels.c.level == COUNTRY))
+    geo_ids = select([geo.c.id])
+
+    geo_checks = (
+        ('unparented',
+         select([geo.c.id]).where(and_(
+             ~geo.c.id.in_(select([association.c.child_id])),
+             ~geo.c.id.in_(alias_ids),
+             ~geo.c.id.in_(top_level_ids)))),
+        ('levelless',
+         select([geo.c.id]).where(and_(
+             ~geo.c.id.in_(select([levels.c.geo_id])),
+             ~geo.c.id.in_(alias_ids)))),
+    )
+    orphans = []
+    for orphan, query in geo_checks:
+        for geo_id, in sorted(tuple(row) for row in session.execute(query)):
+            orphans.append(OrderedDict((
+                ('table', geo.name), ('id', geo_id),
+                ('geo', human_ids.get(geo_id)), ('orphan', orphan))))
+
+    data, ids = GeoData.__table__, GeoID.__table__
+    row_checks = (
+        (data, data.c.geo_id, geo_ids),
+        (levels, levels.c.geo_id, geo_ids),
+        (ids, ids.c.level_id, select([levels.c.id])),
+        (association, association.c.parent_id, geo_ids),
+        (association, association.c.child_id, geo_ids),
+        (aliases, aliases.c.alias_target_id, geo_ids),
+        (aliases, aliases.c.alias_id, geo_ids),
+    )
+    for table, column, referent_ids in row_checks:
+        key_columns = list(table.primary_key) or list(table.c)
+        query = (select(key_columns + [column])
+                 .where(and_(column.isnot(None),
+                             ~column.in_(referent_ids))))
+        for row in sorted(tuple(row) for row in session.execute(query)):
+            key = row[:-1]
+            orphans.append(OrderedDict((
+                ('table', table.name),
+                ('id', key[0] if len(key) == 1 else list(key)),
+                ('geo', None),
+                ('orphan', 'missing_{}'.format(column.name)))))
+    return orphans
+
+
+def _to_int(value):
+    '''Convert SQL sums (e.g. Decimals in PostgreSQL) to integers'''
+    return int(value) if value is not None else None
+
+
+def write_report(report, output=None):
+    '''Write report as JSON to the output path, or stdout if None'''
+    text = json.dumps(report, indent=2)
+    if output is None:
+        print(text)
+        return
+    with io.open(output, 'w', encoding='utf-8') as report_file:
+        report_file.write('{}\n'.format(text))
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    from alchy import Manager
+    from alchy.model import extend_declarative_base
+
+    from config import DevConfig
+    from intertwine.geos.models import BaseGeoModel
+
+    options = {k.lstrip('-'): v for k, v in docopt(__doc__).items()}
+
+    db = Manager(Model=BaseGeoModel, config=DevConfig)
+    session = db.session
+    extend_declarative_base(BaseGeoModel, session=session)
+
+    report = verify_geo_data(
+        session, tolerance=float(options['tolerance']),
+        relative_tolerance=float(options['relative-tolerance']))
+    write_report(report, options['output'])
+    sys.exit(0 if report['summary']['ok'] else 1)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Exports a columnar geo snapshot for fast worker startup (see GeoSnapshot)
+
+Run after writing geos, exporting to GEO_SNAPSHOT, so workers replace
+their stale snapshots. The geo load scripts do so when it is set.
+
+Usage:
+    geo_snapshot.py [options] <path>
+
+Options:
+    -h --help       This message
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import time
+
+from alchy import Manager
+from alchy.model import extend_declarative_base
+
+from config import DevConfig
+from intertwine.geos.models import BaseGeoModel
+from intertwine.geos.snapshot import GeoSnapshot
+
+
+def export_snapshot(path, session):
+    '''Export geo snapshot to the given path, printing stats'''
+    start_time = time.time()
+    count = GeoSnapshot.export(path, session)
+    print('Exported {count:,} geos to {path} in {seconds:.2f}s'.format(
+        count=count, path=path, seconds=time.time() - start_time))
+    return count
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+
+    options = docopt(__doc__)
+
+    db = Manager(Model=BaseGeoModel, config=DevConfig)
+    session = db.session
+    extend_declarative_base(BaseGeoModel, session=session)
+
+    export_snapshot(options['<path>'], session)
@@ -9,6 +9,10 @@ from alchy.model import extend_declarative_base, make_declarative_base
 from flask_bootstrap import Bootstrap
 
 from .bases import BaseIntertwineMeta, BaseIntertwineModel
+from .trackable import Trackable
+from .utils.flask_utils import handle_invalid_cursor
+from .utils.jsonable import InvalidCursor
+from .utils.response_cache import ResponseCache
 from .__metadata__ import *  # noqa
 
 
@@ -50,6 +54,23 @@ def create_app(name=None, config=None):
     #     from flask_debugtoolbar import DebugToolbarExtension
     #     toolbar = DebugToolbarExtension()
 
+    # Bound the Trackable registries, e.g. for long-running workers
+    registry_policy = app.config.get('TRACKABLE_REGISTRY_POLICY')
+    registry_limit = app.config.get('TRACKABLE_REGISTRY_LIMIT')
+    if registry_policy or registry_limit:
+        Trackable.configure_registry(policy=registry_policy,
+                                     limit=registry_limit)
+
+    # Cache JSON API responses, invalidated as objects change
+    ResponseCache.configure(app.config)
+
+    # Resolve each hyper key at most once per request
+    app.before_request(Trackable.begin_memo)
+    app.teardown_request(Trackable.end_memo)
+
+    # Invalid cursors from query strings are client errors
+    app.register_error_handler(InvalidCursor, handle_invalid_cursor)
+
     # TODO: replace with Bootstrap 4
     Bootstrap(app)
 
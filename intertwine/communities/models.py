@@ -3,14 +3,17 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import time
 from collections import namedtuple
 from itertools import groupby
 from operator import attrgetter
 
-from sqlalchemy import Column, ForeignKey, Index, desc, orm, types
-from sqlalchemy.orm.exc import DetachedInstanceError
+from sqlalchemy import (Column, ForeignKey, Index, cast, desc, func, null, or_,
+                        orm, types)
+from sqlalchemy.orm.exc import DetachedInstanceError, NoResultFound
 
 from intertwine import IntertwineModel
+from intertwine.geos.models import geo_closure_table
 from intertwine.problems.exceptions import InvalidAggregation
 from intertwine.problems.models import (
     AggregateProblemConnectionRating as APCR,
@@ -24,6 +27,10 @@ from intertwine.utils.tools import vardygrify
 
 BaseCommunityModel = IntertwineModel
 
+BackfillStats = namedtuple(
+    'BackfillStats',
+    'ratings, aggregate_ratings, communities, seconds, ratings_per_second')
+
 
 class Community(BaseCommunityModel):
     '''Base class for communities
@@ -42,6 +49,7 @@ class Community(BaseCommunityModel):
     # org may each be None, indicating no org affiliation.
 
     ALPHABETIZE_UNRATED_CONNECTIONS = False  # Adds overhead when True
+    BACKFILL_BATCH_SIZE = 1000
 
     problem_id = Column(types.Integer, ForeignKey('problem.id'))
     _problem = orm.relationship('Problem', lazy='joined')
@@ -178,8 +186,14 @@ class Community(BaseCommunityModel):
     @classmethod
     def manifest(cls, problem_huid, org_huid, geo_huid):
         '''Manifest community, either real or vardygr'''
+        path = (problem_huid, org_huid, geo_huid)
+        # Retrieve existing community and its components via single query
+        try:
+            return cls.reconstruct(path, retrieve=True)
+        except NoResultFound:
+            pass
         # Raise if any human ids don't exist
-        key = cls.reconstruct((problem_huid, org_huid, geo_huid), as_key=True)
+        key = cls.reconstruct(path, as_key=True)
         try:
             return cls[key]
         except KeyMissingFromRegistryAndDatabase:
@@ -193,16 +207,58 @@ class Community(BaseCommunityModel):
         self.num_followers = num_followers
 
     def update_inclusive_aggregate_ratings(self, connection, user,
-                                           new_user_rating,
-                                           old_user_rating=None):
+                                           new_user_rating, new_user_weight,
+                                           old_user_rating=None,
+                                           old_user_weight=None):
         '''Update inclusive aggregate ratings
 
-        Works by updating the inclusive aggregate ratings for the
-        current community and then recursively calling itself on
-        immediately encompassing communities.
+        Applies a change in a user's rating within the current community
+        to the inclusive aggregate ratings of the current community and
+        of the communities for all geos encompassing its geo, including
+        'The World' (geo is None). Ancestor geos are found in a single
+        query via the geo hierarchy closure, so each is updated exactly
+        once even if reachable via several parents.
+
+        Each inclusive aggregate rating keeps its running weighted
+        rating and weight, which are adjusted incrementally, so reads
+        are a single row lookup. Missing communities are created and
+        missing inclusive aggregate ratings are seeded from all other
+        included ratings, to which the user's new rating is applied.
+        Changes to the geo hierarchy are not propagated; run
+        backfill_aggregate_ratings(aggregation='inclusive') after them.
         '''
-        # TODO
-        pass
+        problem, org, geo = self.derive_key()
+        geos = [geo]
+        if geo is not None:
+            geos.extend(geo.ancestors())
+            geos.append(None)  # The World encompasses every geo
+
+        communities = [community for community, created in
+                       Community.get_or_create_many(
+                           [dict(problem=problem, org=org, geo=g)
+                            for g in geos])]
+        apcrs = {apcr.community_id: apcr for apcr in APCR.query.filter(
+            APCR.community_id.in_([c.id for c in communities]),
+            APCR.connection == connection,
+            APCR.aggregation == APCR.INCLUSIVE)}
+
+        for community in communities:
+            apcr = apcrs.get(community.id)
+            old_rating, old_weight = old_user_rating, old_user_weight
+            if apcr is None:
+                other_ratings = (
+                    APCR.query_ratings(connection, community, APCR.INCLUSIVE)
+                        .filter(or_(PCR.user != user, PCR.geo != geo)))
+                rating, weight = APCR.calculate_values(other_ratings)
+                apcr = APCR(connection=connection, community=community,
+                            aggregation=APCR.INCLUSIVE,
+                            rating=rating, weight=weight)
+                old_rating = old_weight = None
+
+            apcr.update_values(new_user_rating=new_user_rating,
+                               new_user_weight=new_user_weight,
+                               old_user_rating=old_rating,
+                               old_user_weight=old_weight)
 
     def update_aggregate_ratings(self, connection, user,
                                  new_user_rating, new_user_weight,
@@ -213,11 +269,24 @@ class Community(BaseCommunityModel):
         values, updates all affected aggregate ratings. Intended to be
         called in conjunction with or shortly after the rating has been
         updated.
+
+        If the strict aggregate rating does not yet exist, it is created
+        from the ratings of all other users, to which the user's new
+        rating is then applied. This keeps the result independent of
+        whether the user's rating has been flushed.
         '''
         # Update the strict aggregate rating for this community
         apcr = APCR.query.filter_by(community=self, connection=connection,
-                                    aggregation='strict').first()
-        if apcr:
+                                    aggregation=APCR.STRICT).first()
+        if apcr is None:
+            other_ratings = (APCR.query_ratings(connection, self)
+                                 .filter(PCR.user != user))
+            rating, weight = APCR.calculate_values(other_ratings)
+            apcr = APCR(connection=connection, community=self,
+                        aggregation=APCR.STRICT, rating=rating, weight=weight)
+            apcr.update_values(new_user_rating=new_user_rating,
+                               new_user_weight=new_user_weight)
+        else:
             apcr.update_values(new_user_rating=new_user_rating,
                                new_user_weight=new_user_weight,
                                old_user_rating=old_user_rating,
@@ -225,7 +294,8 @@ class Community(BaseCommunityModel):
         # Update inclusive aggregate ratings in encompassing communities
         self.update_inclusive_aggregate_ratings(
             connection=connection, user=user,
-            new_user_rating=new_user_rating, old_user_rating=old_user_rating)
+            new_user_rating=new_user_rating, new_user_weight=new_user_weight,
+            old_user_rating=old_user_rating, old_user_weight=old_user_weight)
 
     def aggregate_connection_ratings(self, aggregation='strict'):
         '''Aggregate connection ratings
@@ -242,11 +312,11 @@ class Community(BaseCommunityModel):
         community_key = self.derive_key()
         problem, org, geo = community_key
 
-        if aggregation not in ('strict'):
+        if aggregation not in APCR.AGGREGATIONS:
             raise InvalidAggregation(aggregation=aggregation)
 
-        pcrs = (PCR.query.filter_by(problem=problem, org=org, geo=geo)
-                         .order_by(PCR.connection_category, PCR.connection_id))
+        pcrs = (APCR.query_ratings(None, self, aggregation)
+                    .order_by(PCR.connection_category, PCR.connection_id))
         pcrs = PeekableIterator(pcrs)
         # Create and persist a community only if necessary
         if not is_real_community and pcrs.has_next():
@@ -277,6 +347,133 @@ class Community(BaseCommunityModel):
 
         return ars
 
+    @classmethod
+    def backfill_aggregate_ratings(cls, aggregation='strict',
+                                   batch_size=None, session=None):
+        '''
+        Backfill aggregate ratings
+
+        Batch job that recalculates the aggregate ratings of every
+        community at once, e.g. after bulk rating imports. Aggregate
+        ratings are otherwise maintained as ratings are written.
+
+        Rather than loading ratings as models, weighted rating totals
+        and weights are summed by a single GROUP BY query across all
+        communities and connections. For inclusive aggregation, each
+        rating is also counted toward every ancestor geo via the geo
+        hierarchy closure and toward 'The World'. Missing communities
+        and aggregate ratings are then bulk inserted and existing
+        aggregate ratings bulk updated, in batches. Aggregate ratings
+        whose ratings no longer exist are reset to no rating. Commits
+        upon completion.
+
+        I/O:
+        aggregation='strict': aggregation method, 'strict' or 'inclusive'
+        batch_size=None: rows per bulk insert/update; BACKFILL_BATCH_SIZE
+            if None
+        session=None: session to use; defaults to that of Community
+        return: BackfillStats namedtuple of ratings, aggregate_ratings,
+            communities (created), seconds, and ratings_per_second
+        '''
+        if aggregation not in APCR.AGGREGATIONS:
+            raise InvalidAggregation(aggregation=aggregation)
+        session = session or cls.session()
+        batch_size = batch_size or cls.BACKFILL_BATCH_SIZE
+        start_time = time.time()
+
+        num_ratings = session.query(func.count(PCR.id)).scalar()
+        sums = cls._query_rating_sums(session, aggregation).all()
+
+        community_ids = {
+            (problem_id, org, geo_id): community_id
+            for community_id, problem_id, org, geo_id in session.query(
+                cls.id, cls.problem_id, cls._org, cls.geo_id)}
+        new_communities = []
+        for row in sums:
+            key = row[:3]
+            if key not in community_ids:
+                community_ids[key] = None
+                new_communities.append(dict(
+                    problem_id=key[0], _org=key[1], geo_id=key[2],
+                    num_followers=0))
+        for i in range(0, len(new_communities), batch_size):
+            batch = new_communities[i:i + batch_size]
+            session.bulk_insert_mappings(cls, batch, return_defaults=True)
+        for values in new_communities:
+            community_ids[(values['problem_id'], values['_org'],
+                           values['geo_id'])] = values['id']
+
+        apcr_ids = {
+            (community_id, connection_id): apcr_id
+            for apcr_id, community_id, connection_id in session.query(
+                APCR.id, APCR.community_id, APCR.connection_id)
+            .filter(APCR.aggregation == aggregation)}
+        inserts, updates = [], []
+        for row in sums:
+            connection_id, category, rating_total, weight = row[3:]
+            community_id = community_ids[row[:3]]
+            values = dict(rating=(rating_total * 1.0 / weight
+                                  if weight > APCR.NO_WEIGHT
+                                  else APCR.NO_RATING),
+                          weight=weight)
+            apcr_id = apcr_ids.pop((community_id, connection_id), None)
+            if apcr_id is None:
+                values.update(community_id=community_id,
+                              connection_id=connection_id,
+                              connection_category=category,
+                              aggregation=aggregation)
+                inserts.append(values)
+            else:
+                values.update(id=apcr_id)
+                updates.append(values)
+        # Remaining aggregate ratings no longer have any ratings
+        updates.extend(dict(id=apcr_id, rating=APCR.NO_RATING,
+                            weight=APCR.NO_WEIGHT)
+                       for apcr_id in apcr_ids.values())
+
+        for mappings, bulk in ((inserts, session.bulk_insert_mappings),
+                               (updates, session.bulk_update_mappings)):
+            for i in range(0, len(mappings), batch_size):
+                bulk(APCR, mappings[i:i + batch_size])
+        session.commit()
+
+        seconds = time.time() - start_time
+        return BackfillStats(
+            ratings=num_ratings, aggregate_ratings=len(inserts) + len(updates),
+            communities=len(new_communities), seconds=seconds,
+            ratings_per_second=num_ratings / seconds if seconds else None)
+
+    @classmethod
+    def _query_rating_sums(cls, session, aggregation):
+        '''Query weighted rating totals and weights per community key'''
+        def rating_columns(geo_id):
+            return (PCR.problem_id.label('problem_id'), PCR.org.label('org'),
+                    geo_id.label('geo_id'),
+                    PCR.connection_id.label('connection_id'),
+                    PCR.connection_category.label('connection_category'),
+                    PCR._rating.label('rating'), PCR._weight.label('weight'))
+
+        ratings = session.query(*rating_columns(PCR.geo_id))
+        if aggregation == APCR.INCLUSIVE:
+            closure = geo_closure_table
+            ancestor_ratings = (
+                session.query(*rating_columns(closure.c.ancestor_id))
+                       .join(closure, closure.c.descendant_id == PCR.geo_id))
+            world_ratings = (
+                session.query(*rating_columns(cast(null(), types.Integer)))
+                       .filter(PCR.geo_id.isnot(None)))
+            ratings = ratings.union_all(ancestor_ratings, world_ratings)
+        ratings = ratings.subquery()
+
+        # Community key columns followed by connection columns
+        group_columns = (ratings.c.problem_id, ratings.c.org,
+                         ratings.c.geo_id, ratings.c.connection_id,
+                         ratings.c.connection_category)
+        sum_columns = (func.sum(ratings.c.rating * ratings.c.weight),
+                       func.sum(ratings.c.weight))
+        return (session.query(*(group_columns + sum_columns))
+                       .group_by(*group_columns))
+
     def jsonify_connection_category(self, problem, category, aggregation,
                                     aggregate_ratings, depth, **json_kwargs):
         '''Prepare connection rating JSON
@@ -331,27 +528,21 @@ class Community(BaseCommunityModel):
         'impacts', 'broader', 'narrower') where values are lists of
         aggregate rating JSON in descending order by rating.
 
-        Searches for existing aggregate connection ratings with the
-        specified aggregation method, and if none are found, aggregates
-        them from ratings. Connections without ratings are included last
-        in alphabetical order by the name of the adjoining problem.
+        Reads existing aggregate connection ratings with the specified
+        aggregation method, which are maintained as ratings are written,
+        so it never writes. Connections without aggregate ratings are
+        included last, in alphabetical order by the name of the
+        adjoining problem if ALPHABETIZE_UNRATED_CONNECTIONS is True.
         '''
         community = self
         community_exists = type(self) is Community
         problem, org, geo = self.derive_key()
 
+        ars = ()
         if community_exists:
             ars = (APCR.query
                        .filter_by(community=self, aggregation=aggregation)
                        .order_by(APCR.connection_category, desc(APCR.rating)))
-            ars = PeekableIterator(ars)
-
-        if not community_exists or not ars.has_next():
-            ars = self.aggregate_connection_ratings(aggregation=aggregation)
-            if ars:
-                community = ars[0].community
-                ars.sort(key=attrgetter('connection_category', 'rating'),
-                         reverse=True)
 
         rv = {category: list(community.jsonify_connection_category(
               problem, category, aggregation, aggregate_ratings, depth,
@@ -14,6 +14,7 @@ from intertwine.geos.models import Geo
 from intertwine.problems.models import Problem, ProblemConnection
 from intertwine.utils.flask_utils import json_requested
 from intertwine.utils.jsonable import Jsonable
+from intertwine.utils.response_cache import cached_json_response
 from intertwine.utils.tools import vardygrify
 from .models import Community
 
@@ -66,16 +67,21 @@ def get_community_json(problem_huid, org_huid, geo_huid):
     'http://localhost:5000/communities/homelessness/us/tx/austin'
     '''
     json_kwargs = dict(Community.objectify_json_kwargs(request.args))
+    if not request.args.get('config'):
+        json_kwargs['config'] = configure_community_json()
 
-    try:
-        community = Community.manifest(problem_huid, org_huid, geo_huid)
+    def render():
+        try:
+            community = Community.manifest(problem_huid, org_huid, geo_huid)
 
-    except IntertwineException as e:
-        raise ResourceDoesNotExist(str(e))
+        except IntertwineException as e:
+            raise ResourceDoesNotExist(str(e))
 
-    if not request.args.get('config'):
-        json_kwargs['config'] = configure_community_json()
-    return jsonify(community.jsonify(**json_kwargs))
+        community.eager_load(**json_kwargs)
+        return community.jsonify(**json_kwargs)
+
+    uri = Community.form_uri(Community.Key(problem_huid, org_huid, geo_huid))
+    return cached_json_response(uri, json_kwargs, render)
 
 
 def get_community_html(problem_huid, org_huid, geo_huid):
@@ -2,12 +2,15 @@
 # -*- coding: utf-8 -*-
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
+import os
 
 from flask import Blueprint
 from alchy import Manager
 from alchy.model import extend_declarative_base
 
 from . import models
+from .search import GeoSearchIndex
+from .snapshot import GeoSnapshot
 
 
 blueprint = Blueprint(models.Geo.blueprint_name(), __name__,
@@ -27,3 +30,54 @@ def on_load(state):
     # Set up database tables
     geo_db.config.update(state.app.config)
     geo_db.create_all()
+    configure_search_index(state.app.config)
+    configure_snapshot(state.app.config)
+
+
+def configure_search_index(config, session=None):
+    '''
+    Configure search index
+
+    Install an in-process geo search index if GEO_SEARCH_INDEX is set,
+    loading it from GEO_SEARCH_INDEX_SNAPSHOT if the file exists and is
+    current with the database, and otherwise building it from the
+    database and saving the snapshot. Snapshots saved by other
+    versions are likewise replaced. The database is read via the given
+    session, if any, or that of geo_db.
+    '''
+    if not config.get('GEO_SEARCH_INDEX'):
+        return
+    session = session or geo_db.session
+    snapshot = config.get('GEO_SEARCH_INDEX_SNAPSHOT')
+    index = None
+    if snapshot and os.path.exists(snapshot):
+        try:
+            index = GeoSearchIndex.load(snapshot)
+        except ValueError:
+            pass
+        else:
+            if not index.is_current(session):
+                index = None
+    if index is None:
+        index = GeoSearchIndex.build(session)
+        if snapshot:
+            index.save(snapshot)
+    GeoSearchIndex.install(index)
+
+
+def configure_snapshot(config, session=None):
+    '''
+    Configure snapshot
+
+    Install the geo snapshot at GEO_SNAPSHOT, if set, memory mapping it
+    read-only. Snapshots are exported via data/geos/geo_snapshot.py.
+    Snapshots exported prior to the current geo revision are stale, so
+    are bypassed until exported again, whereupon they are replaced (see
+    GeoSnapshot.reload). The database is read via the given session, if
+    any, or that of geo_db.
+    '''
+    path = config.get('GEO_SNAPSHOT')
+    if path:
+        snapshot = GeoSnapshot.load(path)
+        snapshot.is_current(session or geo_db.session)
+        GeoSnapshot.install(snapshot)
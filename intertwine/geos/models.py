@@ -6,8 +6,10 @@ import sys
 from collections import OrderedDict, namedtuple
 from functools import reduce
 
-from sqlalchemy import Column, ForeignKey, Index, Table, desc, or_, orm, types
-from sqlalchemy.exc import OperationalError
+from sqlalchemy import (DDL, Column, ForeignKey, Index, Table, desc, event,
+                        func, inspect, literal, or_, orm, select, types)
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.orm import attributes
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.orm.exc import DetachedInstanceError
 
@@ -15,7 +17,8 @@ from intertwine import IntertwineModel
 from intertwine.exceptions import (AttributeConflict, CircularReference)
 from intertwine.utils.enums import MatchType
 from intertwine.utils.jsonable import JsonProperty
-from intertwine.utils.space import Area, Coordinate, GeoLocation
+from intertwine.utils.space import (Area, Coordinate, GeoLocation,
+                                    WeightedCentroid)
 from intertwine.utils.tools import (define_constants_at_module_scope,
                                     find_any_words)
 
@@ -373,6 +376,10 @@ class GeoData(BaseGeoModel):
         'GeoData_Record',
         'total_pop, urban_pop, latitude, longitude, land_area, water_area')
 
+    # Values as stored: coordinates * 10^7 and areas * 10^6, as integers
+    DequantizedRecord = namedtuple('GeoData_DequantizedRecord',
+                                   Record._fields)
+
     Key = namedtuple('GeoDataKey', (GEO,))
 
     @classmethod
@@ -445,6 +452,31 @@ class GeoData(BaseGeoModel):
 
     jsonified_location = JsonProperty(name='location', after='geo')
 
+    @classmethod
+    def find_timezone_names(cls, data_rows):
+        '''
+        Find timezone names
+
+        Return timezone names for many geo data rows at once, via the
+        batch lookup in GeoLocation.find_timezone_names, which looks up
+        each distinct location only once and memoizes the results.
+
+        I/O:
+        data_rows: iterable of GeoData instances
+        return: ordered dict of timezone names keyed by GeoData, with
+            None for rows without a location or timezone
+        '''
+        data_rows = list(data_rows)
+        located = [(data, data.location) for data in data_rows]
+        located = [(data, location) for data, location in located
+                   if location is not None]
+        tz_names = GeoLocation.find_timezone_names(
+            location for data, location in located)
+        rv = OrderedDict((data, None) for data in data_rows)
+        rv.update((data, tz_name)
+                  for (data, location), tz_name in zip(located, tz_names))
+        return rv
+
     @property
     def land_area(self):
         try:
@@ -516,8 +548,9 @@ class GeoData(BaseGeoModel):
               in zip(field_names._fields, field_names)))
 
     @classmethod
-    def transform_value(cls, field, value):
-        return (Coordinate(value) if field in cls.COORDINATE_FIELDS else
+    def transform_value(cls, field, value, requantize=False):
+        return (Coordinate(value, requantize=requantize)
+                if field in cls.COORDINATE_FIELDS else
                 Area(value, requantize=True) if field in cls.AREA_FIELDS else
                 value)
 
@@ -539,7 +572,8 @@ class GeoData(BaseGeoModel):
         Create parent data
 
         Constructor for aggregating geo data for a parent geo from its
-        children geos at a given level.
+        children geos at a given level. Values are aggregated as stored
+        integers (see combine_dequantized), without Decimals per child.
 
         IO:
         parent_geo:
@@ -562,17 +596,59 @@ class GeoData(BaseGeoModel):
         if not children:
             return None
 
-        data = {field: sum((child.data[field] for child in children))
-                for field in cls.SUMMED_FIELDS}
+        record = cls.combine_dequantized(
+            child.data.dequantize() for child in children)
+        return cls.from_dequantized(parent_geo, record)
 
-        geo_location = GeoLocation.combine_locations(
-            *((GeoLocation(child.data.latitude, child.data.longitude),
-                child.data.total_area)
-                for child in children))
+    def dequantize(self):
+        '''Return DequantizedRecord of values as stored, sans Decimals'''
+        return self.DequantizedRecord(
+            self.total_pop, self.urban_pop, self._latitude, self._longitude,
+            self._land_area, self._water_area)
 
-        data['latitude'], data['longitude'] = geo_location.coordinates
+    @classmethod
+    def requantize(cls, record):
+        '''Return Record of Coordinates/Areas given a DequantizedRecord'''
+        return cls.Record(
+            *(cls.transform_value(field, value, requantize=True)
+              if value is not None else None
+              for field, value in zip(record._fields, record)))
+
+    @classmethod
+    def combine_dequantized(cls, records):
+        '''
+        Combine dequantized records
+
+        Aggregate DequantizedRecords with integer arithmetic only:
+        summed fields are summed, and coordinates are combined weighted
+        by total area via WeightedCentroid, as create_parent_data does.
+
+        I/O:
+        records: iterable of DequantizedRecords
+        return: DequantizedRecord of aggregated values
+        '''
+        total_pop = urban_pop = land_area = water_area = 0
+        centroid = WeightedCentroid()
+        for record in records:
+            total_pop += record.total_pop
+            urban_pop += record.urban_pop
+            land_area += record.land_area
+            water_area += record.water_area
+            centroid.add(record.latitude, record.longitude,
+                         record.land_area + record.water_area)
+        latitude, longitude = centroid.coordinates
+        return cls.DequantizedRecord(
+            total_pop, urban_pop, latitude, longitude, land_area, water_area)
 
-        return cls(parent_geo, **data)
+    @classmethod
+    def from_dequantized(cls, geo, record):
+        '''Create geo data for geo given a DequantizedRecord'''
+        data = cls(geo, total_pop=record.total_pop,
+                   urban_pop=record.urban_pop)
+        data._latitude, data._longitude = record.latitude, record.longitude
+        data._land_area, data._water_area = (record.land_area,
+                                             record.water_area)
+        return data
 
     def __init__(self, geo, total_pop=None, urban_pop=None,
                  latitude=None, longitude=None,
@@ -601,6 +677,36 @@ geo_alias_association_table = Table(
 )
 
 
+# Closure of the parent/child hierarchy: one row per ancestor/descendant
+# pair at the shortest depth (number of parent/child hops) between them.
+# Backfilled upon creation and maintained on flush; see
+# Geo.refresh_closure
+geo_closure_table = Table(
+    'geo_closure', BaseGeoModel.metadata,
+    Column('ancestor_id', types.Integer,
+           ForeignKey('geo.id', ondelete='CASCADE'), primary_key=True),
+    Column('descendant_id', types.Integer,
+           ForeignKey('geo.id', ondelete='CASCADE'), primary_key=True),
+    Column('depth', types.Integer, nullable=False),
+    Index('ix_geo_closure:descendant_id+depth', 'descendant_id', 'depth')
+)
+
+
+# Revision of the geo tables, bumped once per transaction that writes
+# geos or their data, levels, IDs, or relations, so processes holding
+# structures derived from the tables (e.g. snapshots) can detect changes
+# committed elsewhere. The single row is seeded upon creation; see
+# bump_geo_revision
+geo_revision_table = Table(
+    'geo_revision', BaseGeoModel.metadata,
+    Column('id', types.Integer, primary_key=True),
+    Column('revision', types.BigInteger, nullable=False)
+)
+
+event.listen(geo_revision_table, 'after_create', DDL(
+    'INSERT INTO geo_revision (id, revision) VALUES (1, 0)'))
+
+
 class Geo(BaseGeoModel):
     '''
     Geo
@@ -714,12 +820,53 @@ class Geo(BaseGeoModel):
 
     KEYWORDS_FOR_USES_THE = {'states', 'islands', 'republic', 'district'}
 
-    uses_the = Column(types.Boolean)  # e.g. 'The United States'
+    # Whether window functions are used; if None, decided per backend
+    # (see supports_window_functions)
+    WINDOW_FUNCTIONS_SUPPORTED = None
+    # Minimum versions supporting window functions, by dialect name
+    WINDOW_FUNCTION_VERSIONS = {'sqlite': (3, 25, 0), 'postgresql': (8, 4),
+                                'mysql': (8, 0), 'oracle': (8,),
+                                'mssql': (9,)}
+    _window_function_support = {}  # by dialect name and server version
+
+    # Hierarchy closure maintenance (see refresh_closure)
+    CLOSURE_MAX_DEPTH = 20  # Guards recursion against cycles
+    CLOSURE_BATCH_SIZE = 500
+    CLOSURE_REBUILD_THRESHOLD = 1000
+
+    # Optional in-process index used by find_matches (see search module)
+    search_index = None
+
+    # Optional read-only snapshot of the geo graph used by related geo
+    # and match reads (see snapshot module)
+    snapshot = None
+
+    _uses_the = Column('uses_the', types.Boolean)  # e.g. 'The United States'
     _name = Column('name', types.String(60), index=True)
     _abbrev = Column('abbrev', types.String(20), index=True)
     _qualifier = Column('qualifier', types.String(60))
     _human_id = Column(HUMAN_ID, types.String(200), index=True, unique=True)
 
+    # display() variants are cached per instance (see display)
+    DisplayArgs = namedtuple('GeoDisplayArgs', (
+        'show_the', 'show_The', 'show_abbrev', 'show_qualifier',
+        'abbrev_path', 'max_path'))
+    DisplayArgs.__new__.__defaults__ = (True, False, True, True, True,
+                                        float('Inf'))
+
+    # Fields of a geo included in displays: those of its path children
+    # include the first PATH_DISPLAY_FIELDS, but not uses_the/qualifier
+    DISPLAY_FIELDS = ('_name', '_abbrev', 'path_parent_id', '_uses_the',
+                      '_qualifier')
+    PATH_DISPLAY_FIELDS = 3
+
+    # Incremented whenever name, abbrev, or path parent change, so the
+    # displays cached by the geo and its path children are invalidated
+    _display_stamp = 0
+    _display_fields = None  # Values as of any displays cached via path
+    _display_cache = None  # (path stamps, displays by DisplayArgs)
+    _uri_cache = None  # (human_id, uri)
+
     jsonified_display = JsonProperty(
         name='display', after=HUMAN_ID, method='display', kwargs=dict(
             max_path=1, show_the=True, show_abbrev=False, abbrev_path=True))
@@ -783,6 +930,17 @@ class Geo(BaseGeoModel):
 
     PATH_DELIMITER = '/'
 
+    @property
+    def uses_the(self):
+        return self._uses_the
+
+    @uses_the.setter
+    def uses_the(self, val):
+        self._uses_the = val
+        self.invalidate_display()
+
+    uses_the = orm.synonym('_uses_the', descriptor=uses_the)
+
     @property
     def name(self):
         return self._name
@@ -797,8 +955,9 @@ class Geo(BaseGeoModel):
                                  alias_targets=self.alias_targets)
             self.human_id = key.human_id
         nstr = val.lower()
-        self.uses_the = find_any_words(nstr, self.KEYWORDS_FOR_USES_THE)
+        self._uses_the = find_any_words(nstr, self.KEYWORDS_FOR_USES_THE)
         self._name = val  # set name last
+        self.invalidate_display(path_children=True)
 
     name = orm.synonym('_name', descriptor=name)
 
@@ -815,6 +974,7 @@ class Geo(BaseGeoModel):
                                  alias_targets=self.alias_targets)
             self.human_id = key.human_id
         self._abbrev = val  # set abbrev last
+        self.invalidate_display(path_children=True)
 
     abbrev = orm.synonym('_abbrev', descriptor=abbrev)
 
@@ -831,6 +991,7 @@ class Geo(BaseGeoModel):
                                  alias_targets=self.alias_targets)
             self.human_id = key.human_id
         self._qualifier = val  # set qualifier last
+        self.invalidate_display()
 
     qualifier = orm.synonym('_qualifier', descriptor=qualifier)
 
@@ -847,6 +1008,7 @@ class Geo(BaseGeoModel):
                                  alias_targets=self.alias_targets)
             self.human_id = key.human_id
         self._path_parent = val
+        self.invalidate_display(path_children=True)
 
     path_parent = orm.synonym('_path_parent', descriptor=path_parent)
 
@@ -1023,6 +1185,15 @@ class Geo(BaseGeoModel):
 
     human_id = orm.synonym('_human_id', descriptor=human_id)
 
+    @property
+    def uri(self):
+        '''URI, cached until the human_id changes'''
+        cache = self._uri_cache
+        if cache is None or cache[0] != self._human_id:
+            cache = self._uri_cache = (self._human_id,
+                                       super(Geo, self).uri)
+        return cache[1]
+
     @property
     def data(self):
         return self._data
@@ -1196,6 +1367,31 @@ class Geo(BaseGeoModel):
         '''
         Generate text for displaying a geo to a user
 
+        Displays are derived once per variant and cached on the instance
+        until a displayed field of the geo or a geo along its path
+        changes (see invalidate_display). Parameters are per
+        derive_display.
+        '''
+        args = self.DisplayArgs(show_the, show_The, show_abbrev,
+                                show_qualifier, abbrev_path, max_path)
+        cache = self._display_cache
+        # Validating may reload expired geos, which may invalidate
+        if (cache is None or not self._is_display_path_current(cache[0]) or
+                cache is not self._display_cache):
+            cache = self._display_cache = (self._derive_display_path(), {})
+        displays = cache[1]
+        try:
+            return displays[args]
+        except KeyError:
+            display = displays[args] = self.derive_display(*args)
+            return display
+
+    def derive_display(self, show_the=True, show_The=False, show_abbrev=True,
+                       show_qualifier=True, abbrev_path=True,
+                       max_path=float('Inf')):
+        '''
+        Derive text for displaying a geo to a user
+
         Returns a string derived from the name, abbrev, uses_the, and
         the geo path established by the path_parent. The following
         parameters affect the output:
@@ -1238,6 +1434,49 @@ class Geo(BaseGeoModel):
             plvl += 1
         return ', '.join(geostr)
 
+    def invalidate_display(self, path_children=False):
+        '''
+        Invalidate display
+
+        Invalidate the displays cached on the geo and, if path_children,
+        those cached on its path children (and theirs), as they include
+        its name or abbrev. Path children are invalidated lazily, as each
+        checks the geos along its path upon display, so path children
+        need not be loaded.
+
+        I/O:
+        path_children=False: if True, also invalidate displays of path
+            children, e.g. when name, abbrev, or path parent change
+        '''
+        self._display_cache = None
+        if path_children:
+            self._display_stamp += 1
+            self._display_fields = None
+
+    def _derive_display_path(self):
+        '''Derive (geo, stamp) tuples along path for validating displays'''
+        path = []
+        geo = self
+        while geo is not None:
+            if geo._display_fields is None:
+                geo._display_fields = tuple(
+                    getattr(geo, field) for field in self.DISPLAY_FIELDS)
+            path.append((geo, geo._display_stamp))
+            geo = geo.path_parent
+        return tuple(path)
+
+    def _is_display_path_current(self, path):
+        '''Return True if geos along path are unchanged since derived'''
+        geo = self
+        for path_geo, stamp in path:
+            if geo is not path_geo:
+                return False
+            path_parent = geo.path_parent  # First reload geo if expired
+            if geo._display_stamp != stamp:
+                return False
+            geo = path_parent
+        return geo is None
+
     def is_known_by(self, match_string, full_name=True, case_sensitive=True,
                     include_abbrev=True, include_aliases=True):
         '''
@@ -1315,8 +1554,36 @@ class Geo(BaseGeoModel):
     def find_component_matches(cls, match_string, match_type=MatchType.BEST,
                                parent=None, elevate_exact_matches=True):
         '''Find component matches given an unqualified geo match string'''
+        search_index, snapshot = cls.search_index, cls.snapshot
+        session = cls.query.session
+        # Indexes derived prior to geos committed elsewhere are rebuilt
+        if search_index is not None:
+            search_index = search_index.current(session)
+        # The search index is kept current as geos change, so is favored
+        if search_index is None and snapshot is not None:
+            snapshot = snapshot.current(session)
+        if search_index is None and snapshot is not None:
+            # The snapshot resolves alias targets of the parent itself
+            human_ids = snapshot.find(match_string, match_type,
+                                      parent.human_id if parent else None)
+            if human_ids is not None:
+                matches = cls._retrieve_matches(
+                    human_ids, match_string, elevate_exact_matches)
+                if matches is not None:
+                    return matches
+                snapshot.mark_stale('snapshot geos missing from database')
+
         alias_targets = parent.alias_targets if parent else None
         parent = alias_targets[0] if alias_targets else parent
+
+        if search_index is not None:
+            human_ids = search_index.find(match_string, match_type, parent)
+            matches = cls._retrieve_matches(
+                human_ids, match_string, elevate_exact_matches)
+            if matches is not None:
+                return matches
+            search_index.mark_stale('indexed geos missing from database')
+
         base_query = parent.path_children if parent else cls.query
 
         if match_type is MatchType.BEST:
@@ -1350,6 +1617,17 @@ class Geo(BaseGeoModel):
             cls.elevate_exact_matches(matches, match_string)
         return matches
 
+    @classmethod
+    def _retrieve_matches(cls, human_ids, match_string,
+                          elevate_exact_matches=True):
+        '''Retrieve ranked matches by human_id; None if any are missing'''
+        matches = cls.tget_many(human_ids)
+        if None in matches:
+            return None
+        if elevate_exact_matches:
+            cls.elevate_exact_matches(matches, match_string)
+        return matches
+
     @staticmethod
     def elevate_exact_matches(matches, match_string):
         '''Elevate exact matches ignoring case given list of matches'''
@@ -1389,6 +1667,126 @@ class Geo(BaseGeoModel):
         largest = reduce(lambda x, y: x if x[1] > y[1] else y, geo_pop_tuples)
         return largest[0]
 
+    def ancestors(self, level=None, max_depth=None):
+        '''
+        Ancestors
+
+        Return query of geos that contain the geo via any chain of
+        parent relationships, nearest first, via the hierarchy closure.
+
+        I/O:
+        level=None: filter ancestors by level, if provided
+        max_depth=None: if provided, limit ancestors to those within
+            the given number of parent/child hops (1 for parents)
+        return: query of ancestor geos ordered by depth
+        '''
+        return self._closure_query(geo_closure_table.c.ancestor_id,
+                                   geo_closure_table.c.descendant_id,
+                                   level, max_depth)
+
+    def descendants(self, level=None, max_depth=None):
+        '''
+        Descendants
+
+        Return query of geos contained by the geo via any chain of
+        child relationships, nearest first, via the hierarchy closure.
+
+        I/O:
+        level=None: filter descendants by level, if provided
+        max_depth=None: if provided, limit descendants to those within
+            the given number of parent/child hops (1 for children)
+        return: query of descendant geos ordered by depth
+        '''
+        return self._closure_query(geo_closure_table.c.descendant_id,
+                                   geo_closure_table.c.ancestor_id,
+                                   level, max_depth)
+
+    def _closure_query(self, related_column, self_column, level, max_depth):
+        '''Query geos related to self via hierarchy closure'''
+        closure = geo_closure_table
+        query = (Geo.query.join(closure, Geo.id == related_column)
+                 .filter(self_column == self.id))
+        if level:
+            query = query.join(Geo.levels).filter(GeoLevel.level == level)
+        if max_depth is not None:
+            query = query.filter(closure.c.depth <= max_depth)
+        return query.order_by(closure.c.depth)
+
+    @classmethod
+    def refresh_closure(cls, session, geo_ids=None):
+        '''
+        Refresh closure
+
+        Recompute hierarchy closure rows for the given geos and all of
+        their descendants, as their ancestors change whenever a geo's
+        parents change. Rows are derived from parent/child associations
+        with recursive queries. Runs automatically on flush for geos
+        whose parents/children change, but must be run explicitly after
+        writing associations directly (e.g. bulk inserts).
+
+        I/O:
+        session: session on which to execute
+        geo_ids=None: ids of geos whose parents changed; if None or
+            more than CLOSURE_REBUILD_THRESHOLD, rebuild the closure
+        '''
+        closure = geo_closure_table
+        if geo_ids is None or len(geo_ids) > cls.CLOSURE_REBUILD_THRESHOLD:
+            session.execute(closure.delete())
+            session.execute(closure.insert().from_select(
+                ('ancestor_id', 'descendant_id', 'depth'),
+                cls._derive_closure()))
+            return
+
+        affected_ids = sorted(cls._derive_descendant_ids(session, geo_ids))
+        batch_size = cls.CLOSURE_BATCH_SIZE
+        for i in range(0, len(affected_ids), batch_size):
+            batch = affected_ids[i:i + batch_size]
+            session.execute(closure.delete().where(
+                closure.c.descendant_id.in_(batch)))
+            session.execute(closure.insert().from_select(
+                ('ancestor_id', 'descendant_id', 'depth'),
+                cls._derive_closure(batch)))
+
+    @classmethod
+    def _derive_closure(cls, descendant_ids=None):
+        '''Select closure rows for descendants (default all geos)'''
+        association = geo_parent_child_association_table
+        base = select([association.c.parent_id.label('ancestor_id'),
+                       association.c.child_id.label('descendant_id'),
+                       literal(1).label('depth')])
+        if descendant_ids is not None:
+            base = base.where(association.c.child_id.in_(descendant_ids))
+        paths = base.cte('geo_closure_paths', recursive=True)
+        paths = paths.union_all(
+            select([association.c.parent_id, paths.c.descendant_id,
+                    paths.c.depth + 1])
+            .where(association.c.child_id == paths.c.ancestor_id)
+            .where(paths.c.depth < cls.CLOSURE_MAX_DEPTH))
+        return (select([paths.c.ancestor_id, paths.c.descendant_id,
+                        func.min(paths.c.depth)])
+                .group_by(paths.c.ancestor_id, paths.c.descendant_id))
+
+    @classmethod
+    def _derive_descendant_ids(cls, session, geo_ids):
+        '''Return set of geo ids and ids of all their descendants'''
+        association = geo_parent_child_association_table
+        geo_ids = set(geo_ids)
+        parent_ids = geo_ids
+        depth = 0
+        while parent_ids and depth < cls.CLOSURE_MAX_DEPTH:
+            child_ids = set()
+            parent_ids = sorted(parent_ids)
+            batch_size = cls.CLOSURE_BATCH_SIZE
+            for i in range(0, len(parent_ids), batch_size):
+                batch = parent_ids[i:i + batch_size]
+                child_ids.update(row[0] for row in session.execute(
+                    select([association.c.child_id])
+                    .where(association.c.parent_id.in_(batch))))
+            parent_ids = child_ids - geo_ids
+            geo_ids |= parent_ids
+            depth += 1
+        return geo_ids
+
     def get_related_geos(self, relation, level=None, include_aliases=False,
                          order_by=None, outer_join_data=False):
         '''
@@ -1404,11 +1802,28 @@ class Geo(BaseGeoModel):
         order_by=None: by default, order by total population, descending
         outer_join_data=False: outer join Data if True or if including
             aliases else inner join; only applicable if data is required
+
+        If a snapshot is installed and current and the session has no
+        pending changes, related geos are selected and ordered via the
+        snapshot (unless ordering otherwise) and only those selected are
+        retrieved. Should any be missing, the snapshot is stale, so it
+        is marked as such and the related geos are queried instead.
         '''
         if relation not in self.RELATIONS:
             raise ValueError('{rel} is not an allowed value for relation'
                              .format(rel=relation))
 
+        snapshot_geo = (self._derive_snapshot_geo() if order_by is None
+                        else None)
+        if snapshot_geo is not None:
+            related_geos = snapshot_geo.get_related_geos(
+                relation, level=level, include_aliases=include_aliases,
+                outer_join_data=outer_join_data)
+            geos = Geo.tget_many([g.human_id for g in related_geos])
+            if None not in geos:
+                return geos
+            self.snapshot.mark_stale('snapshot geos missing from database')
+
         query = getattr(self, relation)
 
         outer_join_data_required = outer_join_data or include_aliases
@@ -1450,13 +1865,17 @@ class Geo(BaseGeoModel):
         are ordered top to bottom for children and bottom to top for
         parents. Within each level, the geos are listed in descending
         order by total population. Any geos that are missing data and/or
-        levels (e.g. aliases) are excluded.
+        levels (e.g. aliases) are excluded. If a snapshot is installed,
+        pages are selected via the snapshot (see get_related_geos).
 
         I/O:
         relation: 'parents', 'children', 'path_children', etc.
         json_kwargs: JSON keyword arguments per Jsonable.jsonify()
         '''
         limit = json_kwargs['limit']
+        # Related geos are ordered by population, so cursors are unused
+        offset, _ = self.derive_page_start(
+            json_kwargs.get('offset', 0), None, json_kwargs.get('_path'))
 
         if relation not in self.RELATIONS:
             raise ValueError('{rel} is not an allowed value for relation'
@@ -1473,35 +1892,188 @@ class Geo(BaseGeoModel):
                                 for g in base_q.all()]
 
         else:
-            levels = (lvl for lvl in (
-                GeoLevel.UP if relation == self.PARENTS else GeoLevel.DOWN))
-
-            if limit < 0:
-                rv = OrderedDict(
-                    (lvl, [self.jsonify_geo(g, **json_kwargs)
-                           for g in base_q.filter(GeoLevel.level == lvl)
-                           .order_by(desc(GeoData.total_pop)).all()])
-                    for lvl in levels)
-            else:
-                rv = OrderedDict(
-                    (lvl, [self.jsonify_geo(g, **json_kwargs)
-                           for g in base_q.filter(GeoLevel.level == lvl)
-                           .order_by(desc(GeoData.total_pop))
-                           .limit(limit).all()])
-                    for lvl in levels)
-
-            for lvl, geos in list(rv.items()):
-                if len(geos) == 0:
-                    rv.pop(lvl)
-
-                if len(geos) == limit:
-                    total = base_q.filter(GeoLevel.level == lvl).count()
-                    if total > limit:
-                        rv[lvl].append(
-                            self.paginate(len(rv[lvl]), limit, total))
+            levels = (GeoLevel.UP if relation == self.PARENTS
+                      else GeoLevel.DOWN)
+            snapshot_geo = self._derive_snapshot_geo()
+            related_geos = None
+            if snapshot_geo is not None:
+                related_geos = self._retrieve_snapshot_geos_by_level(
+                    snapshot_geo.related_geos_by_level(
+                        relation, levels, limit, offset))
+            if related_geos is None:
+                related_geos = self.related_geos_by_level(
+                    base_q, levels, limit, offset)
+
+            rv = OrderedDict()
+            for lvl, (geos, total) in related_geos.items():
+                rv[lvl] = [self.jsonify_geo(g, **json_kwargs) for g in geos]
+                has_more = offset + len(geos) < total
+                if has_more or offset:
+                    # Totals are free, as they come from the same query
+                    rv[lvl].append(self.paginate(
+                        offset, limit, len(geos), has_more, total))
+
+        return rv
+
+    def _derive_snapshot_geo(self):
+        '''Return snapshot geo if installed and current, else None'''
+        snapshot = self.snapshot
+        if snapshot is None:
+            return None
+        # Pending changes (e.g. new related geos) are not in the snapshot
+        state = inspect(self)
+        if not state.persistent:
+            return None
+        session = state.session
+        if session.new or session.dirty or session.deleted:
+            return None
+        # Nor are changes committed since it was exported, unless it has
+        # been exported again since
+        snapshot = snapshot.current(session)
+        if snapshot is None:
+            return None
+        return snapshot.get(self.human_id)
+
+    @classmethod
+    def _retrieve_snapshot_geos_by_level(cls, snapshot_geos_by_level):
+        '''
+        Retrieve geos from snapshot (geos, total) tuples by level
+
+        Returns None if any geos are missing (e.g. renamed), in which
+        case the snapshot is stale and marked as such.
+        '''
+        human_ids = [g.human_id for snapshot_geos, _ in
+                     snapshot_geos_by_level.values() for g in snapshot_geos]
+        geos = dict(zip(human_ids, cls.tget_many(human_ids)))
+        if None in geos.values():
+            cls.snapshot.mark_stale('snapshot geos missing from database')
+            return None
+        rv = OrderedDict()
+        for lvl, (snapshot_geos, total) in snapshot_geos_by_level.items():
+            level_geos = [geos[g.human_id] for g in snapshot_geos]
+            if level_geos:
+                rv[lvl] = (level_geos, total)
+        return rv
+
+    @classmethod
+    def related_geos_by_level(cls, query, levels, limit=-1, offset=0):
+        '''
+        Related geos by level
+
+        Given a query of related geos joined with their data and levels,
+        returns an ordered dictionary keyed by level of (geos, total)
+        tuples, in which geos are listed in descending order by total
+        population, skipping offset geos and capped by limit, and total
+        is the number of geos in the level. Levels without geos in the
+        page are excluded.
+
+        A single query ranks geos within each level and counts them via
+        window functions. Backends without window function support fall
+        back to a query per level plus a count for each full level.
+
+        I/O:
+        query: geo query joined with Geo.data and Geo.levels
+        levels: iterable of levels in the order they are to be returned
+        limit=-1: maximum number of geos per level; no cap if negative
+        offset=0: number of geos to skip in each level
+        return: ordered dict of (geos, total) tuples keyed by level
+        '''
+        levels = tuple(levels)
+        if cls.supports_window_functions(query.session):
+            return cls._rank_related_geos_by_level(
+                query, levels, limit, offset)
+
+        rv = OrderedDict()
+        for lvl in levels:
+            level_q = query.filter(GeoLevel.level == lvl)
+            geos_q = level_q.order_by(desc(GeoData.total_pop))
+            if offset > 0:
+                geos_q = geos_q.offset(offset)
+            geos = geos_q.all() if limit < 0 else geos_q.limit(limit).all()
+            if not geos:
+                continue
+            total = (level_q.count() if len(geos) == limit
+                     else offset + len(geos))
+            rv[lvl] = (geos, total)
 
         return rv
 
+    @classmethod
+    def supports_window_functions(cls, session):
+        '''
+        Supports window functions
+
+        Return WINDOW_FUNCTIONS_SUPPORTED unless None, in which case
+        support is decided once per backend, from the dialect and its
+        server version. Backends without a known minimum version (see
+        WINDOW_FUNCTION_VERSIONS) are probed within a savepoint, so a
+        failed probe does not abort the session's transaction.
+
+        I/O:
+        session: session whose bind is checked
+        return: True if window functions are supported, else False
+        '''
+        if cls.WINDOW_FUNCTIONS_SUPPORTED is not None:
+            return cls.WINDOW_FUNCTIONS_SUPPORTED
+
+        dialect = session.get_bind().dialect
+        if dialect.name == 'sqlite':
+            version = dialect.dbapi.sqlite_version_info
+        else:
+            version = dialect.server_version_info
+        support_key = (dialect.name, version)
+        try:
+            return cls._window_function_support[support_key]
+        except KeyError:
+            pass
+
+        min_version = cls.WINDOW_FUNCTION_VERSIONS.get(dialect.name)
+        if min_version is not None and version is not None:
+            supported = tuple(version[:len(min_version)]) >= min_version
+            if dialect.name == 'mysql' and 'MariaDB' in str(version):
+                supported = version >= (10, 2)
+        else:
+            try:
+                with session.begin_nested():
+                    session.execute(select([func.row_number().over()]))
+                supported = True
+            except DBAPIError:
+                supported = False
+
+        cls._window_function_support[support_key] = supported
+        return supported
+
+    @classmethod
+    def _rank_related_geos_by_level(cls, query, levels, limit, offset=0):
+        '''Rank related geos by level via window functions'''
+        ranked = (query.filter(GeoLevel.level.in_(levels))
+                  .with_entities(
+                      Geo.id.label('geo_id'),
+                      GeoLevel.level.label('level'),
+                      func.row_number().over(
+                          partition_by=GeoLevel.level,
+                          order_by=desc(GeoData.total_pop)).label('rank'),
+                      func.count().over(
+                          partition_by=GeoLevel.level).label('total'))
+                  .subquery())
+
+        ranked_q = (query.session.query(Geo, ranked.c.level, ranked.c.total)
+                    .join(ranked, Geo.id == ranked.c.geo_id))
+        if offset > 0:
+            ranked_q = ranked_q.filter(ranked.c.rank > offset)
+        if limit >= 0:
+            ranked_q = ranked_q.filter(ranked.c.rank <= offset + limit)
+        ranked_q = ranked_q.order_by(ranked.c.level, ranked.c.rank)
+
+        geos_by_level = {}
+        totals = {}
+        for geo, lvl, total in ranked_q:
+            geos_by_level.setdefault(lvl, []).append(geo)
+            totals[lvl] = total
+
+        return OrderedDict((lvl, (geos_by_level[lvl], totals[lvl]))
+                           for lvl in levels if lvl in geos_by_level)
+
     def jsonify_geo(self, geo, depth, **json_kwargs):
         '''Jsonify geo'''
         _json = json_kwargs['_json']
@@ -1516,3 +2088,140 @@ class Geo(BaseGeoModel):
 define_constants_at_module_scope(__name__, GeoID, GeoID.STANDARDS)
 define_constants_at_module_scope(__name__, GeoLevel, GeoLevel.DOWN)
 define_constants_at_module_scope(__name__, Geo, Geo.RELATIONS)
+
+
+def read_geo_revision(session):
+    '''Read revision of the geo tables; 0 if never bumped'''
+    table = geo_revision_table
+    revision = session.execute(
+        select([table.c.revision]).where(table.c.id == 1)).scalar()
+    return revision or 0
+
+
+def bump_geo_revision(session, bulk=False):
+    '''
+    Bump geo revision
+
+    Increment the revision of the geo tables within the session's
+    transaction, at most once per transaction, and return the new
+    revision. Writes via the ORM bump it on flush. Writes bypassing the
+    ORM must bump it explicitly, with bulk=True, as structures derived
+    from the tables cannot otherwise track them.
+
+    I/O:
+    session: session whose transaction writes the geo tables
+    bulk=False: if True, the transaction writes bypassing the ORM
+    return: revision as of the transaction
+    '''
+    info = session.info
+    if bulk:
+        info['geo_revision_bulk'] = True
+    revision = info.get('geo_revision')
+    if revision is None:
+        table = geo_revision_table
+        result = session.execute(table.update().where(table.c.id == 1)
+                                 .values(revision=table.c.revision + 1))
+        if not result.rowcount:
+            session.execute(table.insert().values(id=1, revision=1))
+        revision = info['geo_revision'] = read_geo_revision(session)
+    return revision
+
+
+@event.listens_for(Geo, 'refresh')
+def invalidate_refreshed_geo_displays(geo, context, attrs):
+    '''Invalidate cached displays of geos reloaded (e.g. upon commit)
+    with displayed fields changed elsewhere, and of their path children'''
+    fields = geo._display_fields
+    if fields is None:
+        return
+    values = inspect(geo).dict
+    refreshed_fields = tuple(values.get(field)
+                             for field in Geo.DISPLAY_FIELDS)
+    num_path_fields = Geo.PATH_DISPLAY_FIELDS
+    if fields[:num_path_fields] != refreshed_fields[:num_path_fields]:
+        geo.invalidate_display(path_children=True)
+    elif fields != refreshed_fields:
+        geo.invalidate_display()
+        geo._display_fields = refreshed_fields
+
+
+@event.listens_for(orm.Session, 'before_flush')
+def track_geo_hierarchy_changes(session, flush_context, instances):
+    '''Track geos whose ancestors change in flush to refresh closure'''
+    changed_geos = session.info.setdefault('geo_closure_changes', set())
+    passive = attributes.PASSIVE_NO_INITIALIZE
+    for geo in session.new | session.dirty:
+        if not isinstance(geo, Geo):
+            continue
+        if attributes.get_history(geo, Geo.PARENTS, passive).has_changes():
+            changed_geos.add(geo)
+        children_history = attributes.get_history(geo, Geo.CHILDREN, passive)
+        changed_geos.update(children_history.added)
+        changed_geos.update(children_history.deleted)
+
+    deleted_ids = {geo.id for geo in session.deleted
+                   if isinstance(geo, Geo) and geo.id is not None}
+    if deleted_ids:
+        # Capture descendants now, as closure rows cascade on delete
+        closure = geo_closure_table
+        session.info.setdefault('geo_closure_deletions', set()).update(
+            deleted_ids)
+        session.info.setdefault('geo_closure_orphans', set()).update(
+            row[0] for row in session.execute(
+                select([closure.c.descendant_id])
+                .where(closure.c.ancestor_id.in_(deleted_ids))))
+
+
+@event.listens_for(orm.Session, 'after_flush')
+def bump_geo_revision_on_flush(session, flush_context):
+    '''Bump geo revision if geos or their data, levels, or IDs changed'''
+    if 'geo_revision' in session.info:
+        return
+    for instances in (session.new, session.dirty, session.deleted):
+        if any(isinstance(instance, (Geo, GeoData, GeoLevel, GeoID))
+               for instance in instances):
+            bump_geo_revision(session)
+            return
+
+
+@event.listens_for(orm.Session, 'after_transaction_end')
+def reset_geo_revision(session, transaction):
+    '''Reset geo revision bump once the outermost transaction ends'''
+    if transaction.parent is None:
+        session.info.pop('geo_revision', None)
+        session.info.pop('geo_revision_bulk', None)
+
+
+@event.listens_for(orm.Session, 'after_rollback')
+def reset_rolled_back_geo_revision(session):
+    '''Reset geo revision bump if rolled back, e.g. to a savepoint'''
+    session.info.pop('geo_revision', None)
+
+
+@event.listens_for(orm.Session, 'after_flush')
+def refresh_geo_closure(session, flush_context):
+    '''Refresh closure for geos whose ancestors changed in flush'''
+    changed_geos = session.info.pop('geo_closure_changes', ())
+    deleted_ids = session.info.pop('geo_closure_deletions', set())
+    geo_ids = session.info.pop('geo_closure_orphans', set())
+    geo_ids.update(geo.id for geo in changed_geos if geo.id is not None)
+    geo_ids -= deleted_ids
+
+    if deleted_ids:
+        closure = geo_closure_table
+        session.execute(closure.delete().where(or_(
+            closure.c.ancestor_id.in_(deleted_ids),
+            closure.c.descendant_id.in_(deleted_ids))))
+    if geo_ids:
+        Geo.refresh_closure(session, geo_ids)
+
+
+@event.listens_for(geo_closure_table, 'after_create')
+def backfill_geo_closure(target, connection, **kwds):
+    '''Backfill closure from existing parent/child associations, as
+    flushes maintain only the rows of geos changed since'''
+    association = geo_parent_child_association_table
+    if not connection.dialect.has_table(connection, association.name):
+        return
+    connection.execute(target.insert().from_select(
+        ('ancestor_id', 'descendant_id', 'depth'), Geo._derive_closure()))
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import logging
+import threading
+import time
+
+from .models import read_geo_revision
+
+log = logging.getLogger('intertwine.geos.revision')
+
+
+class GeoRevisionChecked(object):
+    '''
+    Geo revision checked
+
+    Mixin for in-process structures derived from the geo tables, such
+    as snapshots and search indexes, which record the geo revision from
+    which they were derived (see bump_geo_revision). The revision is
+    compared with that in the database at most once per
+    REVISION_CHECK_SECONDS, so changes committed by other processes are
+    detected. Once stale, a structure is bypassed and reads served via
+    current are attempted from a replacement (see reload), which is
+    then installed in its place.
+
+    Subclasses implement install and reload.
+    '''
+    REVISION_CHECK_SECONDS = 10
+
+    revision = None
+    _stale = False
+    _checked_at = None
+    _reloaded_at = None
+    _reload_lock = threading.Lock()
+
+    @classmethod
+    def install(cls, instance):
+        '''Install instance on Geo; uninstall if None'''
+        raise NotImplementedError
+
+    def reload(self, session):
+        '''Return replacement current with the database, or None'''
+        raise NotImplementedError
+
+    @property
+    def stale(self):
+        return self._stale
+
+    def is_current(self, session):
+        '''
+        Is current
+
+        Return True unless stale, first checking the geo revision in the
+        database if not checked within REVISION_CHECK_SECONDS.
+
+        I/O:
+        session: session used to read the geo revision
+        return: True if not stale, else False
+        '''
+        if self._stale:
+            return False
+        now = time.time()
+        checked_at = self._checked_at
+        if checked_at is None or now - checked_at >= (
+                self.REVISION_CHECK_SECONDS):
+            self._checked_at = now
+            revision = read_geo_revision(session)
+            if revision != self.revision:
+                self.mark_stale('derived from geo revision {derived} but '
+                                'the database is at {current}'.format(
+                                    derived=self.revision, current=revision))
+        return not self._stale
+
+    def current(self, session):
+        '''
+        Current
+
+        Return self if current. Otherwise, return a replacement, reloaded
+        for the current geo revision and installed in place of self, or
+        None if no replacement is current (or another thread is
+        reloading), in which case reads revert to queries. Reloads are
+        attempted at most once per REVISION_CHECK_SECONDS.
+
+        I/O:
+        session: session used to read the geo revision and reload
+        return: current instance, or None
+        '''
+        if self.is_current(session):
+            return self
+        now = time.time()
+        reloaded_at = self._reloaded_at
+        if reloaded_at is not None and now - reloaded_at < (
+                self.REVISION_CHECK_SECONDS):
+            return None
+        if not self._reload_lock.acquire(False):
+            return None
+        try:
+            self._reloaded_at = now
+            replacement = self.reload(session)
+            if replacement is None:
+                return None
+            replacement._checked_at = now
+            self.install(replacement)
+            log.info('Replaced stale %r with %r', self, replacement)
+            return replacement
+        finally:
+            self._reload_lock.release()
+
+    def mark_stale(self, reason):
+        '''Mark as stale, so it is bypassed, logging the reason once'''
+        if not self._stale:
+            self._stale = True
+            log.warning('%r is stale and will be bypassed: %s', self, reason)
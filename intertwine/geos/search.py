@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import io
+import json
+import threading
+from collections import namedtuple
+
+from sqlalchemy import event, orm, select
+
+from intertwine.utils.enums import MatchType
+
+from .models import (Geo, GeoData, geo_alias_association_table,
+                     read_geo_revision)
+from .revision import GeoRevisionChecked
+
+
+class GeoSearchIndex(GeoRevisionChecked):
+    '''
+    Geo search index
+
+    In-process index for matching geos by name and abbreviation. It is
+    an optional alternative to the LIKE queries run by
+    Geo.find_component_matches, as patterns that match word starts or
+    substrings cannot use database indexes. When installed on Geo (see
+    install), matching uses the index and only the matched geos are
+    retrieved, via the Trackable registry when possible.
+
+    The same MatchType semantics apply, ignoring case as LIKE does by
+    default. Matches are ranked by descending total population, with
+    aliases ranked by their most populous alias target, and geos
+    without data last.
+
+    Terms are indexed as follows:
+    - Word starts (the name, each word within it, and the abbreviation)
+      by prefixes up to PREFIX_LENGTH characters, for BEST, EXACT, and
+      STARTS_WITH matches
+    - Trigrams of the name and abbreviation for CONTAINS and ENDS_WITH
+      matches of at least 3 characters; shorter strings are scanned
+    - Path children by path parent, for matches scoped to a parent
+
+    Once installed, the index is updated as geos are created, renamed,
+    or deleted, when sessions commit. The index records the geo revision
+    from which it was derived, advancing it as commits are applied. Geos
+    committed otherwise (by other processes or via bulk writes) render
+    the index stale (see GeoRevisionChecked), after which it is rebuilt
+    from the database upon the next match (see reload). While another
+    thread is rebuilding it, matching reverts to queries.
+
+    I/O:
+    entries=(): iterable of Entry namedtuples with which to populate
+    revision=None: geo revision from which the entries were derived
+    '''
+    PREFIX_LENGTH = 3
+    TRIGRAM_LENGTH = 3
+    SNAPSHOT_VERSION = 2
+
+    Entry = namedtuple('GeoSearchEntry', 'id, human_id, name, abbrev, '
+                                         'path_parent_id, total_pop, '
+                                         'alias_target_ids')
+
+    def __init__(self, entries=(), revision=None):
+        self.revision = revision
+        self._entries = {}
+        self._prefixes = {}
+        self._trigrams = {}
+        self._children = {}
+        self._lock = threading.RLock()
+        for entry in entries:
+            self.add(entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '<{cls}: {size} geos at revision {revision}>'.format(
+            cls=self.__class__.__name__, size=len(self._entries),
+            revision=self.revision)
+
+    def __contains__(self, geo_id):
+        return geo_id in self._entries
+
+    @classmethod
+    def install(cls, index):
+        '''Install index on Geo for matching; uninstall if None'''
+        Geo.search_index = index
+
+    def reload(self, session):
+        '''Rebuild index from the database, as it is stale'''
+        return self.build(session)
+
+    @classmethod
+    def build(cls, session=None):
+        '''
+        Build index
+
+        Build an index of all geos from the database, reading only the
+        columns needed rather than instantiating models.
+
+        I/O:
+        session=None: session to query; defaults to that of Geo.query
+        return: new GeoSearchIndex
+        '''
+        session = session or Geo.query.session
+        # Read first, so any geos committed during the build render it stale
+        revision = read_geo_revision(session)
+        alias_target_ids = {}
+        association = geo_alias_association_table
+        for alias_id, alias_target_id in session.execute(
+                select([association.c.alias_id,
+                        association.c.alias_target_id])):
+            alias_target_ids.setdefault(alias_id, []).append(alias_target_id)
+
+        rows = (session.query(Geo.id, Geo.human_id, Geo.name, Geo.abbrev,
+                              Geo.path_parent_id, GeoData.total_pop)
+                       .outerjoin(Geo.data))
+        return cls((cls.Entry(*row, alias_target_ids=tuple(
+            sorted(alias_target_ids.get(row[0], ())))) for row in rows),
+            revision=revision)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Load index from a snapshot saved at the given path
+
+        The snapshot may predate geos committed since; check is_current
+        before installing.
+        '''
+        with io.open(path, encoding='utf-8') as snapshot:
+            payload = json.load(snapshot)
+        if payload.get('version') != cls.SNAPSHOT_VERSION:
+            raise ValueError('Unsupported geo search index snapshot version: '
+                             '{}'.format(payload.get('version')))
+        return cls((cls.Entry(*(values[:-1] + [tuple(values[-1])]))
+                    for values in payload['entries']),
+                   revision=payload['revision'])
+
+    def save(self, path):
+        '''Save index snapshot to the given path'''
+        with self._lock:
+            entries = sorted(self._entries.values())
+            revision = self.revision
+        payload = {'version': self.SNAPSHOT_VERSION, 'revision': revision,
+                   'entries': entries}
+        with io.open(path, 'w', encoding='utf-8') as snapshot:
+            snapshot.write(json.dumps(payload, ensure_ascii=False))
+
+    @classmethod
+    def derive_entry(cls, geo):
+        '''Derive index entry from a geo'''
+        data = geo.data
+        return cls.Entry(
+            id=geo.id, human_id=geo.human_id, name=geo.name,
+            abbrev=geo.abbrev, path_parent_id=geo.path_parent_id,
+            total_pop=data.total_pop if data else None,
+            alias_target_ids=tuple(sorted(
+                target.id for target in geo._alias_targets)))
+
+    def add(self, entry):
+        '''Add entry to index, replacing any with the same geo id'''
+        with self._lock:
+            self.remove(entry.id)
+            self._entries[entry.id] = entry
+            for term in self._derive_prefixes(entry):
+                self._prefixes.setdefault(term, set()).add(entry.id)
+            for term in self._derive_trigrams(entry):
+                self._trigrams.setdefault(term, set()).add(entry.id)
+            self._children.setdefault(entry.path_parent_id, set()).add(
+                entry.id)
+
+    def remove(self, geo_id):
+        '''Remove entry for geo id from index, if any'''
+        with self._lock:
+            entry = self._entries.pop(geo_id, None)
+            if entry is None:
+                return
+            for index, terms in (
+                    (self._prefixes, self._derive_prefixes(entry)),
+                    (self._trigrams, self._derive_trigrams(entry)),
+                    (self._children, (entry.path_parent_id,))):
+                for term in terms:
+                    ids = index.get(term)
+                    ids.discard(geo_id)
+                    if not ids:
+                        del index[term]
+
+    def find(self, match_string, match_type=MatchType.BEST, parent=None):
+        '''
+        Find
+
+        Return human ids of geos matching the string per match type,
+        ranked by total population (see GeoSearchIndex).
+
+        I/O:
+        match_string: unqualified geo match string
+        match_type=MatchType.BEST: MatchType enum value
+        parent=None: if provided, only match path children of parent
+        return: list of matching geo human ids, ranked
+        '''
+        string = match_string.lower()
+        is_match = self.derive_matcher(string, match_type, parent)
+
+        with self._lock:
+            candidates = self._find_candidates(string, match_type, parent)
+            entries = self._entries
+            matches = [entries[geo_id] for geo_id in candidates
+                       if is_match(entries[geo_id])]
+            matches.sort(key=self._rank)
+
+        return [entry.human_id for entry in matches]
+
+    @staticmethod
+    def derive_matcher(string, match_type, parent=None):
+        '''
+        Derive matcher
+
+        Return predicate that determines if an entry, or any object with
+        name and abbrev attributes, matches the lowercased string.
+        '''
+        space_string = ' ' + string
+
+        def terms(entry):
+            name = entry.name.lower()
+            return (name, entry.abbrev.lower()) if entry.abbrev else (name,)
+
+        def best_abbrev(entry):
+            return bool(entry.abbrev) and (
+                entry.abbrev.lower().startswith(string))
+
+        def best(entry):
+            entry_terms = terms(entry)
+            if space_string in entry_terms[0]:
+                return True
+            return any(term.startswith(string) for term in entry_terms)
+
+        def exact(entry):
+            return string in terms(entry)
+
+        def contains(entry):
+            return any(string in term for term in terms(entry))
+
+        def starts_with(entry):
+            return any(term.startswith(string) for term in terms(entry))
+
+        def ends_with(entry):
+            return any(term.endswith(string) for term in terms(entry))
+
+        if match_type is MatchType.BEST:
+            return (best_abbrev if len(string) < 3 and parent is None
+                    else best)
+        matchers = {MatchType.EXACT: exact,
+                    MatchType.CONTAINS: contains,
+                    MatchType.STARTS_WITH: starts_with,
+                    MatchType.ENDS_WITH: ends_with}
+        try:
+            return matchers[match_type]
+        except KeyError:
+            raise ValueError('Unsupported match type: {!r}'.format(match_type))
+
+    def _find_candidates(self, string, match_type, parent):
+        '''Return ids of geos that may match, a superset of matches'''
+        if parent is not None:
+            return tuple(self._children.get(parent.id, ()))
+        if not string:
+            return tuple(self._entries)
+
+        if match_type in {MatchType.CONTAINS, MatchType.ENDS_WITH}:
+            trigrams = self._derive_terms_trigrams(string)
+            if not trigrams:
+                return tuple(self._entries)
+            postings = sorted((self._trigrams.get(t, set()) for t in trigrams),
+                              key=len)
+            return tuple(postings[0].intersection(*postings[1:]))
+
+        return tuple(self._prefixes.get(string[:self.PREFIX_LENGTH], ()))
+
+    def _rank(self, entry):
+        '''Rank by total pop (aliases by targets) with missing data last'''
+        total_pop = entry.total_pop
+        if total_pop is None:
+            entries = self._entries
+            targets = (entries.get(target_id)
+                       for target_id in entry.alias_target_ids)
+            target_pops = [target.total_pop for target in targets
+                           if target and target.total_pop is not None]
+            total_pop = max(target_pops) if target_pops else None
+        return (total_pop is None, -(total_pop or 0),
+                bool(entry.alias_target_ids), entry.name.lower(), entry.id)
+
+    @classmethod
+    def _derive_prefixes(cls, entry):
+        '''Derive prefixes of word starts in entry name and abbrev'''
+        name = entry.name.lower()
+        # As with LIKE '% x%', a word starts after each space
+        word_starts = {name}
+        word_starts.update(name[i + 1:] for i, c in enumerate(name)
+                           if c == ' ' and name[i + 1:])
+        if entry.abbrev:
+            word_starts.add(entry.abbrev.lower())
+        return {word_start[:length]
+                for word_start in word_starts
+                for length in range(1, cls.PREFIX_LENGTH + 1)}
+
+    @classmethod
+    def _derive_trigrams(cls, entry):
+        '''Derive trigrams of entry name and abbrev'''
+        trigrams = cls._derive_terms_trigrams(entry.name.lower())
+        if entry.abbrev:
+            trigrams |= cls._derive_terms_trigrams(entry.abbrev.lower())
+        return trigrams
+
+    @classmethod
+    def _derive_terms_trigrams(cls, term):
+        n = cls.TRIGRAM_LENGTH
+        return {term[i:i + n] for i in range(len(term) - n + 1)}
+
+
+@event.listens_for(orm.Session, 'after_flush')
+def track_geo_search_changes(session, flush_context):
+    '''Capture changes to geos in flush for the installed search index'''
+    if Geo.search_index is None:
+        return
+    updates = session.info.setdefault('geo_search_updates', [])
+    geos = set()
+    for instance in session.new | session.dirty:
+        if isinstance(instance, Geo):
+            geos.add(instance)
+        elif isinstance(instance, GeoData) and instance.geo is not None:
+            geos.add(instance.geo)
+    for geo in geos:
+        if geo not in session.deleted:
+            updates.append((True, GeoSearchIndex.derive_entry(geo)))
+    for instance in session.deleted:
+        if isinstance(instance, Geo):
+            updates.append((False, instance.id))
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def apply_geo_search_changes(session):
+    '''
+    Apply committed geo changes to the installed search index
+
+    Changes are applied only if the commit advanced the geo revision
+    from that of the index. Otherwise geos were committed elsewhere in
+    the meantime, or bulk written, so the index is marked stale.
+    '''
+    updates = session.info.pop('geo_search_updates', ())
+    index = Geo.search_index
+    revision = session.info.get('geo_revision')
+    if index is None or revision is None or index.stale:
+        return
+    with index._lock:
+        if (session.info.get('geo_revision_bulk') or
+                index.revision is None or revision != index.revision + 1):
+            index.mark_stale('geo revision {revision} committed, but the '
+                             'index is at {derived}'.format(
+                                 revision=revision, derived=index.revision))
+            return
+        for is_update, value in updates:
+            if is_update:
+                index.add(value)
+            else:
+                index.remove(value)
+        index.revision = revision
+
+
+@event.listens_for(orm.Session, 'after_rollback')
+def discard_geo_search_changes(session):
+    '''Discard uncommitted geo changes captured for the search index'''
+    session.info.pop('geo_search_updates', None)
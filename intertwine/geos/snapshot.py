@@ -0,0 +1,772 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import io
+import mmap
+import os
+import struct
+import sys
+import zlib
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import event, orm, select
+
+from intertwine.utils.enums import MatchType
+
+from .models import (Geo, GeoData, GeoID, GeoLevel,
+                     geo_alias_association_table,
+                     geo_parent_child_association_table, read_geo_revision)
+from .revision import GeoRevisionChecked
+from .search import GeoSearchIndex
+
+
+class GeoSnapshot(GeoRevisionChecked):
+    '''
+    Geo snapshot
+
+    Read-only columnar snapshot of the geo graph: geos, their data,
+    levels, and IDs, plus parent/child, path, and alias relations. It is
+    written by export and memory mapped by load, so processes can look
+    up geos by human_id, traverse related geos, and order them by
+    population without registering geos via Trackable or querying the
+    database. Processes mapping the same file (e.g. web workers under
+    circus) share its pages, so memory does not grow with workers.
+
+    Snapshot geos (SnapshotGeo) are lightweight views of rows rather
+    than model instances; writes must still go through the ORM, after
+    which the snapshot must be exported again. Once installed on Geo
+    (see install), the read-only paths of Geo.get_related_geos,
+    Geo.find_component_matches, and Geo.jsonify_related_geos use the
+    snapshot to select and order geos, retrieving only those selected.
+
+    The snapshot records the geo revision as of export. Once geos are
+    committed, by this process or another (see GeoRevisionChecked), the
+    snapshot is stale and these reads revert to queries until it is
+    exported again, e.g. via data/geos/geo_snapshot.py, which the geo
+    load scripts run when GEO_SNAPSHOT is set. Each process then maps
+    the new export in place of the stale one within
+    REVISION_CHECK_SECONDS (see reload).
+
+    File layout (little-endian):
+    - Header: MAGIC, VERSION, and number of sections
+    - Section table: name, typecode, byte offset, and number of items
+    - Sections of fixed-width integers, each 8-byte aligned:
+      - Geo revision as of export
+      - Geo columns, one row per geo in human_id order: id, human_id,
+        name, and abbrev (string table indices or -1 if null),
+        path_parent (row or -1), and rank by descending population
+      - Geo data columns: total_pop, urban_pop, and the stored integer
+        latitude, longitude, land_area, and water_area (NULL if null)
+      - Human_id hash index: open addressing table of rows (or -1),
+        with a power of 2 slots, probed linearly from the CRC-32 of
+        the UTF-8 encoded human_id
+      - Levels (level, designation) by geo and IDs (standard, code) by
+        level, in compressed sparse row (CSR) form: an offsets array
+        with one more item than rows, indexing into the columns
+      - Relations in CSR form: offsets by geo into arrays of related
+        geo rows, ordered by descending total population
+      - Related geos with data by level, in nested CSR form: offsets
+        by geo into levels, and offsets by level into geo rows, again
+        ordered by descending total population
+      - Match terms: rows and byte offsets of word starts in names and
+        rows of abbreviations, sorted by lowercased term
+      - String table: offsets into a UTF-8 blob
+
+    I/O:
+    buffer: buffer containing a snapshot, e.g. an mmap (see load)
+    '''
+    MAGIC = b'ITGEOSNP'
+    VERSION = 3
+    NULL = -2 ** 63
+
+    HEADER = struct.Struct(str('<8sII'))
+    SECTION = struct.Struct(str('<48s1s7xQQ'))
+    SECTION_NAME_LENGTH = 48
+    ALIGNMENT = 8
+
+    path = None
+
+    DATA_COLUMNS = GeoData.Record._fields
+    RELATIONS = (Geo.PARENTS, Geo.CHILDREN, Geo.PATH_CHILDREN, Geo.ALIASES,
+                 Geo.ALIAS_TARGETS)
+
+    Level = namedtuple('SnapshotGeoLevel', 'level, designation, ids')
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        magic, version, num_sections = self.HEADER.unpack_from(buffer, 0)
+        if magic != self.MAGIC:
+            raise ValueError('Not a geo snapshot')
+        if version != self.VERSION:
+            raise ValueError('Unsupported geo snapshot version: {}'
+                             .format(version))
+        self._sections = {}
+        offsets = {}
+        for i in range(num_sections):
+            name, typecode, offset, count = self.SECTION.unpack_from(
+                buffer, self.HEADER.size + i * self.SECTION.size)
+            name = name.rstrip(b'\0').decode('ascii')
+            offsets[name] = offset
+            self._sections[name] = _map_array(
+                buffer, offset, count, typecode.decode('ascii'))
+
+        self._strings = self._sections['strings.offsets']
+        self._blob_offset = offsets['strings.blob']
+        self._human_ids = self._sections['geo.human_id']
+        self._slots = self._sections['index.slots']
+        self._size = len(self._human_ids)
+        self.revision = self._sections['meta.revision'][0]
+
+    @classmethod
+    def install(cls, snapshot):
+        '''Install snapshot on Geo; uninstall if None'''
+        Geo.snapshot = snapshot
+
+    @classmethod
+    def load(cls, path):
+        '''Memory map snapshot saved at the given path, read-only'''
+        with io.open(path, 'rb') as snapshot_file:
+            buffer = mmap.mmap(snapshot_file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+        snapshot = cls(buffer)
+        snapshot.path = path
+        return snapshot
+
+    def reload(self, session):
+        '''
+        Reload
+
+        Map the snapshot at the path from which this one was loaded if
+        it has since been exported again as of the current geo revision.
+        Only the section table is read, so this is cheap when it has
+        not. This snapshot is left mapped, as other threads may still be
+        reading it, and is unmapped once no longer referenced.
+
+        I/O:
+        session: session used to read the geo revision
+        return: reloaded GeoSnapshot, or None if not exported since or
+            if stale
+        '''
+        if self.path is None:
+            return None
+        try:
+            snapshot = self.load(self.path)
+        except (IOError, OSError, ValueError):
+            return None
+        if snapshot.revision != read_geo_revision(session):
+            snapshot.close()
+            return None
+        return snapshot
+
+    def close(self):
+        '''Unmap the snapshot; snapshot geos may no longer be used'''
+        sections, self._sections = self._sections, {}
+        for section in sections.values():
+            release = getattr(section, 'release', None)
+            if release is not None:
+                release()
+        self._strings = self._human_ids = self._slots = None
+        close = getattr(self._buffer, 'close', None)
+        if close is not None:
+            close()
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, human_id):
+        return self._find_row(human_id) is not None
+
+    def __getitem__(self, human_id):
+        row = self._find_row(human_id)
+        if row is None:
+            raise KeyError(human_id)
+        return SnapshotGeo(self, row)
+
+    def get(self, human_id, default=None):
+        row = self._find_row(human_id)
+        return SnapshotGeo(self, row) if row is not None else default
+
+    def __iter__(self):
+        for row in range(self._size):
+            yield SnapshotGeo(self, row)
+
+    def find(self, match_string, match_type=MatchType.BEST, parent=None):
+        '''
+        Find
+
+        Return human ids of geos matching the string per match type,
+        ranked by total population with missing data last. MatchType
+        semantics are those of GeoSearchIndex, ignoring case as LIKE
+        does by default. Matches scoped to a parent are found among its
+        path children (or those of its first alias target); others are
+        found via the match terms. Unscoped CONTAINS and ENDS_WITH
+        matches cannot use the match terms and are not served.
+
+        I/O:
+        match_string: unqualified geo match string
+        match_type=MatchType.BEST: MatchType enum value
+        parent=None: if provided, human_id of the geo whose path
+            children are to be matched
+        return: list of matching geo human ids, ranked, or None if the
+            match is not served by the snapshot
+        '''
+        string = match_string.lower()
+        is_match = GeoSearchIndex.derive_matcher(string, match_type, parent)
+
+        if parent is not None:
+            parent_geo = self.get(parent)
+            if parent_geo is None:
+                return None
+            alias_targets = parent_geo.alias_targets
+            parent_geo = alias_targets[0] if alias_targets else parent_geo
+            # Path children are already ranked
+            return [geo.human_id for geo in parent_geo.path_children
+                    if is_match(geo)]
+
+        if match_type in {MatchType.CONTAINS, MatchType.ENDS_WITH}:
+            return None
+        target = string.encode('utf-8')
+        sections = self._sections
+        name_rows = sections['match.name.row']
+        name_offsets = sections['match.name.offset']
+        abbrev_rows = sections['match.abbrev.row']
+        names, abbrevs = sections['geo.name'], sections['geo.abbrev']
+
+        def read_name_term(i):
+            return self._read_term(names[name_rows[i]], name_offsets[i])
+
+        def read_abbrev_term(i):
+            return self._read_term(abbrevs[abbrev_rows[i]])
+
+        rows = set()
+        for term_rows, read_term in ((name_rows, read_name_term),
+                                     (abbrev_rows, read_abbrev_term)):
+            i = _bisect_left(read_term, target, len(term_rows))
+            while i < len(term_rows) and read_term(i).startswith(target):
+                rows.add(term_rows[i])
+                i += 1
+
+        geos = (SnapshotGeo(self, row) for row in
+                sorted(rows, key=sections['geo.rank'].__getitem__))
+        return [geo.human_id for geo in geos if is_match(geo)]
+
+    def __repr__(self):
+        return '<{cls}: {size} geos at revision {revision}>'.format(
+            cls=self.__class__.__name__, size=self._size,
+            revision=self.revision)
+
+    def _find_row(self, human_id):
+        '''Look up row of a human_id via the hash index; None if missing'''
+        target = human_id.encode('utf-8')
+        human_ids, slots = self._human_ids, self._slots
+        mask = len(slots) - 1
+        slot = _hash(target) & mask
+        while True:
+            row = slots[slot]
+            if row < 0:
+                return None
+            if self._read_bytes(human_ids[row]) == target:
+                return row
+            slot = (slot + 1) & mask
+
+    def _read_bytes(self, index):
+        start = self._blob_offset + self._strings[index]
+        end = self._blob_offset + self._strings[index + 1]
+        return bytes(self._buffer[start:end])
+
+    def _read_string(self, index):
+        '''Read string at index in string table; None if index is -1'''
+        if index < 0:
+            return None
+        return self._read_bytes(index).decode('utf-8')
+
+    def _read_term(self, index, offset=0):
+        '''Read lowercased UTF-8 term of string at index from offset'''
+        term = self._read_bytes(index)[offset:].decode('utf-8')
+        return term.lower().encode('utf-8')
+
+    def _read_column(self, name, row):
+        '''Read integer column value, converting NULL to None'''
+        value = self._sections[name][row]
+        return None if value == self.NULL else value
+
+    def _read_csr(self, name, row):
+        '''Read items of a CSR section for a row'''
+        offsets = self._sections[name + '.offsets']
+        return self._sections[name][offsets[row]:offsets[row + 1]]
+
+    @classmethod
+    def export(cls, path, session=None):
+        '''
+        Export
+
+        Write a snapshot of all geos in the database to the given path,
+        reading only the columns needed rather than instantiating
+        models. The file is written alongside and then moved into
+        place, so processes mapping a prior snapshot are unaffected.
+
+        I/O:
+        path: path of snapshot file
+        session=None: session to query; defaults to that of Geo.query
+        return: number of geos exported
+        '''
+        session = session or Geo.query.session
+        strings = _StringTable()
+        # Read first, so any geos committed during export render it stale
+        revision = read_geo_revision(session)
+
+        data_columns = [getattr(GeoData, '_' + column)
+                        if hasattr(GeoData, '_' + column)
+                        else getattr(GeoData, column)
+                        for column in cls.DATA_COLUMNS]
+        geo_rows = sorted(
+            session.query(Geo.id, Geo.human_id, Geo.name, Geo.abbrev,
+                          Geo.path_parent_id, *data_columns)
+                   .outerjoin(Geo.data),
+            key=lambda row: row[1].encode('utf-8'))
+        rows_by_id = {row[0]: i for i, row in enumerate(geo_rows)}
+
+        sections = OrderedDict()
+        sections['meta.revision'] = [revision]
+        sections['geo.id'] = [r[0] for r in geo_rows]
+        for column, i in (('human_id', 1), ('name', 2), ('abbrev', 3)):
+            sections['geo.' + column] = [strings.add(r[i]) for r in geo_rows]
+        sections['geo.path_parent'] = [
+            rows_by_id[r[4]] if r[4] is not None else -1 for r in geo_rows]
+        # Rank by descending total population, missing data last
+        total_pops = [r[5 + cls.DATA_COLUMNS.index('total_pop')]
+                      for r in geo_rows]
+        ranks = {row: rank for rank, row in enumerate(sorted(
+            range(len(geo_rows)), key=lambda row: (
+                total_pops[row] is None, -(total_pops[row] or 0), row)))}
+        sections['geo.rank'] = [ranks[row] for row in range(len(geo_rows))]
+        for i, column in enumerate(cls.DATA_COLUMNS, start=5):
+            sections['data.' + column] = [
+                r[i] if r[i] is not None else cls.NULL for r in geo_rows]
+        sections['index.slots'] = cls._index_human_ids(
+            r[1] for r in geo_rows)
+
+        levels = [[] for _ in geo_rows]
+        for level_id, geo_id, level, designation in session.execute(
+                select([GeoLevel.__table__.c.id, GeoLevel.geo_id,
+                        GeoLevel.__table__.c.level,
+                        GeoLevel.designation])):
+            levels[rows_by_id[geo_id]].append((level, designation, level_id))
+        ids = {}
+        for level_id, standard, code in session.execute(
+                select([GeoID.level_id, GeoID.__table__.c.standard,
+                        GeoID.__table__.c.code])):
+            ids.setdefault(level_id, []).append((standard, code))
+
+        level_offsets, level_names, designations = [0], [], []
+        id_offsets, standards, codes = [0], [], []
+        for geo_levels in levels:
+            for level, designation, level_id in sorted(geo_levels):
+                level_names.append(strings.add(level))
+                designations.append(strings.add(designation))
+                for standard, code in sorted(ids.get(level_id, ())):
+                    standards.append(strings.add(standard))
+                    codes.append(strings.add(code))
+                id_offsets.append(len(standards))
+            level_offsets.append(len(level_names))
+        for name, values in (('level.offsets', level_offsets),
+                             ('level', level_names),
+                             ('level.designation', designations),
+                             ('level.ids.offsets', id_offsets),
+                             ('level.ids.standard', standards),
+                             ('level.ids.code', codes)):
+            sections[name] = values
+
+        related = {relation: [[] for _ in geo_rows]
+                   for relation in cls.RELATIONS}
+        for r in geo_rows:
+            if r[4] is not None:
+                related[Geo.PATH_CHILDREN][rows_by_id[r[4]]].append(
+                    rows_by_id[r[0]])
+        for table, a_column, b_column, a_relation, b_relation in (
+                (geo_parent_child_association_table, 'parent_id',
+                 'child_id', Geo.CHILDREN, Geo.PARENTS),
+                (geo_alias_association_table, 'alias_target_id',
+                 'alias_id', Geo.ALIASES, Geo.ALIAS_TARGETS)):
+            for a_id, b_id in session.execute(
+                    select([table.c[a_column], table.c[b_column]])):
+                a_row, b_row = rows_by_id[a_id], rows_by_id[b_id]
+                related[a_relation][a_row].append(b_row)
+                related[b_relation][b_row].append(a_row)
+        level_names = [sorted(level for level, _, _ in geo_levels)
+                       for geo_levels in levels]
+        for relation in cls.RELATIONS:
+            offsets, targets = [0], []
+            level_offsets, related_levels = [0], []
+            level_geo_offsets, level_targets = [0], []
+            for related_rows in related[relation]:
+                related_rows = sorted(set(related_rows), key=ranks.get)
+                targets.extend(related_rows)
+                offsets.append(len(targets))
+                rows_by_level = OrderedDict()
+                for row in related_rows:
+                    if total_pops[row] is None:
+                        continue
+                    for level in level_names[row]:
+                        rows_by_level.setdefault(level, []).append(row)
+                for level in sorted(rows_by_level):
+                    related_levels.append(strings.add(level))
+                    level_targets.extend(rows_by_level[level])
+                    level_geo_offsets.append(len(level_targets))
+                level_offsets.append(len(related_levels))
+            name = 'relation.{}'.format(relation)
+            for suffix, values in (('.offsets', offsets),
+                                   ('', targets),
+                                   ('.level.offsets', level_offsets),
+                                   ('.level', related_levels),
+                                   ('.level.geos.offsets', level_geo_offsets),
+                                   ('.level.geos', level_targets)):
+                sections[name + suffix] = values
+
+        name_terms, abbrev_terms = [], []
+        for row, r in enumerate(geo_rows):
+            name = (r[2] or '').encode('utf-8')
+            # As with LIKE '% x%', a word starts after each space
+            for offset in [0] + [i + 1 for i, c in enumerate(bytearray(name))
+                                 if c == ord(' ') and i + 1 < len(name)]:
+                name_terms.append((_lower(name[offset:]), row, offset))
+            if r[3]:
+                abbrev_terms.append((_lower(r[3].encode('utf-8')), row))
+        name_terms.sort()
+        abbrev_terms.sort()
+        sections['match.name.row'] = [row for _, row, _ in name_terms]
+        sections['match.name.offset'] = [offset for _, _, offset in name_terms]
+        sections['match.abbrev.row'] = [row for _, row in abbrev_terms]
+
+        sections['strings.offsets'] = strings.offsets
+        sections['strings.blob'] = strings.blob
+
+        cls._write(path, sections)
+        return len(geo_rows)
+
+    @staticmethod
+    def _index_human_ids(human_ids):
+        '''Return hash index slots of rows for human_ids, in row order'''
+        encoded = [human_id.encode('utf-8') for human_id in human_ids]
+        num_slots = 1
+        while num_slots < 2 * len(encoded):
+            num_slots *= 2
+        mask = num_slots - 1
+        slots = [-1] * num_slots
+        for row, human_id in enumerate(encoded):
+            slot = _hash(human_id) & mask
+            while slots[slot] >= 0:
+                slot = (slot + 1) & mask
+            slots[slot] = row
+        return slots
+
+    @classmethod
+    def _write(cls, path, sections):
+        '''
+        Write sections to a temporary file and move it into place
+
+        Sections are lists of integers, written as 64-bit integers, or
+        bytes (e.g. the string blob), written as is.
+        '''
+        alignment = cls.ALIGNMENT
+        offset = cls.HEADER.size + len(sections) * cls.SECTION.size
+        table = []
+        for name, values in sections.items():
+            if len(name) > cls.SECTION_NAME_LENGTH:
+                raise ValueError('Snapshot section name too long: {}'
+                                 .format(name))
+            offset += -offset % alignment
+            typecode = 'B' if isinstance(values, (bytes, bytearray)) else 'q'
+            table.append((name, values, typecode, offset))
+            offset += len(values) * struct.calcsize(str('<' + typecode))
+
+        temp_path = '{path}.{pid}.tmp'.format(path=path, pid=os.getpid())
+        with io.open(temp_path, 'wb') as snapshot_file:
+            snapshot_file.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION,
+                                                len(sections)))
+            for name, values, typecode, offset in table:
+                snapshot_file.write(cls.SECTION.pack(
+                    name.encode('ascii'), typecode.encode('ascii'),
+                    offset, len(values)))
+            for name, values, typecode, offset in table:
+                snapshot_file.write(
+                    b'\0' * (offset - snapshot_file.tell()))
+                if typecode == 'B':
+                    snapshot_file.write(bytes(values))
+                else:
+                    snapshot_file.write(struct.pack(
+                        str('<{}q'.format(len(values))), *values))
+        os.rename(temp_path, path)
+
+
+class SnapshotGeo(object):
+    '''
+    Snapshot geo
+
+    Read-only view of a geo row in a GeoSnapshot, with the attributes
+    and related geo traversal of Geo needed to serve reads.
+    '''
+    __slots__ = ('_snapshot', 'row')
+
+    def __init__(self, snapshot, row):
+        self._snapshot = snapshot
+        self.row = row
+
+    def __eq__(self, other):
+        return (isinstance(other, SnapshotGeo) and
+                other._snapshot is self._snapshot and other.row == self.row)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self._snapshot), self.row))
+
+    def __repr__(self):
+        return '{cls}[{human_id!r}]'.format(cls=self.__class__.__name__,
+                                            human_id=self.human_id)
+
+    @property
+    def id(self):
+        return self._snapshot._read_column('geo.id', self.row)
+
+    @property
+    def human_id(self):
+        return self._read_string('geo.human_id')
+
+    @property
+    def name(self):
+        return self._read_string('geo.name')
+
+    @property
+    def abbrev(self):
+        return self._read_string('geo.abbrev')
+
+    @property
+    def path_parent(self):
+        row = self._snapshot._sections['geo.path_parent'][self.row]
+        return SnapshotGeo(self._snapshot, row) if row >= 0 else None
+
+    @property
+    def data(self):
+        '''GeoData.Record of data values, or None if no data'''
+        snapshot = self._snapshot
+        record = GeoData.DequantizedRecord(
+            *(snapshot._read_column('data.' + column, self.row)
+              for column in GeoData.DequantizedRecord._fields))
+        if all(value is None for value in record):
+            return None
+        return GeoData.requantize(record)
+
+    @property
+    def total_pop(self):
+        return self._snapshot._read_column('data.total_pop', self.row)
+
+    @property
+    def levels(self):
+        '''OrderedDict of SnapshotGeo.Level namedtuples keyed by level'''
+        snapshot, sections = self._snapshot, self._snapshot._sections
+        read_string = snapshot._read_string
+        offsets, id_offsets = (sections['level.offsets'],
+                               sections['level.ids.offsets'])
+        standards, codes = (sections['level.ids.standard'],
+                            sections['level.ids.code'])
+        levels = OrderedDict()
+        for i in range(offsets[self.row], offsets[self.row + 1]):
+            ids = OrderedDict(
+                (read_string(standards[j]), read_string(codes[j]))
+                for j in range(id_offsets[i], id_offsets[i + 1]))
+            level = read_string(sections['level'][i])
+            levels[level] = GeoSnapshot.Level(
+                level=level,
+                designation=read_string(sections['level.designation'][i]),
+                ids=ids)
+        return levels
+
+    @property
+    def parents(self):
+        return self._read_related(Geo.PARENTS)
+
+    @property
+    def children(self):
+        return self._read_related(Geo.CHILDREN)
+
+    @property
+    def path_children(self):
+        return self._read_related(Geo.PATH_CHILDREN)
+
+    @property
+    def aliases(self):
+        return self._read_related(Geo.ALIASES)
+
+    @property
+    def alias_targets(self):
+        return self._read_related(Geo.ALIAS_TARGETS)
+
+    @property
+    def rank(self):
+        '''Rank by descending total population, missing data last'''
+        return self._snapshot._sections['geo.rank'][self.row]
+
+    def get_related_geos(self, relation, level=None, include_aliases=False,
+                         outer_join_data=False):
+        '''
+        Get related geos (e.g. parents/children)
+
+        Given a relation, returns a list of related geos at the given
+        level (if specified), in descending order by total population,
+        per Geo.get_related_geos. Aliases are excluded unless included,
+        as are geos without data unless including aliases or outer
+        joining data.
+        '''
+        self._validate_relation(relation)
+        include_missing_data = outer_join_data or include_aliases
+        if level and not include_missing_data:
+            geos = self._read_related_by_level(relation).get(level, [])
+        else:
+            geos = self._read_related(relation)
+            if not include_missing_data:
+                geos = [g for g in geos if g.total_pop is not None]
+            if level:
+                geos = [g for g in geos if level in g.levels]
+        if not include_aliases:
+            geos = [g for g in geos if not g._has_related(Geo.ALIAS_TARGETS)]
+        return geos
+
+    def related_geos_by_level(self, relation, levels, limit=-1, offset=0):
+        '''
+        Related geos by level
+
+        Given a relation, returns an ordered dictionary keyed by level
+        of (geos, total) tuples, per Geo.related_geos_by_level: geos
+        with data are listed in descending order by total population,
+        skipping offset geos and capped by limit, and total is the
+        number of geos in the level. Levels without geos in the page
+        are excluded.
+        '''
+        self._validate_relation(relation)
+        related_geos = self._read_related_by_level(relation)
+        rv = OrderedDict()
+        for level in levels:
+            geos = related_geos.get(level, ())
+            page = (geos[offset:] if limit < 0
+                    else geos[offset:offset + limit])
+            if page:
+                rv[level] = (page, len(geos))
+        return rv
+
+    @staticmethod
+    def _validate_relation(relation):
+        if relation not in Geo.RELATIONS:
+            raise ValueError('{rel} is not an allowed value for relation'
+                             .format(rel=relation))
+
+    def _read_string(self, column):
+        snapshot = self._snapshot
+        return snapshot._read_string(snapshot._sections[column][self.row])
+
+    def _read_related(self, relation):
+        snapshot = self._snapshot
+        return [SnapshotGeo(snapshot, row) for row in snapshot._read_csr(
+            'relation.{}'.format(relation), self.row)]
+
+    def _read_related_by_level(self, relation):
+        '''Read dict of related geos with data, keyed by their levels'''
+        snapshot, sections = self._snapshot, self._snapshot._sections
+        name = 'relation.{}.level'.format(relation)
+        offsets, levels = sections[name + '.offsets'], sections[name]
+        geo_offsets, geo_rows = (sections[name + '.geos.offsets'],
+                                 sections[name + '.geos'])
+        return {snapshot._read_string(levels[i]): [
+                    SnapshotGeo(snapshot, row) for row in
+                    geo_rows[geo_offsets[i]:geo_offsets[i + 1]]]
+                for i in range(offsets[self.row], offsets[self.row + 1])}
+
+    def _has_related(self, relation):
+        offsets = self._snapshot._sections[
+            'relation.{}.offsets'.format(relation)]
+        return offsets[self.row + 1] > offsets[self.row]
+
+
+class _StringTable(object):
+    '''Deduplicated UTF-8 strings, indexed in order of addition'''
+
+    def __init__(self):
+        self._indices = {}
+        self.offsets = [0]
+        self.blob = bytearray()
+
+    def add(self, string):
+        '''Add string, if new, and return its index; -1 if None'''
+        if string is None:
+            return -1
+        index = self._indices.get(string)
+        if index is None:
+            index = self._indices[string] = len(self.offsets) - 1
+            self.blob.extend(string.encode('utf-8'))
+            self.offsets.append(len(self.blob))
+        return index
+
+
+class _StructArray(object):
+    '''Read-only little-endian array view via struct (e.g. Python 2)'''
+
+    def __init__(self, buffer, offset, count, typecode):
+        self._buffer = buffer
+        self._struct = struct.Struct(str('<' + typecode))
+        self._offset = offset
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('snapshot array index out of range')
+        return self._struct.unpack_from(
+            self._buffer, self._offset + index * self._struct.size)[0]
+
+
+def _hash(data):
+    '''Stable unsigned hash of bytes, independent of PYTHONHASHSEED'''
+    return zlib.crc32(data) & 0xffffffff
+
+
+def _lower(data):
+    '''Lowercase UTF-8 encoded bytes'''
+    return data.decode('utf-8').lower().encode('utf-8')
+
+
+def _bisect_left(read, target, size):
+    '''Return first index in [0, size) with read(index) >= target'''
+    lo, hi = 0, size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if read(mid) < target:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _map_array(buffer, offset, count, typecode):
+    '''Map read-only array of count items at offset within buffer'''
+    size = struct.calcsize(str('<' + typecode))
+    if sys.byteorder == 'little' and hasattr(memoryview, 'cast'):
+        view = memoryview(buffer)[offset:offset + count * size]
+        return view.cast(str(typecode))
+    return _StructArray(buffer, offset, count, typecode)
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def invalidate_geo_snapshot(session):
+    '''Mark the installed snapshot stale once geos are committed'''
+    snapshot = Geo.snapshot
+    if snapshot is not None and 'geo_revision' in session.info:
+        snapshot.mark_stale('geos committed in this process')
@@ -3,14 +3,16 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import flask
-from flask import (abort, jsonify, make_response, redirect, render_template,
-                   request)
+from flask import (abort, json, jsonify, make_response, redirect,
+                   render_template, request)
 
 from . import blueprint
 from .models import Geo, GeoLevel
 from intertwine.utils.jsonable import Jsonable
 from ..exceptions import InterfaceException, ResourceDoesNotExist
-from ..utils.flask_utils import json_requested
+from ..utils.flask_utils import (json_requested, json_stream_warranted,
+                                 stream_json_response)
+from ..utils.response_cache import cached_json_response
 
 
 @blueprint.errorhandler(InterfaceException)
@@ -76,6 +78,9 @@ def find_geo_matches(match_string, match_limit=None):
     json_kwarg_map = {Geo: json_kwargs}
     if match_limit:
         json_kwarg_map[object] = dict(limit=match_limit)
+    if match_limit < 0 or json_stream_warranted(**json_kwargs):
+        return stream_json_response(Jsonable.iterjsonify_value(
+            geo_matches, json_kwarg_map, dumps=json.dumps))
     return jsonify(Jsonable.jsonify_value(geo_matches, json_kwarg_map))
 
 
@@ -99,12 +104,24 @@ def get_geo_json(geo_huid):
     '''
     json_kwargs = dict(Geo.objectify_json_kwargs(request.args))
 
-    try:
-        geo = Geo.reconstruct(geo_huid)
-    except KeyError as e:
-        raise ResourceDoesNotExist(str(e))
+    def load():
+        try:
+            geo = Geo.reconstruct((geo_huid,))
+        except KeyError as e:
+            raise ResourceDoesNotExist(str(e))
+
+        return geo.eager_load(**json_kwargs)
+
+    if json_stream_warranted(**json_kwargs):
+        # Large responses are streamed rather than cached
+        return stream_json_response(
+            load().iterjsonify(dumps=json.dumps, **json_kwargs))
+
+    def render():
+        return load().jsonify(**json_kwargs)
 
-    return jsonify(geo.jsonify(**json_kwargs))
+    uri = Geo.form_uri(Geo.Key(geo_huid))
+    return cached_json_response(uri, json_kwargs, render)
 
 
 def get_geo_html(geo_huid):
@@ -112,7 +129,7 @@ def get_geo_html(geo_huid):
     geo_huid = geo_huid.lower()
 
     try:
-        geo = Geo.reconstruct(geo_huid)
+        geo = Geo.reconstruct((geo_huid,))
     except KeyError:
         # TODO: Instead of aborting, reroute to geo_not_found page
         # Oops! 'X' is not a geo found in Intertwine.
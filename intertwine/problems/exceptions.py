@@ -49,7 +49,8 @@ class InvalidAggregateConnectionRating(IntertwineException):
 
 
 class InvalidAggregation(IntertwineException):
-    '''Aggregation '{aggregation}' is not valid. Must be 'strict'.'''
+    '''Aggregation '{aggregation}' is not valid. Must be 'strict' or
+    'inclusive'.'''
 
 
 class InvalidUser(IntertwineException):
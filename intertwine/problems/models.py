@@ -9,11 +9,11 @@ from numbers import Real
 from operator import attrgetter
 
 from past.builtins import basestring
-from sqlalchemy import Column, ForeignKey, Index, or_, orm, types
+from sqlalchemy import Column, ForeignKey, Index, or_, orm, select, types
 from titlecase import titlecase
 
 from intertwine import IntertwineModel
-from intertwine.geos.models import Geo
+from intertwine.geos.models import Geo, geo_closure_table
 from intertwine.third_party import urlnorm
 from intertwine.utils.enums import UriType
 
@@ -108,18 +108,25 @@ class AggregateProblemConnectionRating(BaseProblemModel):
     recalculated on each request. Ratings are aggregated across users
     within a community context of problem, org, and geo.
 
-    Currently, aggregations are only created when the problem network is
-    first rendered within a given community. The cumulative weight
-    across all the ratings aggregated is also stored, allowing the
-    aggregate rating to be updated without having to recalculate the
-    aggregation across all the included ratings.
+    Aggregations are maintained on write: whenever a rating changes,
+    the strict aggregate rating in its community is created or updated
+    (see ProblemConnectionRating.update_values), along with the
+    inclusive aggregate ratings of the communities for every geo
+    encompassing it, so rendering the problem network never writes.
+    Aggregations predating this can be backfilled via
+    Community.backfill_aggregate_ratings. The cumulative weight across
+    all the ratings aggregated is also stored, allowing the aggregate
+    rating to be updated without having to recalculate the aggregation
+    across all the included ratings.
 
     I/O:
     community: Community context for the aggregate rating
     connection: Connection being rated
     aggregation='strict': String specifying the aggregation method:
         - 'strict': include only ratings in the associated community
-        - 'inclusive': include all ratings within sub-orgs/geos
+        - 'inclusive': include all ratings within the community geo
+            and all of its descendant geos; the community for 'The
+            World' (geo is None) includes ratings in every geo
         - 'inherited': include ratings from a different community
     rating=None: Real number between 0 and 4 inclusive; rating and
         weight must both be defined or both be None
@@ -131,7 +138,8 @@ class AggregateProblemConnectionRating(BaseProblemModel):
     '''
     SUB_BLUEPRINT = 'rated_connections'
     STRICT = 'strict'
-    AGGREGATIONS = {STRICT}
+    INCLUSIVE = 'inclusive'
+    AGGREGATIONS = {STRICT, INCLUSIVE}
 
     NO_RATING = -1
     NO_WEIGHT = 0
@@ -232,6 +240,35 @@ class AggregateProblemConnectionRating(BaseProblemModel):
 
         return (aggregate_rating, aggregate_weight)
 
+    @classmethod
+    def query_ratings(cls, connection, community, aggregation=STRICT):
+        '''
+        Query ratings
+
+        Return a query of the ratings included in the aggregation of
+        the connection within the community. If connection is None,
+        ratings on all connections are included.
+        '''
+        problem, org, geo = community.derive_key()
+        rq = ProblemConnectionRating.query.filter_by(problem=problem, org=org)
+        if connection is not None:
+            rq = rq.filter_by(connection=connection)
+
+        if aggregation == cls.STRICT:
+            return rq.filter_by(geo=geo)
+
+        if aggregation == cls.INCLUSIVE:
+            if geo is None:
+                return rq  # The World encompasses every geo
+            closure = geo_closure_table
+            descendant_ids = (select([closure.c.descendant_id])
+                              .where(closure.c.ancestor_id == geo.id))
+            return rq.filter(or_(
+                ProblemConnectionRating.geo_id == geo.id,
+                ProblemConnectionRating.geo_id.in_(descendant_ids)))
+
+        raise InvalidAggregation(aggregation=aggregation)
+
     def update_values(self, new_user_rating, new_user_weight,
                       old_user_rating=None, old_user_weight=None):
         '''Update values'''
@@ -243,6 +280,11 @@ class AggregateProblemConnectionRating(BaseProblemModel):
 
         new_aggregate_weight = (
             self.weight + new_user_weight - old_user_weight)
+        if new_aggregate_weight <= self.NO_WEIGHT:
+            # All remaining ratings carry no weight
+            self.rating, self.weight = self.NO_RATING, self.NO_WEIGHT
+            return
+
         new_aggregate_rating = (
             (self.rating * self.weight + increase - decrease) * 1.0 /
             new_aggregate_weight)
@@ -253,7 +295,6 @@ class AggregateProblemConnectionRating(BaseProblemModel):
                  rating=None, weight=None, ratings=None):
         problem, org, geo = community.derive_key()
         self.connection_category = connection.derive_category(problem)
-        # TODO: add 'inclusive' to include all ratings within sub-orgs/geos
         # TODO: add 'inherited' to point to a different context for ratings
         if aggregation not in self.AGGREGATIONS:
             raise InvalidAggregation(aggregation=aggregation)
@@ -273,16 +314,9 @@ class AggregateProblemConnectionRating(BaseProblemModel):
                 AggregateProblemConnectionRating.calculate_values(ratings))
 
         elif rating is None:
-            if aggregation == self.STRICT:
-                rq = ProblemConnectionRating.query.filter_by(
-                    connection=connection, problem=problem, org=org, geo=geo)
-                # TODO: implement inclusive aggregation
-                # Removed since it is not strict:
-                # rq = rq.filter_by(org=org) if org else rq
-                # rq = rq.filter_by(geo=geo) if geo else rq
-                # ratings = rq.all()
-                rating, weight = (
-                    AggregateProblemConnectionRating.calculate_values(rq))
+            rq = self.query_ratings(connection, community, aggregation)
+            rating, weight = (
+                AggregateProblemConnectionRating.calculate_values(rq))
 
         for field, value in (('Rating', rating), ('Weight', weight)):
             if not isinstance(value, Real):
@@ -306,11 +340,19 @@ class AggregateProblemConnectionRating(BaseProblemModel):
         Modify an existing aggregate rating
 
         Modify the rating and/or weight if new values are provided and
-        flag the aggregate problem connection rating as modified.
+        flag the aggregate problem connection rating as modified. If
+        neither is provided, they are recalculated from ratings, if
+        provided, or otherwise from the database, as upon creation.
         Required by the Trackable metaclass.
         '''
         rating = kwds.get('rating', None)
         weight = kwds.get('weight', None)
+        if rating is None and weight is None:
+            ratings = kwds.get('ratings', None)
+            if ratings is None:
+                ratings = self.query_ratings(
+                    self.connection, self.community, self.aggregation)
+            rating, weight = self.calculate_values(ratings)
 
         for field, value in (('Rating', rating), ('Weight', weight)):
             if not isinstance(value, Real):
@@ -511,16 +553,16 @@ class ProblemConnectionRating(BaseProblemModel):
         if has_updated:
             from ..communities.models import Community
 
-            community = Community.query.filter_by(problem=self.problem,
-                                                  org=self.org,
-                                                  geo=self.geo).first()
-            if community:
-                community.update_aggregate_ratings(connection=self.connection,
-                                                   user=self.user,
-                                                   new_user_rating=rating,
-                                                   new_user_weight=weight,
-                                                   old_user_rating=old_rating,
-                                                   old_user_weight=old_weight)
+            # Maintain aggregate ratings on write so reads never write
+            community_key = Community.Key(self.problem, self.org, self.geo)
+            community = (Community.tget(community_key) or
+                         Community(*community_key))
+            community.update_aggregate_ratings(connection=self.connection,
+                                               user=self.user,
+                                               new_user_rating=rating,
+                                               new_user_weight=weight,
+                                               old_user_rating=old_rating,
+                                               old_user_weight=old_weight)
         return has_updated
 
     def __init__(self, rating, connection, problem, org, geo,
@@ -5,6 +5,7 @@ from __future__ import (absolute_import, division, print_function,
 
 from flask import (abort, current_app, jsonify, make_response, redirect,
                    render_template, request)
+from sqlalchemy.orm.exc import NoResultFound
 
 from . import blueprint
 from .models import Problem, ProblemConnection
@@ -12,6 +13,7 @@ from .models import AggregateProblemConnectionRating as APCR
 from ..exceptions import (InterfaceException, IntertwineException,
                           ResourceDoesNotExist)
 from intertwine.utils.flask_utils import json_requested
+from intertwine.utils.response_cache import cached_json_response
 from intertwine.utils.tools import vardygrify
 
 
@@ -58,12 +60,17 @@ def get_problem_json(problem_huid):
     '''
     json_kwargs = dict(Problem.objectify_json_kwargs(request.args))
 
-    try:
-        problem = Problem.reconstruct(problem_huid)
-    except KeyError as e:
-        raise ResourceDoesNotExist(str(e))
+    def render():
+        try:
+            problem = Problem.reconstruct((problem_huid,))
+        except KeyError as e:
+            raise ResourceDoesNotExist(str(e))
+
+        problem.eager_load(**json_kwargs)
+        return problem.jsonify(**json_kwargs)
 
-    return jsonify(problem.jsonify(**json_kwargs))
+    uri = Problem.form_uri(Problem.Key(problem_huid))
+    return cached_json_response(uri, json_kwargs, render)
 
 
 def get_problem_html(problem_huid):
@@ -79,7 +86,7 @@ def get_problem_html(problem_huid):
     problem_huid = Problem.convert_name_to_human_id(problem_huid)
 
     try:
-        problem = Problem.reconstruct(problem_huid)
+        problem = Problem.reconstruct((problem_huid,))
     except KeyError:
         # TODO: Instead of aborting, reroute to problem_not_found page
         # Oops! 'X' is not a problem found in Intertwine.
@@ -117,13 +124,19 @@ def get_problem_connection_json(axis, problem_a_huid, problem_b_huid):
     '''
     json_kwargs = dict(ProblemConnection.objectify_json_kwargs(request.args))
 
-    try:
-        connection = ProblemConnection.reconstruct(
-            (axis, problem_a_huid, problem_b_huid))
-    except IntertwineException as e:
-        raise ResourceDoesNotExist(str(e))
+    def render():
+        try:
+            connection = ProblemConnection.reconstruct(
+                (axis, problem_a_huid, problem_b_huid), retrieve=True)
+        except (IntertwineException, NoResultFound) as e:
+            raise ResourceDoesNotExist(str(e))
+
+        connection.eager_load(**json_kwargs)
+        return connection.jsonify(**json_kwargs)
 
-    return jsonify(connection.jsonify(**json_kwargs))
+    uri = ProblemConnection.form_uri(
+        ProblemConnection.Key(axis, problem_a_huid, problem_b_huid))
+    return cached_json_response(uri, json_kwargs, render)
 
 
 def get_problem_connection_html(axis, problem_a_huid, problem_b_huid):
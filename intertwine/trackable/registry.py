@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import sys
+from collections import OrderedDict, namedtuple
+from weakref import KeyedRef
+
+from past.builtins import basestring
+
+# Python version compatibilities
+if sys.version_info < (3,):
+    from collections import MutableMapping
+else:
+    from collections.abc import MutableMapping
+
+
+RegistryStats = namedtuple(
+    'RegistryStats', 'policy, size, limit, hits, misses, evictions')
+
+
+class Registry(MutableMapping):
+    '''
+    Registry
+
+    Registry is the default (unbounded) store for instances tracked by
+    a Trackable class. It behaves like a dict, but also counts lookup
+    hits and misses and any evictions made by subclass policies.
+
+    Subclasses implement a policy by overriding _fetch and _store. The
+    registry is only a cache, as Trackable fails over to the database
+    on a registry miss, so evicting an instance is always safe for
+    instances that have been saved.
+
+    I/O:
+    limit=None: maximum number of instances; unbounded if None
+    '''
+    POLICY = 'unbounded'
+    # Whether instances may be evicted while still in use
+    BOUNDED = False
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.hits = self.misses = self.evictions = 0
+        self._data = self._create_store()
+
+    def _create_store(self):
+        return {}
+
+    def _fetch(self, key):
+        '''Return value for key without stats; raise KeyError on miss'''
+        return self._data[key]
+
+    def _store(self, key, value):
+        '''Store value by key, evicting per the policy as needed'''
+        self._data[key] = value
+
+    @property
+    def stats(self):
+        return RegistryStats(policy=self.POLICY, size=len(self),
+                             limit=self.limit, hits=self.hits,
+                             misses=self.misses, evictions=self.evictions)
+
+    def reset_stats(self):
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        '''Pop key without affecting stats'''
+        try:
+            value = self._fetch(key)
+            del self._data[key]
+            return value
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+
+    def values(self):
+        '''List registered values without affecting stats'''
+        rv = []
+        for key in list(self._data):
+            try:
+                rv.append(self._fetch(key))
+            except KeyError:
+                pass
+        return rv
+
+    def clear(self):
+        self._data.clear()
+
+    def __getitem__(self, key):
+        try:
+            value = self._fetch(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._store(key, value)
+
+    def __delitem__(self, key):
+        del self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return ('<{cls}: {size} of {limit}; {hits} hits, {misses} misses, '
+                '{evictions} evictions>'.format(
+                    cls=self.__class__.__name__, size=len(self),
+                    limit=self.limit, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions))
+
+
+class LRURegistry(Registry):
+    '''
+    LRU Registry
+
+    Registry bounded by limit that evicts the least recently used
+    instance once the limit is exceeded.
+
+    I/O:
+    limit=None: maximum number of instances; DEFAULT_LIMIT if None
+    '''
+    POLICY = 'lru'
+    BOUNDED = True
+    DEFAULT_LIMIT = 10000
+
+    def __init__(self, limit=None):
+        limit = self.DEFAULT_LIMIT if limit is None else limit
+        if limit < 1:
+            raise ValueError('Invalid registry limit: {}'.format(limit))
+        super(LRURegistry, self).__init__(limit=limit)
+
+    def _create_store(self):
+        return OrderedDict()
+
+    def _fetch(self, key):
+        # Reinsert to mark as most recently used
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def _store(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.limit:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+
+class WeakRegistry(Registry):
+    '''
+    Weak Registry
+
+    Registry that holds weak references, so an instance is evicted as
+    soon as nothing else (e.g. a session identity map) refers to it.
+
+    I/O:
+    limit=None: not used, as size is bounded by live references
+    '''
+    POLICY = 'weak'
+    BOUNDED = True
+
+    def _fetch(self, key):
+        value = self._data[key]()
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def _store(self, key, value):
+        self._data[key] = KeyedRef(value, self._evict, key)
+
+    def _evict(self, ref):
+        if self._data.get(ref.key) is ref:
+            del self._data[ref.key]
+            self.evictions += 1
+
+
+REGISTRY_POLICIES = {registry.POLICY: registry
+                     for registry in (Registry, LRURegistry, WeakRegistry)}
+
+
+def create_registry(policy=None, limit=None):
+    '''
+    Create registry
+
+    I/O:
+    policy=None: policy name (e.g. 'lru' or 'weak') or Registry
+        subclass; if None, the registry is unbounded unless a limit is
+        given, in which case the LRU policy is used
+    limit=None: maximum number of instances, if supported by policy
+    return: new registry
+    raise: ValueError if policy is not recognized
+    '''
+    if policy is None:
+        registry = Registry if limit is None else LRURegistry
+    elif isinstance(policy, basestring):
+        try:
+            registry = REGISTRY_POLICIES[policy]
+        except KeyError:
+            raise ValueError('Unknown registry policy: {}'.format(policy))
+    elif isinstance(policy, type) and issubclass(policy, Registry):
+        registry = policy
+    else:
+        raise ValueError('Unknown registry policy: {!r}'.format(policy))
+    return registry(limit=limit)
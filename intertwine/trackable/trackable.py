@@ -5,24 +5,34 @@ from __future__ import (absolute_import, division, print_function,
 
 import inspect
 import sys
+import threading
+import time
 from collections import namedtuple, OrderedDict
 
 from alchy.model import ModelMeta
 from past.builtins import basestring
+from sqlalchemy import and_, bindparam, or_
 from sqlalchemy.exc import IntegrityError, InvalidRequestError
-from sqlalchemy.orm import aliased, class_mapper
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import (RelationshipProperty, SynonymProperty, aliased,
+                            class_mapper, contains_eager, joinedload,
+                            lazyload)
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 
 from .exceptions import (
     InvalidRegistryKey, KeyConflictError, KeyInconsistencyError,
     KeyMissingFromRegistry, KeyMissingFromRegistryAndDatabase,
     KeyRegisteredAndNoModify)
+from .registry import create_registry
 from .utils import (build_table_model_map, dehumpify, isiterator, isnamedtuple,
-                    merge_args)
+                    merge_args, peak_memory)
 
 # Python version compatibilities
 U_LITERAL = 'u' if sys.version_info < (3,) else ''
 
+# Holds the memo of retrieved instances for the current thread/request
+_request_local = threading.local()
+
 
 def trepr(self, named=False, raw=True, tight=False, outclassed=True, _lvl=0):
     '''
@@ -192,7 +202,7 @@ def _update_(self, _prefix='_', _suffix='', **fields):
         updated = True
 
     if updated:
-        self.__class__._updates.add(self)
+        self.__class__._track_updates_((self,))
     return updated
 
 
@@ -220,6 +230,8 @@ def _validate_(self, registry_key):
 
 URIComponents = namedtuple('URIComponents', 'path, query')
 
+PreloadStats = namedtuple('PreloadStats', 'count, seconds, memory')
+
 
 def deconstruct(self, query_fields=None, named=True):
     '''
@@ -282,6 +294,15 @@ class Trackable(ModelMeta):
     instances are tracked automatically. Modifications of instances may
     be tracked using the '_modified' field on the instance, which is the
     set of modified instances of the same type.
+
+    The registry is a cache. By default it is unbounded, but a class may
+    set REGISTRY_POLICY ('lru' or 'weak') and REGISTRY_LIMIT to bound
+    it, or configure_registry may be used at runtime. Evicted instances
+    are retrieved from the database on the next lookup, including by
+    the constructor, which queries the database on a registry miss when
+    the registry is bounded. Unsaved instances are only found in the
+    registry, so loaders that rely on the constructor to find them
+    should use the default unbounded registry.
     '''
 
     # Max width used for Trackable's default repr
@@ -295,9 +316,24 @@ class Trackable(ModelMeta):
 
     QualifiedKey = namedtuple('QualifiedKey', 'model, key')
 
+    # Default registry policy and limit; may be overridden on classes
+    REGISTRY_POLICY = None
+    REGISTRY_LIMIT = None
+
+    # Rows fetched per batch when preloading existing instances
+    PRELOAD_BATCH_SIZE = 1000
+
+    # Max keys per query when getting many (bound by SQLite's 999 vars)
+    QUERY_BATCH_SIZE = 200
+
+    # Callables notified of instances tracked as new or modified
+    _update_listeners = []
+
+    # Cache of baked retrieval queries, one per model and hyper key shape
+    RETRIEVAL_CACHE_SIZE = 200
+    _bakery = staticmethod(baked.bakery(size=RETRIEVAL_CACHE_SIZE))
+
     def __new__(meta, name, bases, attr):
-        # Track instances for each class of type Trackable
-        attr['_instances'] = {}
         # Track any new or modified instances
         attr['_updates'] = set()
         # Provide default __repr__()
@@ -312,30 +348,52 @@ class Trackable(ModelMeta):
         attr['_validate_'] = _validate_
         attr['deconstruct'] = deconstruct
         new_cls = super(Trackable, meta).__new__(meta, name, bases, attr)
+        # Track instances for each class of type Trackable
+        new_cls._instances = create_registry(policy=new_cls.REGISTRY_POLICY,
+                                             limit=new_cls.REGISTRY_LIMIT)
         if new_cls.__name__ != 'Base':
             meta._classes[name] = new_cls
         return new_cls
 
     def __call__(cls, *args, **kwds):
+        return cls._construct_(cls._instances.BOUNDED, *args, **kwds)
+
+    def _construct_(cls, _query_on_miss, *args, **kwds):
+        '''
+        Construct
+
+        Return the registered instance for the key given by args/kwds,
+        modified accordingly, or else a new instance. If _query_on_miss
+        is True, the database is queried on a registry miss before
+        creating a new instance, as evicted instances would otherwise be
+        duplicated.
+        '''
         all_kwds = merge_args(cls.__init__, *args, **kwds) if args else kwds
         key = cls.create_key(**all_kwds)
         if key is None or key == '':
             raise InvalidRegistryKey(key=key, classname=cls.__name__)
-        inst = cls._instances.get(key, None)
+        inst = cls.tget(key, query_on_miss=_query_on_miss)
         if inst is None:
             inst = super(Trackable, cls).__call__(*args, **kwds)
             cls._instances[key] = inst
-            cls._updates.add(inst)
+            cls._track_updates_((inst,))
         else:
             if not hasattr(cls, 'modify'):
                 raise KeyRegisteredAndNoModify(key=key, classname=cls.__name__)
             inst._modified = set()
             cls.modify(inst, **all_kwds)
         if hasattr(inst, '_modified'):
-            cls._updates.update(inst._modified)
+            if inst._modified:
+                cls._track_updates_(inst._modified)
             del inst._modified
         return inst
 
+    def _track_updates_(cls, instances):
+        '''Track updated instances and notify update listeners'''
+        cls._updates.update(instances)
+        for listener in Trackable._update_listeners:
+            listener(instances)
+
     def _create_(cls, _save=True, *args, **kwds):
         inst = cls(*args, **kwds)
         if _save:
@@ -391,6 +449,45 @@ class Trackable(ModelMeta):
             inst = cls[key]
             return inst, False
 
+    def get_or_create_many(cls, kwds_list, _query_on_miss=True, _save=True):
+        '''
+        Get or create many
+
+        Given a sequence of kwds dicts as defined by the model's
+        __init__, return a list of (object, created) tuples in the same
+        order, as would be returned by get_or_create for each.
+
+        Existing objects are found via tget_many, so misses in the
+        registry are resolved with a single query per batch of keys.
+        The database is always queried if the registry is bounded, as
+        evicted objects would otherwise be duplicated. Objects are then
+        created for the remaining keys and if _save is True, added to
+        the session and flushed once.
+        '''
+        keys = [cls.create_key(**kwds) for kwds in kwds_list]
+        query_on_miss = _query_on_miss or cls._instances.BOUNDED
+        instances = cls.tget_many(keys, query_on_miss=query_on_miss)
+
+        rv, created = [], OrderedDict()
+        for key, kwds, inst in zip(keys, kwds_list, instances):
+            # Keys repeated in kwds_list are only created once, even if
+            # evicted from a bounded registry in the meantime
+            if inst is None and key in created:
+                inst = created[key]
+            elif inst is None:
+                # Known to be missing, so skip querying on a miss
+                inst = created[key] = cls._construct_(False, **kwds)
+                rv.append((inst, True))
+                continue
+            rv.append((inst, False))
+
+        if _save and created:
+            session = cls.session()
+            session.add_all(created.values())
+            session.flush()
+
+        return rv
+
     def update_or_create(cls, _query_on_miss=True, _nested_transaction=False,
                          _save=True, _prefix='_', _suffix='', *args, **kwds):
         '''
@@ -484,8 +581,10 @@ class Trackable(ModelMeta):
         query=None: URI query string values as a list or dict
         retrieve=False: if retrieve is False (default), instantiate
             foreign keys during reconstruction; if retrieve is True,
-            reconstruct via single query, but forgo Trackable caching;
-            if as_key is also True, return hyper_key instead of instance
+            reconstruct via single query (see retrieve), registering
+            the instance and its key components and memoizing it for
+            the current request, if any; if as_key is also True,
+            return hyper_key instead of instance
         as_key=False: if not as_key (default), return instance;
             if as_key is True and retrieve is False, return key;
             if as_key is True and retrieve is True, return hyper_key
@@ -546,13 +645,20 @@ class Trackable(ModelMeta):
         inst = cls[key]
         return inst if _base is None else (inst, _pidx, _qidx)
 
-    def retrieve(cls, hyper_key, _alias=None, _query=None):
+    def retrieve(cls, hyper_key):
         '''
         Retrieve
 
-        Instantiate from hyper key by recursively building query in a
-        depth-first manner and then executing it with the expectation
-        there will be a single result.
+        Instantiate from hyper key via a single query in which the key
+        components are joined, with the expectation there will be a
+        single result. The instance and its key components are then
+        registered.
+
+        Queries are baked (compiled once and cached) for each shape of
+        hyper key, i.e. the key types and which values are None, so only
+        the values are bound on each call. If a memo has been begun
+        (e.g. for the current request), each hyper key is retrieved at
+        most once until the memo is ended.
 
         I/O:
         hyper_key: Trackable key in which objects are replaced by keys
@@ -562,36 +668,128 @@ class Trackable(ModelMeta):
                 driver=Problem_Key(human_id=u'domestic_violence'),
                 impact=Problem_Key(human_id=u'homelessness')
             )
-        _alias=None: Private parameter containing SQLAlchemy alias for
-            each foreign key join; used to distinguish between multiple
-            joins to the same table (e.g. driver vs. impact above)
-        _idx=None: private parameter for tracking the index in recursion
         return: instance matching given query_key
         raise: NoResultFound if no instance is found
         '''
-        query = _query or cls.query
+        memo = getattr(_request_local, 'memo', None)
+        qualified_key = Trackable.QualifiedKey(cls, hyper_key)
+        if memo is not None and qualified_key in memo:
+            return memo[qualified_key]
+
+        shape, params = cls._retrieval_shape_(hyper_key)
+        query = Trackable._bakery(lambda session: session.query(cls), cls)
+        query.add_criteria(
+            lambda q: cls._shape_query_(q, shape), shape)
+
+        inst = query(cls.session()).params(**params).one()
+        inst = cls._register_retrieved_(inst, shape)
+
+        if memo is not None:
+            memo[qualified_key] = inst
+        return inst
+
+    def _retrieval_shape_(cls, hyper_key, _base=None, _params=None):
+        '''
+        Retrieval shape
+
+        Derive the shape of a hyper key and the values to be bound. The
+        shape is a hashable tuple of the (mutated) key type followed by
+        a tuple per field: (name, component class, component shape) for
+        key components, (name, None) for None values, and (name, param)
+        for values to be bound to the named parameter.
+
+        I/O:
+        hyper_key: Trackable key in which objects are replaced by keys
+        return: tuple of shape and dictionary of parameter values
+        '''
+        params = {} if _params is None else _params
         if hasattr(cls, 'mutate_key'):
             hyper_key = cls.mutate_key(hyper_key)
+        shape = [type(hyper_key)]
+
         for name, value in hyper_key._asdict().items():
-            field = getattr(_alias, name) if _alias else getattr(cls, name)
+            param = '__'.join((_base, name)) if _base else name
 
-            if not isnamedtuple(value):
-                query = query.filter(field == value)
+            if isnamedtuple(value):
+                component_cls = cls.key_model(value)
+                component_shape, _ = component_cls._retrieval_shape_(
+                    value, _base=param, _params=params)
+                shape.append((name, component_cls, component_shape))
+
+            elif value is None:
+                shape.append((name, None))
 
             else:
-                component_key = value
-                component_cls = cls.key_model(component_key)
+                params[param] = value
+                shape.append((name, param))
+
+        return tuple(shape), params
+
+    def _shape_query_(cls, query, shape, _alias=None, _path=None):
+        '''
+        Shape query
+
+        Recursively apply joins and filters to the query in a depth-
+        first manner, based on a hyper key shape. Key components are
+        joined and eagerly loaded from their joins.
+
+        I/O:
+        query: SQLAlchemy query to which joins/filters are applied
+        shape: hyper key shape, as derived by _retrieval_shape_
+        _alias=None: Private parameter containing SQLAlchemy alias for
+            each foreign key join; used to distinguish between multiple
+            joins to the same table (e.g. driver vs. impact)
+        _path=None: Private parameter containing the eager load path
+        return: query with joins/filters applied
+        '''
+        entity = cls if _alias is None else _alias
+        for item in shape[1:]:
+            name = item[0]
+            field = getattr(entity, name)
+
+            if len(item) == 3:
+                component_cls, component_shape = item[1:]
                 alias = aliased(component_cls)  # UnmappedClassError if invalid
                 query = query.join(alias, field)
-                query = component_cls.retrieve(
-                    hyper_key=component_key, _alias=alias, _query=query)
+                relation = getattr(entity, cls._relation_name_(name))
+                path = (_path.contains_eager(relation, alias=alias)
+                        if _path is not None
+                        else contains_eager(relation, alias=alias))
+                query = query.options(path)
+                query = component_cls._shape_query_(
+                    query, component_shape, _alias=alias, _path=path)
+
+            elif item[1] is None:
+                query = query.filter(field == None)  # noqa: E711
+
+            else:
+                query = query.filter(field == bindparam(item[1]))
+
+        return query
 
-        return query.one() if _query is None else query
+    def _relation_name_(cls, name):
+        '''Name of relation underlying a field, resolving synonyms'''
+        prop = class_mapper(cls).get_property(name)
+        return prop.name if isinstance(prop, SynonymProperty) else name
+
+    def _register_retrieved_(cls, inst, shape):
+        '''Register retrieved instance and its key components'''
+        for item in shape[1:]:
+            if len(item) == 3:
+                component_cls, component_shape = item[1:]
+                component = getattr(inst, item[0])
+                component_cls._register_retrieved_(component, component_shape)
+        return cls._instances.setdefault(inst.derive_key(), inst)
 
     def reconstitute(cls, hyper_key):
         '''
         Reconstitute
 
+        Instantiate from hyper key by recursively reconstituting key
+        components via the registry, which fails over to the database.
+        If a memo has been begun (e.g. for the current request), each
+        hyper key is reconstituted at most once until the memo is ended.
+
         I/O:
         hyper_key: Trackable key in which objects are replaced by keys
             Example:
@@ -603,6 +801,11 @@ class Trackable(ModelMeta):
         return: instance matching given query_key
         raise: KeyMissingFromRegistryAndDatabase if no instance is found
         '''
+        memo = getattr(_request_local, 'memo', None)
+        qualified_key = Trackable.QualifiedKey(cls, hyper_key)
+        if memo is not None and qualified_key in memo:
+            return memo[qualified_key]
+
         key_components = []
 
         for name, value in hyper_key._asdict().items():
@@ -618,6 +821,9 @@ class Trackable(ModelMeta):
 
         key = cls.create_key(*key_components)
         inst = cls[key]
+
+        if memo is not None:
+            memo[qualified_key] = inst
         return inst
 
     def instrumented_attribute(cls, field_name):
@@ -741,18 +947,14 @@ class Trackable(ModelMeta):
             When True, the database is queried if the key is not found
             in the registry.
         '''
+        if not isinstance(key, tuple):
+            key = (key,)  # convert non-tuple to 1-tuple
+
         try:
             return cls._instances[key]
         except KeyError:
             pass
 
-        if not isinstance(key, tuple):
-            key = (key,)  # convert non-tuple to 1-tuple
-            try:
-                return cls._instances[key]
-            except KeyError:
-                pass
-
         if not query_on_miss:
             return default
 
@@ -781,6 +983,75 @@ class Trackable(ModelMeta):
         cls._instances[key] = instance
         return instance
 
+    def tget_many(cls, keys, default=None, query_on_miss=True):
+        '''
+        Trackable get many (tget_many)
+
+        Given a sequence of keys, gets the corresponding instances from
+        the registry. If any keys are unregistered and query_on_miss is
+        True (default), the database is queried for all of them at once,
+        in batches of up to QUERY_BATCH_SIZE keys, and any instances
+        found are registered. Returns a list of instances in the same
+        order as the keys, with the default for any not found.
+
+        I/O:
+        keys:
+            A sequence of natural key tuples as defined by create_key/
+            derive_key methods on the Trackable class. As with tget, a
+            1-tuple key may be the unpacked 1-tuple (the value within).
+
+        default=None:
+            The value returned for each key without an instance.
+
+        query_on_miss=True:
+            When True, the database is queried for keys not found in
+            the registry.
+        '''
+        rv, misses = [], OrderedDict()
+        for i, key in enumerate(keys):
+            if not isinstance(key, tuple):
+                key = (key,)  # convert non-tuple to 1-tuple
+            try:
+                rv.append(cls._instances[key])
+            except KeyError:
+                rv.append(default)
+                misses.setdefault(cls.create_key(*key), []).append(i)
+
+        if not query_on_miss or not misses:
+            return rv
+
+        missing_keys = list(misses)
+        for start in range(0, len(missing_keys), cls.QUERY_BATCH_SIZE):
+            batch = missing_keys[start:start + cls.QUERY_BATCH_SIZE]
+            criteria = [cls._key_criterion_(key) for key in batch]
+            for instance in cls.query.filter(or_(*criteria)):
+                key = instance.derive_key()
+                if key not in misses:
+                    continue
+                instance = cls._instances.setdefault(key, instance)
+                for i in misses[key]:
+                    rv[i] = instance
+
+        return rv
+
+    def _key_criterion_(cls, key):
+        '''
+        Key criterion
+
+        Build SQL criterion matching the given key, comparing related
+        objects by id when the key field is not a mapped relation.
+        '''
+        key_properties = cls._key_properties_()
+        clauses = []
+        for field, value in key._asdict().items():
+            prop = key_properties[field]
+            if prop is not None:
+                clauses.append(prop.class_attribute == value)
+            else:
+                field_id = getattr(cls, field + cls._ID_TAG)
+                clauses.append(field_id == getattr(value, cls.ID_TAG))
+        return and_(*clauses)
+
     def __getitem__(cls, key):
         instance = cls.tget(key)
         if instance is None:
@@ -821,8 +1092,87 @@ class Trackable(ModelMeta):
         cls._instances.pop(key, None)
         cls._updates.discard(inst)
 
+    def _key_properties_(cls):
+        '''
+        Key properties
+
+        Map each key field to its underlying mapper property, resolving
+        synonyms. Fields not mapped directly (e.g. derived properties)
+        are mapped to None.
+        '''
+        mapper = class_mapper(cls)
+        key_properties = OrderedDict()
+        for field in cls.Key._fields:
+            try:
+                prop = mapper.get_property(field)
+                if isinstance(prop, SynonymProperty):
+                    prop = mapper.get_property(prop.name)
+            except InvalidRequestError:
+                prop = None
+            key_properties[field] = prop
+        return key_properties
+
+    def _preload_(cls, session, batch_size=None):
+        '''
+        Preload
+
+        Register existing instances by streaming them from the database
+        in batches. Only relations needed by the key are eagerly loaded
+        and keys are built from the selected column values, so no lazy
+        loads are incurred. If any key field is not directly mapped or
+        a key built from the first batch differs from the derived key,
+        keys are derived from the instances instead.
+
+        I/O:
+        session: SQLAlchemy session used to query instances
+        batch_size=None: rows per batch; PRELOAD_BATCH_SIZE if None
+        return: PreloadStats namedtuple of count, seconds, and memory,
+            the growth in peak resident memory in KB (None if unknown)
+        '''
+        batch_size = batch_size or cls.PRELOAD_BATCH_SIZE
+        start_time, start_memory = time.time(), peak_memory()
+
+        key_properties = cls._key_properties_()
+        derive = False
+        columns, options = [], [lazyload('*')]
+        for prop in key_properties.values():
+            if prop is None or (isinstance(prop, RelationshipProperty) and
+                                prop.uselist):
+                derive = True
+            elif isinstance(prop, RelationshipProperty):
+                options.append(joinedload(prop.class_attribute))
+            else:
+                columns.append(prop.class_attribute)
+
+        columns = [] if derive else columns
+        rows = (session.query(cls, *columns).options(*options)
+                       .yield_per(batch_size))
+
+        count = 0
+        for row in rows:
+            # Rows are instances unless columns are also selected
+            inst, values = (row[0], iter(row[1:])) if columns else (row, None)
+            key = None if derive else cls.Key(*(
+                getattr(inst, prop.key)
+                if isinstance(prop, RelationshipProperty) else next(values)
+                for prop in key_properties.values()))
+            # Key properties may transform column values (e.g. lowercase),
+            # so check keys against derived keys for the first batch
+            if derive or count < batch_size:
+                derived_key = inst.derive_key()
+                derive = derive or key != derived_key
+                key = derived_key
+            cls._instances[key] = inst
+            count += 1
+
+        end_memory = peak_memory()
+        memory = (end_memory - start_memory
+                  if start_memory is not None else None)
+        return PreloadStats(count=count, seconds=time.time() - start_time,
+                            memory=memory)
+
     @classmethod
-    def register_existing(meta, session, *args):
+    def register_existing(meta, session, *args, **kwds):
         '''
         Register existing instances of Trackable classes
 
@@ -831,14 +1181,39 @@ class Trackable(ModelMeta):
         and registered. If no classes are provided, instances of all
         Trackable classes are loaded from the database and registered.
         If a class is not Trackable, a TypeError is raised.
+
+        In preload mode, instances are streamed in batches, only the
+        relations needed by keys are eagerly loaded, and keys are built
+        from column values. Classes are preloaded in the order given,
+        so classes whose keys reference other classes should follow
+        them, e.g. (Geo, GeoData, GeoLevel, GeoID).
+
+        I/O:
+        session: SQLAlchemy session used to query instances
+        *args: Trackable classes; all Trackable classes if none given
+        preload=False: if True, use preload mode
+        batch_size=None: rows per batch in preload mode
+        return: if preload, an OrderedDict keyed by class name of
+            PreloadStats namedtuples (count, seconds, memory); else None
         '''
+        preload = kwds.pop('preload', False)
+        batch_size = kwds.pop('batch_size', None)
+        if kwds:
+            raise TypeError('Unexpected keyword arguments: {}'
+                            .format(', '.join(kwds)))
+
         classes = meta._classes.values() if len(args) == 0 else args
+        stats = OrderedDict() if preload else None
         for cls in classes:
             if cls.__name__ not in meta._classes:
                 raise TypeError('{} not Trackable.'.format(cls.__name__))
+            if preload:
+                stats[cls.__name__] = cls._preload_(session, batch_size)
+                continue
             instances = session.query(cls).all()
             for inst in instances:
                 cls._instances[inst.derive_key()] = inst
+        return stats
 
     @classmethod
     def clear_instances(meta, *args):
@@ -854,7 +1229,103 @@ class Trackable(ModelMeta):
         for cls in classes:
             if cls.__name__ not in meta._classes:
                 raise TypeError('{} not Trackable.'.format(cls.__name__))
-            cls._instances = {}
+            cls._instances.clear()
+
+    @classmethod
+    def configure_registry(meta, *args, **kwds):
+        '''
+        Configure registry used by Trackable classes
+
+        Replaces the registry of each class with a new registry of the
+        given policy and limit, carrying over registered instances (as
+        limited by the new registry). If no classes are provided, all
+        Trackable classes are configured. If a class is not Trackable,
+        a TypeError is raised.
+
+        I/O:
+        *args: Trackable classes to be configured
+        policy=None: registry policy name (e.g. 'lru' or 'weak') or
+            Registry subclass; unbounded if None and limit is None
+        limit=None: maximum number of instances registered per class
+        '''
+        policy = kwds.pop('policy', None)
+        limit = kwds.pop('limit', None)
+        if kwds:
+            raise TypeError('Unexpected keyword arguments: {}'
+                            .format(', '.join(kwds)))
+
+        classes = meta._classes.values() if len(args) == 0 else args
+        for cls in classes:
+            if cls.__name__ not in meta._classes:
+                raise TypeError('{} not Trackable.'.format(cls.__name__))
+            registry = create_registry(policy=policy, limit=limit)
+            for key in cls._instances:
+                try:
+                    registry[key] = cls._instances._fetch(key)
+                except KeyError:
+                    pass
+            cls._instances = registry
+
+    @classmethod
+    def registry_stats(meta, *args):
+        '''
+        Registry stats for Trackable classes
+
+        Returns a dictionary keyed by class name, where the values are
+        RegistryStats namedtuples of policy, size, limit, hits, misses,
+        and evictions.
+
+        If no arguments are provided, stats for all Trackable classes
+        are included. If one or more classes are passed as input, only
+        stats from these classes are included. If a class is not
+        Trackable, a TypeError is raised.
+        '''
+        classes = meta._classes.values() if len(args) == 0 else args
+        stats = {}
+        for cls in classes:
+            if cls.__name__ not in meta._classes:
+                raise TypeError('{} not Trackable.'.format(cls.__name__))
+            stats[cls.__name__] = cls._instances.stats
+        return stats
+
+    @classmethod
+    def begin_memo(meta):
+        '''
+        Begin memo
+
+        Begin memoizing instances retrieved/reconstituted from hyper
+        keys for the current thread, e.g. at the start of a request.
+        '''
+        _request_local.memo = {}
+
+    @classmethod
+    def end_memo(meta, *args):
+        '''
+        End memo
+
+        End memoizing instances for the current thread, e.g. at the end
+        of a request. Any args (e.g. a teardown exception) are ignored.
+        '''
+        _request_local.memo = None
+
+    @classmethod
+    def add_update_listener(meta, listener):
+        '''
+        Add update listener
+
+        Register a callable to be notified whenever instances of any
+        Trackable class are tracked as new or modified (see _updates).
+        The callable is passed an iterable of the instances, e.g. to
+        invalidate caches derived from them.
+        '''
+        if listener not in meta._update_listeners:
+            meta._update_listeners.append(listener)
+
+    @classmethod
+    def remove_update_listener(meta, listener):
+        '''Remove update listener, if registered'''
+        if listener in meta._update_listeners:
+            meta._update_listeners.remove(listener)
 
     @classmethod
     def clear_updates(meta, *args):
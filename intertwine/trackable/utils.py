@@ -82,3 +82,14 @@ def merge_args(func, *args, **kwds):
         kwds[arg_name] = arg_value
 
     return kwds
+
+
+def peak_memory():
+    '''Peak resident memory of the process in KB; None if unavailable'''
+    try:
+        import resource
+    except ImportError:  # e.g. Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
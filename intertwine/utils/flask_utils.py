@@ -3,7 +3,10 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
-from flask import request
+from flask import current_app, jsonify, request, stream_with_context
+
+# Responses jsonified deeper than this are streamed
+JSON_STREAM_DEPTH = 2
 
 
 def json_requested():
@@ -21,3 +24,38 @@ def json_requested():
     best = accept_mimetypes.best_match(['application/json', 'text/html'])
     return (best == 'application/json' and
             accept_mimetypes[best] > accept_mimetypes['text/html'])
+
+
+def json_stream_warranted(depth=1, limit=10, **json_kwargs):
+    '''
+    JSON stream warranted
+
+    Given jsonify kwargs, return True if the response may be large
+    enough to be streamed, i.e. if collections are unlimited or depth
+    exceeds JSON_STREAM_DEPTH.
+    '''
+    return limit < 0 or depth > JSON_STREAM_DEPTH
+
+
+def stream_json_response(chunks):
+    '''
+    Stream JSON response
+
+    Return a response streaming the given iterable of JSON strings
+    (e.g. from Jsonable.iterjsonify) within the request context.
+    '''
+    return current_app.response_class(stream_with_context(chunks),
+                                      mimetype='application/json')
+
+
+def handle_invalid_cursor(error):
+    '''
+    Handle invalid cursor
+
+    Return a 400 response with a JSON representation of the error, as
+    cursors come from the query string (see Jsonable.parse_cursor).
+    '''
+    response = jsonify({'error': {'message': str(error),
+                                  'type': error.__class__.__name__}})
+    response.status_code = 400
+    return response
@@ -3,6 +3,7 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import base64
 import inspect
 import json
 import sys
@@ -18,6 +19,7 @@ from past.builtins import basestring
 
 import sqlalchemy
 from sqlalchemy import orm
+from sqlalchemy.exc import NoInspectionAvailable
 from sqlalchemy.orm.descriptor_props import SynonymProperty as SP
 from sqlalchemy.orm.properties import ColumnProperty as CP
 from sqlalchemy.orm.relationships import RelationshipProperty as RP
@@ -70,6 +72,40 @@ class JsonProperty(object):
         return rv
 
 
+class JsonStream(dict):
+    '''
+    JSON stream
+
+    Top-level JSON dict used when streaming (see Jsonable.iterjsonify).
+    Jsonifying keyed objects other than the current one is deferred
+    until the entries visited before them are complete, so entries can
+    be emitted in order as soon as they are complete. Emitted entries
+    are released, keeping only their keys to detect repeat visits.
+    '''
+    def __init__(self):
+        super(JsonStream, self).__init__()
+        self.current = None
+        self.deferred = []
+        self.added = []
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.added.append(key)
+        super(JsonStream, self).__setitem__(key, value)
+
+    def defer(self, inst, json_kwargs):
+        '''Defer jsonifying the instance with the given kwargs'''
+        self.deferred.append((inst, json_kwargs))
+
+    def release(self, key):
+        '''Release value of an emitted entry, retaining its key'''
+        super(JsonStream, self).__setitem__(key, None)
+
+
+class InvalidCursor(ValueError):
+    '''Cursor is malformed or not supported for its collection'''
+
+
 class Jsonable(object):
 
     JSONIFY = 'jsonify'  # Must match the method name
@@ -83,6 +119,16 @@ class Jsonable(object):
     JsonKeyType = Enum('JsonKeyType', 'PRIMARY, NATURAL, URI',
                        module=__name__)
 
+    # Parsed form of opaque cursors (see form_cursor)
+    Cursor = namedtuple('Cursor', 'path, after')
+
+    # Compiled jsonify plans, cached LRU by signature across all classes
+    JSONIFY_PLAN_CACHE_SIZE = 1000
+    _jsonify_plans = OrderedDict()
+
+    JsonifyPlanStep = namedtuple('JsonifyPlanStep',
+                                 'field, prop, depth, hide_all, path')
+
     QualifiedPrimaryKey = namedtuple('QualifiedPrimaryKey', 'model, pk')
 
     @property
@@ -365,6 +411,7 @@ class Jsonable(object):
                 item_key = None
 
             if not item_key or (depth > 0 and item_key not in _json):
+                # Deferred if streaming, but the key is returned anyway
                 jsonified = value.jsonify(_json=_json, **json_kwargs)
 
             return item_key if item_key else jsonified
@@ -372,10 +419,21 @@ class Jsonable(object):
         if isinstance(value, NonCallableMagicMock):
             return None
 
+        path = json_kwargs.get('_path') or ''
+        offset, cursor, count = cls.extract_json_kwargs(
+            json_kwargs, 'offset', 'cursor', 'count')
+        offset, after = cls.derive_page_start(offset, cursor, path)
+
+        if isinstance(value, orm.Query):
+            return cls._jsonify_query(value, kwarg_map, _json, path, limit,
+                                      offset, after, count)
+        if after is not None:
+            raise InvalidCursor('Cursor not supported for {path}'
+                                .format(path=path))
+
         try:
             if isinstance(value, basestring) or value_is_class:
                 raise TypeError
-            # TODO: apply limit() if a query and then count() for total
             all_item_iterator = PeekableIterator(value)  # non-iterables raise
 
         except TypeError:
@@ -383,8 +441,20 @@ class Jsonable(object):
             return default(value)
 
         else:  # value is iterable and not a string
-            item_iterator = (islice(all_item_iterator, limit) if limit > 0
-                             else all_item_iterator)
+            try:
+                constructor = value._make  # namedtuple
+            except AttributeError:
+                constructor = None
+            else:
+                offset = 0  # all fields required
+
+            if offset > 0:
+                all_item_iterator = PeekableIterator(
+                    islice(all_item_iterator, offset, None))
+
+            item_iterator = (
+                islice(all_item_iterator, limit)
+                if limit > 0 and constructor is None else all_item_iterator)
 
             if hasattr(value, 'items'):  # dictionary
                 items = OrderedDict(
@@ -393,36 +463,143 @@ class Jsonable(object):
                     for k in item_iterator)
 
             else:  # tuple/list
-                try:
-                    constructor = value._make  # namedtuple
-                    item_iterator = all_item_iterator  # all fields required
-                except AttributeError:
-                    constructor = list
-
-                items = constructor(
+                items = (constructor or list)(
                     cls.jsonify_value(item, kwarg_map, _json)
                     for item in item_iterator)
 
-            if all_item_iterator.has_next():  # paginate
+            has_more = all_item_iterator.has_next()
+            if constructor is None and (has_more or offset or count):
                 try:
                     total = len(value)
                 except TypeError:
-                    total = value.count()
-                if limit < total:
-                    pagination = cls.paginate(len(items), limit, total)
-                    try:
-                        items.append(pagination)
-                    except AttributeError:
-                        items[cls.JSON_PAGINATION] = pagination
+                    total = None
+                pagination = cls.paginate(offset, limit, len(items),
+                                          has_more, total)
+                try:
+                    items.append(pagination)
+                except AttributeError:
+                    items[cls.JSON_PAGINATION] = pagination[
+                        cls.JSON_PAGINATION]
 
             return items
 
+    @classmethod
+    def _jsonify_query(cls, query, kwarg_map, _json, path, limit, offset,
+                       after, count):
+        '''
+        Jsonify query
+
+        Jsonify a page of query results, pushing the limit and offset
+        or keyset start (after) into SQL. One extra row is fetched to
+        determine if there are more, so the query is only counted if
+        count is True. Queries of a single entity without an ordering
+        are ordered by primary key for stable pages and may be paged by
+        cursor, starting after the primary key of the last item.
+        '''
+        total = query.order_by(None).count() if count else None
+        mapper = cls._keyset_mapper(query)
+        if mapper is not None:
+            pk = mapper.primary_key[0]
+            query = query.order_by(pk)
+            if after is not None:
+                query = query.filter(pk > after)
+        elif after is not None:
+            raise InvalidCursor('Cursor not supported for {path}'
+                                .format(path=path))
+        if offset > 0:
+            query = query.offset(offset)
+
+        rows = (query.limit(limit + 1) if limit > 0 else query).all()
+        has_more = 0 < limit < len(rows)
+        if has_more:
+            rows = rows[:limit]
+
+        items = [cls.jsonify_value(row, kwarg_map, _json) for row in rows]
+
+        if has_more or offset or after is not None or count:
+            next_cursor = None
+            if has_more and mapper is not None:
+                last_pk = mapper.primary_key_from_instance(rows[-1])[0]
+                next_cursor = cls.form_cursor(path, last_pk)
+            items.append(cls.paginate(offset, limit, len(items), has_more,
+                                      total, next_cursor))
+
+        return items
+
+    @classmethod
+    def _keyset_mapper(cls, query):
+        '''Return mapper if query may be paged by primary key keyset'''
+        # Existing orderings (e.g. relationship order_by) are kept
+        if (getattr(query, '_order_by_clauses', None) or
+                getattr(query, '_order_by', None)):
+            return None
+        descriptions = query.column_descriptions
+        if len(descriptions) != 1:
+            return None
+        try:
+            mapper = sqlalchemy.inspect(descriptions[0]['entity'])
+        except NoInspectionAvailable:
+            return None
+        mapper = getattr(mapper, 'mapper', mapper)  # if aliased
+        return mapper if len(mapper.primary_key) == 1 else None
+
+    @classmethod
+    def derive_page_start(cls, offset, cursor, path):
+        '''
+        Derive page start
+
+        Return (offset, after) tuple for the collection at the given
+        path. The offset applies only to collections of the main object
+        (i.e. at most one field deep). A cursor, parsed or not (see
+        parse_cursor), applies only to the collection for which it was
+        formed, where it replaces the offset with after, the primary key
+        after which the page starts; otherwise after is None.
+        '''
+        path = path or ''
+        if path.count(cls.JSON_PATH_DELIMITER) > 1:
+            offset = 0
+        if cursor:
+            cursor_path, after = cls.parse_cursor(cursor)
+            if cursor_path == path:
+                return 0, after
+        return offset, None
+
+    @classmethod
+    def form_cursor(cls, path, after):
+        '''Form opaque cursor for a collection page after the given key'''
+        data = json.dumps([path, after]).encode('utf-8')
+        return base64.urlsafe_b64encode(data).decode('ascii')
+
+    @classmethod
+    def parse_cursor(cls, cursor):
+        '''
+        Parse cursor
+
+        Return Cursor (path, after) namedtuple for the given cursor (see
+        form_cursor), which is returned as is if already parsed. Raises
+        InvalidCursor if the cursor is malformed.
+        '''
+        if isinstance(cursor, cls.Cursor):
+            return cursor
+        try:
+            data = base64.urlsafe_b64decode(cursor.encode('ascii'))
+            path, after = json.loads(data.decode('utf-8'))
+            if not isinstance(path, basestring):
+                raise TypeError
+            hash(after)
+        except (AttributeError, TypeError, ValueError, UnicodeError):
+            raise InvalidCursor('Invalid cursor: {}'.format(cursor))
+        return cls.Cursor(path, after)
+
     def jsonify(self,
                 config=None,     # type: Dict[Text: Union[int, float]]
                 depth=1,         # type: int
                 hide=None,       # type: Set[Text]
                 hide_all=False,  # type: bool
                 limit=10,        # type: int
+                offset=0,        # type: int
+                cursor=None,     # type: Text
+                count=False,     # type: bool
                 key_type=None,   # type: JsonKeyType
                 raw=False,       # type: bool
                 tight=True,      # type: bool
@@ -473,7 +650,25 @@ class Jsonable(object):
 
         limit=10:
             Cap number of list or dictionary items beneath main level;
-            a negative limit indicates no cap.
+            a negative limit indicates no cap. Collections that are
+            capped, offset, or counted include pagination metadata as
+            their last item (see paginate). Limits on dynamic
+            relationship queries are applied in SQL.
+
+        offset=0:
+            Number of items to skip in main-level collections (those
+            that are fields of the main object).
+
+        cursor=None:
+            Opaque cursor from a prior page's pagination metadata
+            (next_cursor). The collection it was formed for starts
+            after the last item of the prior page (keyset pagination),
+            which remains efficient regardless of page depth. Parsed
+            once up front; InvalidCursor is raised if invalid.
+
+        count=False:
+            If True, include the total number of items in pagination
+            metadata, which for queries requires a count query.
 
         key_type=None:
             A JsonKeyType enumeration with these options:
@@ -509,6 +704,18 @@ class Jsonable(object):
         _json=None:
             Private top-level JSON dict for recursion.
         '''
+        cursor = self.parse_cursor(cursor) if cursor else None
+
+        if isinstance(_json, JsonStream) and not nest:
+            if _json.current is not self:
+                _json.defer(self, dict(
+                    config=config, depth=depth, hide=hide, hide_all=hide_all,
+                    limit=limit, offset=offset, cursor=cursor, count=count,
+                    key_type=key_type, raw=raw, tight=tight, nest=nest,
+                    root=root, default=default, _path=_path))
+                return _json
+            _json.current = None
+
         assert depth > 0
         config = {} if config is None else config
         hide = set() if hide is None else hide
@@ -517,8 +724,9 @@ class Jsonable(object):
         _path = '' if _path is None else _path
         _json = OrderedDict() if _json is None else _json
         json_kwargs = dict(
-            config=config, hide=hide, limit=limit, key_type=key_type,
-            raw=raw, tight=tight, nest=nest, root=False, default=default)
+            config=config, hide=hide, limit=limit, offset=offset,
+            cursor=cursor, count=count, key_type=key_type, raw=raw,
+            tight=tight, nest=nest, root=False, default=default)
 
         # TODO: Check if item already exists and needs to be enhanced?
         self_json = OrderedDict()
@@ -526,31 +734,14 @@ class Jsonable(object):
             self_key = self.json_key(**json_kwargs)
             _json[self_key] = self_json
 
-        fields = self.fields()
+        plan = self.jsonify_plan(config, hide, hide_all, depth, _path)
 
-        for field, prop in fields.items():
-            if field in hide:
-                continue
+        for field, prop, field_depth, field_hide_all, field_path in plan:
 
-            field_depth = depth - 1
-            field_hide_all = hide_all
-
-            field_path = self.form_path(_path, field)
-            if field_path in config:
-                field_setting = config[field_path]
-                if not field_setting:
-                    continue
-                field_depth = int(floor(abs(field_setting)))
-                field_hide_all = field_setting < 0
-            elif hide_all:
-                continue
-
-            if isinstance(prop, JsonProperty):
-                if not prop.hide:
-                    self_json[field] = prop(
-                        obj=self, hide_all=field_hide_all,
-                        depth=field_depth if field_path in config else depth,
-                        _path=field_path, _json=_json, **json_kwargs)
+            if prop is not None:
+                self_json[field] = prop(
+                    obj=self, hide_all=field_hide_all, depth=field_depth,
+                    _path=field_path, _json=_json, **json_kwargs)
                 continue
 
             value = getattr(self, field)
@@ -581,6 +772,236 @@ class Jsonable(object):
 
         return self_json if nest else _json
 
+    def iterjsonify(self, dumps=json.dumps, **json_kwargs):
+        '''
+        Iterjsonify
+
+        Generator version of jsonify that yields the serialized JSON in
+        chunks, one per top-level entry, as objects are visited. Output
+        is equivalent to serializing the jsonify output, including the
+        top-level entry order, but neither the whole dict nor the whole
+        string is held in memory. Entries are yielded once complete and
+        related objects are jsonified after the entries referencing
+        them, which keeps the same depth-first visiting order.
+
+        I/O:
+        dumps=json.dumps: function serializing keys and values
+        **json_kwargs: jsonify kwargs (nest is not supported)
+        return: generator of JSON strings
+        '''
+        def start(_json):
+            _json.current = self
+            self.jsonify(_json=_json, **json_kwargs)
+
+        return self._stream_json(start, dumps)
+
+    @classmethod
+    def iterjsonify_value(cls, value, kwarg_map=None, dumps=json.dumps):
+        '''
+        Iterjsonify value
+
+        Generator version of jsonify_value that yields the serialized
+        JSON in chunks (see iterjsonify), e.g. for long lists of items.
+        '''
+        kwarg_map = {} if kwarg_map is None else kwarg_map
+
+        def start(_json):
+            _json[cls.JSON_ROOT] = cls.jsonify_value(value, kwarg_map, _json)
+
+        return cls._stream_json(start, dumps)
+
+    @classmethod
+    def _stream_json(cls, start, dumps):
+        '''Run jsonify calls depth-first, yielding entries in order'''
+        _json = JsonStream()
+        # Stack of deferred (instance, json_kwargs), the next one last
+        pending = []
+        separator = '{'
+        run = start
+        while True:
+            run(_json)
+            pending.extend(reversed(_json.deferred))
+            _json.deferred = []
+
+            for key in _json.added:
+                if key == cls.JSON_ROOT:
+                    continue
+                yield ''.join((separator, dumps(key), ':', dumps(_json[key])))
+                separator = ','
+                _json.release(key)
+            _json.added = []
+
+            run = None
+            while pending and run is None:
+                inst, json_kwargs = pending.pop()
+                if inst.json_key(**json_kwargs) in _json:
+                    continue  # Visited since deferred
+                run = partial(cls._stream_jsonify, inst, json_kwargs)
+            if run is None:
+                break
+
+        root = _json.get(cls.JSON_ROOT)
+        if root is not None:
+            yield ''.join((separator, dumps(cls.JSON_ROOT), ':', dumps(root)))
+            separator = ','
+        yield '}' if separator == ',' else '{}'
+
+    @staticmethod
+    def _stream_jsonify(inst, json_kwargs, _json):
+        _json.current = inst
+        inst.jsonify(_json=_json, **json_kwargs)
+
+    @classmethod
+    def jsonify_plan(cls, config, hide, hide_all, depth, _path):
+        '''
+        Jsonify plan
+
+        Return the plan for jsonifying instances of the class given the
+        jsonify settings that determine which fields are included and
+        how. Plans are compiled once per signature and cached, evicting
+        the least recently used once JSONIFY_PLAN_CACHE_SIZE is reached.
+
+        I/O:
+        config, hide, hide_all, depth, _path: see jsonify
+        return: tuple of JsonifyPlanStep namedtuples, each with field,
+            prop (the JsonProperty or None), and the depth, hide_all,
+            and path with which the field is to be jsonified
+        '''
+        plans = Jsonable._jsonify_plans
+        try:
+            signature = (cls, frozenset(config.items()), frozenset(hide),
+                         hide_all, depth, _path)
+            plan = plans.pop(signature)
+        except TypeError:  # unhashable config
+            return cls._compile_jsonify_plan(
+                config, hide, hide_all, depth, _path)
+        except KeyError:
+            plan = cls._compile_jsonify_plan(
+                config, hide, hide_all, depth, _path)
+            while len(plans) >= cls.JSONIFY_PLAN_CACHE_SIZE:
+                plans.popitem(last=False)
+        # (Re)insert as most recently used
+        plans[signature] = plan
+        return plan
+
+    @classmethod
+    def _compile_jsonify_plan(cls, config, hide, hide_all, depth, _path):
+        '''Compile jsonify plan (see "jsonify_plan")'''
+        plan = []
+        for field, prop in cls.fields().items():
+            if field in hide:
+                continue
+
+            field_depth = depth - 1
+            field_hide_all = hide_all
+
+            field_path = cls.form_path(_path, field)
+            if field_path in config:
+                field_setting = config[field_path]
+                if not field_setting:
+                    continue
+                field_depth = int(floor(abs(field_setting)))
+                field_hide_all = field_setting < 0
+            elif hide_all:
+                continue
+
+            if isinstance(prop, JsonProperty):
+                if not prop.hide:
+                    plan.append(cls.JsonifyPlanStep(
+                        field, prop,
+                        field_depth if field_path in config else depth,
+                        field_hide_all, field_path))
+                continue
+
+            plan.append(cls.JsonifyPlanStep(
+                field, None, field_depth, field_hide_all, field_path))
+
+        return tuple(plan)
+
+    @classmethod
+    def eager_load_options(cls, config=None, depth=1, hide=None,
+                           hide_all=False, _path=None, _loader=None):
+        '''
+        Eager load options
+
+        Return SQLAlchemy loader options for the relationships reached
+        when jsonifying instances of the class with the given settings,
+        so the object graph can be loaded up front rather than lazily
+        as each field is serialized. The options follow the jsonify
+        plan, recursing into related models as long as depth remains.
+        Scalar relationships are joined and collections are loaded via
+        subquery. Dynamic relationships are skipped, as they are queries
+        rather than loaded collections and so cannot be eager loaded.
+
+        I/O:
+        config, depth, hide, hide_all, _path: see jsonify
+        _loader=None: private loader option to chain from in recursion
+        return: list of loader options, to be passed to query.options()
+        '''
+        config = {} if config is None else config
+        hide = set() if hide is None else set(hide)
+        _path = '' if _path is None else _path
+        mapper = orm.class_mapper(cls)
+        options = []
+
+        plan = cls.jsonify_plan(config, hide, hide_all, depth, _path)
+
+        for field, prop, field_depth, field_hide_all, field_path in plan:
+            # JSON properties may serialize relationships of the same name
+            name = field if prop is None else prop.name
+            if not mapper.has_property(name):
+                continue
+            sa_property = mapper.get_property(name)
+            if isinstance(sa_property, SP):
+                sa_property = mapper.get_property(sa_property.name)
+            if (not isinstance(sa_property, RP) or
+                    sa_property.lazy == 'dynamic'):
+                continue
+
+            attribute = getattr(cls, sa_property.key)
+            loader_name = ('subqueryload' if sa_property.uselist
+                           else 'joinedload')
+            loader = getattr(orm if _loader is None else _loader, loader_name)
+            loader = loader(attribute)
+            options.append(loader)
+
+            # Recurse only where jsonify itself recurses, as JSON property
+            # methods determine how their relationships are serialized
+            related_model = sa_property.mapper.class_
+            if (prop is None and field_depth > 0 and
+                    issubclass(related_model, Jsonable)):
+                options.extend(related_model.eager_load_options(
+                    config=config, depth=field_depth, hide=hide,
+                    hide_all=field_hide_all, _path=field_path,
+                    _loader=loader))
+
+        return options
+
+    def eager_load(self, config=None, depth=1, hide=None, hide_all=False,
+                   **json_kwargs):
+        '''
+        Eager load
+
+        Load the object graph needed to jsonify the instance with the
+        given settings in a single query per collection, instead of
+        lazily as the serializer reaches each relationship. Other
+        jsonify kwargs are accepted so they may be passed through.
+
+        I/O:
+        config, depth, hide, hide_all: see jsonify
+        return: self
+        '''
+        options = self.eager_load_options(
+            config=config, depth=depth, hide=hide, hide_all=hide_all)
+        session = orm.object_session(self)
+        pk = self.pk
+        if options and session is not None and None not in pk:
+            cls = self.__class__
+            criteria = (getattr(cls, field) == value
+                        for field, value in pk._asdict().items())
+            session.query(cls).options(*options).filter(*criteria).one()
+        return self
+
     JSONIFY_ARG_TYPES = OrderedDict(derive_arg_types(jsonify,
                                                      custom=[JsonKeyType]))
     JSONIFY_ARG_DEFAULTS = OrderedDict(derive_defaults(jsonify))
@@ -623,21 +1044,39 @@ class Jsonable(object):
                     kwarg_type = partial(enumify, kwarg_type)
                 if kwarg_type:
                     kwarg_value = kwarg_type(kwarg_value)
+                # Parse cursors up front, so invalid ones fail early
+                if kwarg_name == 'cursor' and kwarg_value:
+                    kwarg_value = cls.parse_cursor(kwarg_value)
             else:
                 kwarg_value = cls.JSONIFY_ARG_DEFAULTS[kwarg_name]
 
             yield kwarg_name, kwarg_value
 
     @classmethod
-    def paginate(cls, page_items, page_size, total_items, start=1):
-        '''Append pagination for collections'''
-        page = (start - 1) // page_size + 1
-        full_pages, remainder = divmod(total_items, page_size)
-        total_pages = full_pages + bool(remainder)
-        end = start + page_items - 1
-        return ('({start}-{end} of {items}; page {page} of {pages})'
-                .format(start=start, end=end, items=total_items,
-                        page=page, pages=total_pages))
+    def paginate(cls, offset, limit, page_items, has_more, total=None,
+                 next_cursor=None):
+        '''
+        Paginate
+
+        Return pagination metadata for a collection page, keyed by
+        JSON_PAGINATION so it may be appended to lists or merged into
+        dictionaries:
+            {'pagination': {'offset': 0, 'limit': 10, 'items': 10,
+                            'has_more': True, 'total': 42,
+                            'next_cursor': '...'}}
+        The total is included only if known and next_cursor only if
+        there are more items and the collection supports cursors.
+        '''
+        pagination = OrderedDict((
+            ('offset', offset),
+            ('limit', limit),
+            ('items', page_items),
+            ('has_more', has_more)))
+        if total is not None:
+            pagination['total'] = total
+        if next_cursor is not None:
+            pagination['next_cursor'] = next_cursor
+        return OrderedDict(((cls.JSON_PAGINATION, pagination),))
 
     def print(self):
         jsonified = self.jsonify(depth=1, limit=10, root=False,
@@ -274,3 +274,26 @@ class QuantizedDecimal(object):
 
     def __long__(self):
         return long(self.value)
+
+
+def divide_half_even(numerator, denominator):
+    '''
+    Divide half even
+
+    Divide integers exactly, rounding the quotient to the nearest
+    integer and ties to even, as Decimal quantize does by default. This
+    allows dequantized values to be averaged without Decimals.
+
+    I/O:
+    numerator: integer
+    denominator: nonzero integer
+    return: integer quotient, rounded half to even
+    '''
+    if denominator < 0:
+        numerator, denominator = -numerator, -denominator
+    quotient, remainder = divmod(numerator, denominator)
+    twice_remainder = 2 * remainder
+    if (twice_remainder > denominator or
+            twice_remainder == denominator and quotient % 2):
+        quotient += 1
+    return quotient
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import current_app, jsonify, request
+from sqlalchemy import event, orm
+
+from intertwine.trackable import Trackable
+
+ResponseCacheStats = namedtuple(
+    'ResponseCacheStats',
+    'size, limit, ttl, hits, misses, evictions, invalidations')
+
+
+class ResponseCache(object):
+    '''
+    Response cache
+
+    In-process cache of serialized JSON API responses, keyed by the URI
+    of the requested resource and its normalized jsonify kwargs. Hits
+    skip reconstructing, eager loading, jsonifying, and serializing the
+    resource, which is worthwhile as geos and problems change rarely.
+
+    Each entry depends on the URIs of all objects rendered within it.
+    Once installed (see install), entries are invalidated by URI as
+    instances are tracked as new or modified by Trackable (_updates),
+    and as instances are flushed, upon commit. New or deleted rows may
+    change responses that render none of them (e.g. a new connection
+    of a cached problem), so committing any clears all entries. The
+    least recently used entries are evicted once the limit is exceeded.
+
+    The cache is per process and invalidation is not shared, so
+    responses cached by other processes (e.g. other workers) may be
+    stale for changes committed here until they expire after ttl
+    seconds. This window is accepted as geos and problems change
+    rarely; lower the ttl where it is not.
+
+    I/O:
+    limit=None: maximum number of entries; DEFAULT_LIMIT if None
+    ttl=None: seconds entries remain fresh; DEFAULT_TTL if None
+    '''
+    DEFAULT_LIMIT = 1000
+    DEFAULT_TTL = 300
+    URI_FIELD = 'uri'
+
+    Entry = namedtuple('ResponseCacheEntry', 'body, etag, expires, uris')
+
+    installed = None
+
+    def __init__(self, limit=None, ttl=None):
+        limit = self.DEFAULT_LIMIT if limit is None else limit
+        if limit < 1:
+            raise ValueError('Invalid response cache limit: {}'.format(limit))
+        self.limit = limit
+        self.ttl = self.DEFAULT_TTL if ttl is None else ttl
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        # Incremented upon invalidation to discard responses in flight
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._keys_by_uri = {}
+        self._lock = threading.RLock()
+
+    @classmethod
+    def install(cls, cache):
+        '''Install cache for JSON API responses; uninstall if None'''
+        cls.installed = cache
+        if cache is None:
+            Trackable.remove_update_listener(invalidate_updated_instances)
+        else:
+            Trackable.add_update_listener(invalidate_updated_instances)
+
+    @classmethod
+    def configure(cls, config):
+        '''
+        Configure
+
+        Install a response cache if RESPONSE_CACHE_LIMIT is set, with
+        entries fresh for RESPONSE_CACHE_TTL seconds; otherwise
+        uninstall any installed cache.
+        '''
+        limit = config.get('RESPONSE_CACHE_LIMIT')
+        cache = (cls(limit=limit, ttl=config.get('RESPONSE_CACHE_TTL'))
+                 if limit else None)
+        cls.install(cache)
+
+    @classmethod
+    def create_key(cls, uri, json_kwargs):
+        '''Create key from URI and (objectified) jsonify kwargs'''
+        return (uri, cls._freeze(json_kwargs))
+
+    @classmethod
+    def _freeze(cls, value):
+        '''Convert value to a hashable equivalent for use in keys'''
+        if isinstance(value, dict):
+            return frozenset((k, cls._freeze(v)) for k, v in value.items())
+        if isinstance(value, (set, frozenset)):
+            return frozenset(cls._freeze(v) for v in value)
+        if isinstance(value, (list, tuple)):
+            return tuple(cls._freeze(v) for v in value)
+        return value
+
+    @classmethod
+    def derive_uris(cls, payload):
+        '''Derive URIs of all objects rendered in a jsonified payload'''
+        uris = set()
+        values = [payload]
+        while values:
+            value = values.pop()
+            if isinstance(value, dict):
+                uri = value.get(cls.URI_FIELD)
+                if uri:
+                    uris.add(uri)
+                values.extend(value.values())
+            elif isinstance(value, (list, tuple)):
+                values.extend(value)
+        return uris
+
+    @property
+    def stats(self):
+        return ResponseCacheStats(
+            size=len(self), limit=self.limit, ttl=self.ttl, hits=self.hits,
+            misses=self.misses, evictions=self.evictions,
+            invalidations=self.invalidations)
+
+    def get(self, key):
+        '''Return fresh entry for key or None, counting hits/misses'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # Reinsert to mark as most recently used
+            del self._entries[key]
+            self._entries[key] = entry
+            self.hits += 1
+            return entry
+
+    def set(self, key, body, uris, generation=None):
+        '''
+        Set
+
+        Store serialized response body for key, depending on the given
+        URIs. If a generation is given and entries have since been
+        invalidated, the body may be stale and is not stored.
+
+        I/O:
+        key: key from create_key
+        body: serialized response body (bytes)
+        uris: iterable of URIs of objects rendered in the body
+        generation=None: generation when rendering began
+        return: Entry namedtuple of body, etag, expires, and uris
+        '''
+        entry = self.Entry(body=body, etag=self.derive_etag(body),
+                           expires=time.time() + self.ttl,
+                           uris=frozenset(uris))
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return entry
+            self._remove(key)
+            self._entries[key] = entry
+            for uri in entry.uris:
+                self._keys_by_uri.setdefault(uri, set()).add(key)
+            while len(self._entries) > self.limit:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return entry
+
+    def invalidate(self, uris):
+        '''Remove all entries depending on any of the given URIs'''
+        with self._lock:
+            self.generation += 1
+            for uri in uris:
+                for key in self._keys_by_uri.pop(uri, ()):
+                    if self._remove(key):
+                        self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._keys_by_uri.clear()
+
+    def _remove(self, key):
+        '''Remove entry and its URI references; return True if found'''
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        for uri in entry.uris:
+            keys = self._keys_by_uri.get(uri)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_uri[uri]
+        return True
+
+    @staticmethod
+    def derive_etag(body):
+        return hashlib.sha1(body).hexdigest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return ('<{cls}: {size} of {limit}; {hits} hits, {misses} misses, '
+                '{evictions} evictions, {invalidations} invalidations>'
+                .format(cls=self.__class__.__name__, size=len(self),
+                        limit=self.limit, hits=self.hits, misses=self.misses,
+                        evictions=self.evictions,
+                        invalidations=self.invalidations))
+
+
+def derive_instance_uris(instances):
+    '''Derive URIs of instances, skipping those without URIs'''
+    uris = set()
+    for inst in instances:
+        try:
+            uri = inst.uri
+        except Exception:
+            # Instances may be partially constructed (e.g. in __init__)
+            continue
+        if uri:
+            uris.add(uri)
+    return uris
+
+
+def invalidate_updated_instances(instances):
+    '''Invalidate cached responses as Trackable tracks updates'''
+    cache = ResponseCache.installed
+    if cache is not None and len(cache):
+        cache.invalidate(derive_instance_uris(instances))
+
+
+def cached_json_response(uri, json_kwargs, render):
+    '''
+    Cached JSON response
+
+    Return a JSON response for the resource with the given URI and
+    jsonify kwargs, served from the installed response cache when
+    fresh. Otherwise the payload is rendered by calling render and
+    cached, unless invalidated while rendering. Responses carry an
+    ETag and are 304 (Not Modified) if it matches If-None-Match.
+
+    I/O:
+    uri: URI of the requested resource
+    json_kwargs: objectified jsonify kwargs (see objectify_json_kwargs)
+    render: callable returning the jsonified payload; exceptions (e.g.
+        for resources that do not exist) propagate and are not cached
+    return: Flask response
+    '''
+    cache = ResponseCache.installed
+    key = ResponseCache.create_key(uri, json_kwargs)
+    entry = cache.get(key) if cache is not None else None
+
+    if entry is None:
+        generation = cache.generation if cache is not None else None
+        payload = render()
+        body = jsonify(payload).get_data()
+        if cache is not None:
+            uris = ResponseCache.derive_uris(payload)
+            uris.add(uri)
+            entry = cache.set(key, body, uris, generation)
+        else:
+            entry = ResponseCache.Entry(
+                body=body, etag=ResponseCache.derive_etag(body),
+                expires=None, uris=None)
+
+    response = current_app.response_class(mimetype='application/json')
+    response.set_etag(entry.etag)
+    if request.if_none_match.contains(entry.etag):
+        response.status_code = 304
+    else:
+        response.set_data(entry.body)
+    return response
+
+
+@event.listens_for(orm.Session, 'after_flush')
+def track_response_cache_changes(session, flush_context):
+    '''Capture changes to instances in flush for the cache'''
+    if ResponseCache.installed is None:
+        return
+    if session.new or session.deleted:
+        session.info['response_cache_clear'] = True
+    uris = session.info.setdefault('response_cache_uris', set())
+    uris.update(derive_instance_uris(
+        session.new | session.dirty | session.deleted))
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def invalidate_response_cache(session):
+    '''Invalidate cached responses for instances committed'''
+    uris = session.info.pop('response_cache_uris', ())
+    clear = session.info.pop('response_cache_clear', False)
+    cache = ResponseCache.installed
+    if cache is None:
+        return
+    if clear:
+        cache.clear()
+    elif uris:
+        cache.invalidate(uris)
+
+
+@event.listens_for(orm.Session, 'after_rollback')
+def discard_response_cache_changes(session):
+    '''Discard uncommitted changes captured for the cache'''
+    session.info.pop('response_cache_uris', None)
+    session.info.pop('response_cache_clear', None)
@@ -49,3 +49,156 @@ def test_community_model_create(session, problem_name, org_name, geo_name,
     assert community_from_db.name == problem.name + (
         ' at ' + org_name if org_name else '') + (
         ' in ' + geo.display(show_abbrev=False) if geo else '')
+
+
+@pytest.mark.unit
+def test_aggregate_ratings_maintained_on_write(session):
+    '''Tests aggregate ratings are maintained on write, not on read'''
+    from intertwine.communities.models import Community
+    from intertwine.geos.models import Geo
+    from intertwine.problems.models import (
+        AggregateProblemConnectionRating as APCR,
+        Problem,
+        ProblemConnection,
+        ProblemConnectionRating)
+    from intertwine.trackable import Trackable
+
+    problem1 = Problem('Test Problem 01')
+    problem2 = Problem('Test Problem 02')
+    connection = ProblemConnection('causal', problem1, problem2)
+    geo = Geo('Austin')
+    session.add_all((problem1, problem2, connection, geo))
+    session.commit()
+
+    # Rating without a community creates the community and aggregate
+    rating1 = ProblemConnectionRating(rating=1, weight=1,
+                                      connection=connection,
+                                      problem=problem1, org=None, geo=geo,
+                                      user='user1')
+    session.commit()
+    community = Community[Community.Key(problem1, None, geo)]
+    apcr = APCR.query.filter_by(community=community,
+                                aggregation=APCR.STRICT).one()
+    assert (apcr.rating, apcr.weight) == (1, 1)
+
+    rating2 = ProblemConnectionRating(rating=4, weight=2,
+                                      connection=connection,
+                                      problem=problem1, org=None, geo=geo,
+                                      user='user2')
+    session.commit()
+    assert (apcr.rating, apcr.weight) == (3, 3)
+
+    rating2.update_values(rating=2, weight=3)
+    session.commit()
+    assert (round(apcr.rating, 2), apcr.weight) == (1.75, 4)
+
+    # Removing all weight yields no rating rather than dividing by zero
+    rating1.weight = 0
+    rating2.weight = 0
+    assert (apcr.rating, apcr.weight) == (APCR.NO_RATING, APCR.NO_WEIGHT)
+    rating1.weight = 1
+    session.commit()
+    assert (apcr.rating, apcr.weight) == (1, 1)
+
+    # Reads never write
+    session.delete(apcr)
+    session.commit()
+    Trackable.clear_instances(APCR)
+    community_json = community.jsonify(depth=2)
+    assert not session.new and not session.dirty
+    assert APCR.query.filter_by(
+        community=community, aggregation=APCR.STRICT).count() == 0
+    ar_key = community_json[community.json_key()]['aggregate_ratings'][
+        connection.derive_category(problem1)][0]
+    assert community_json[ar_key]['rating'] == APCR.NO_RATING
+
+    # The backfill job restores aggregates, creating communities for
+    # ratings bulk imported without maintaining aggregates
+    org = 'University of Texas'
+    session.execute(ProblemConnectionRating.__table__.insert(), [
+        dict(problem_id=problem1.id, org=org, geo_id=geo.id,
+             connection_id=connection.id,
+             connection_category=rating1.connection_category,
+             user=user, rating=rating, weight=weight)
+        for user, rating, weight in (('user1', 0, 1), ('user2', 3, 2))])
+
+    stats = Community.backfill_aggregate_ratings(batch_size=1)
+    assert stats.ratings == 4
+    assert stats.aggregate_ratings == 2
+    assert stats.communities == 1
+    assert stats.ratings_per_second > 0
+    apcr = APCR.query.filter_by(community=community,
+                                aggregation=APCR.STRICT).one()
+    assert (apcr.rating, apcr.weight) == (1, 1)
+    org_community = Community.query.filter_by(
+        problem=problem1, org=org, geo=geo).one()
+    apcr = APCR.query.filter_by(community=org_community,
+                                aggregation=APCR.STRICT).one()
+    assert (apcr.rating, apcr.weight) == (2, 3)
+    assert apcr.connection_category == rating1.connection_category
+
+
+@pytest.mark.unit
+def test_inclusive_aggregate_ratings(session):
+    '''Tests inclusive aggregate ratings roll up the geo hierarchy'''
+    from intertwine.communities.models import Community
+    from intertwine.geos.models import Geo
+    from intertwine.problems.models import (
+        AggregateProblemConnectionRating as APCR,
+        Problem,
+        ProblemConnection,
+        ProblemConnectionRating)
+
+    problem1 = Problem('Test Problem 01')
+    problem2 = Problem('Test Problem 02')
+    connection = ProblemConnection('causal', problem1, problem2)
+    tx = Geo('Texas')
+    travis = Geo('Travis County', parents=[tx])
+    cbsa = Geo('Austin Area', parents=[tx])
+    austin = Geo('Austin', parents=[travis, cbsa])
+    session.add_all((problem1, problem2, connection, austin))
+    session.commit()
+
+    def inclusive_values(geo):
+        community = Community[Community.Key(problem1, None, geo)]
+        apcr = APCR.query.filter_by(community=community,
+                                    aggregation=APCR.INCLUSIVE).one()
+        return (apcr.rating, apcr.weight)
+
+    rating1 = ProblemConnectionRating(rating=1, weight=1,
+                                      connection=connection,
+                                      problem=problem1, org=None, geo=austin,
+                                      user='user1')
+    ProblemConnectionRating(rating=4, weight=2, connection=connection,
+                            problem=problem1, org=None, geo=travis,
+                            user='user2')
+    session.commit()
+
+    # Texas is reached via two parents but counted once
+    assert inclusive_values(austin) == (1, 1)
+    assert inclusive_values(cbsa) == (1, 1)
+    assert inclusive_values(travis) == (3, 3)
+    assert inclusive_values(tx) == (3, 3)
+    assert inclusive_values(None) == (3, 3)
+
+    rating1.update_values(rating=4, weight=4)
+    session.commit()
+    assert inclusive_values(tx) == (4, 6)
+    assert inclusive_values(cbsa) == (4, 4)
+
+    # Strict aggregate ratings are unaffected by descendant geos
+    community = Community[Community.Key(problem1, None, tx)]
+    assert APCR.query.filter_by(community=community,
+                                aggregation=APCR.STRICT).count() == 0
+
+    # The backfill job recalculates the same inclusive aggregates
+    session.query(APCR).filter_by(aggregation=APCR.INCLUSIVE).update(
+        dict(rating=APCR.NO_RATING, weight=APCR.NO_WEIGHT))
+    session.commit()
+    stats = Community.backfill_aggregate_ratings(aggregation=APCR.INCLUSIVE)
+    assert stats.ratings == 2
+    assert stats.aggregate_ratings == 5
+    session.expire_all()
+    assert inclusive_values(tx) == (4, 6)
+    assert inclusive_values(travis) == (4, 6)
+    assert inclusive_values(austin) == (4, 4)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+
+
+@pytest.mark.unit
+def test_bulk_save_geos(session):
+    '''Tests bulk saved geos match geos saved via the ORM'''
+    from intertwine.geos.models import (Geo, GeoData, GeoID, GeoLevel,
+                                        geo_closure_table)
+    from intertwine.trackable import Trackable
+    from data.geos.geo_data_process import bulk_save_geos
+
+    us = Geo(name='United States', abbrev='U.S.')
+    GeoData(geo=us, total_pop=100, urban_pop=80)
+    us_level = GeoLevel(geo=us, level='country',
+                        designation='federal republic')
+    GeoID(level=us_level, standard='ISO_A2', code='US')
+    session.add(us)
+    session.commit()
+    Trackable.clear_updates()
+
+    # New geos attached to existing ones are otherwise autoflushed
+    with session.no_autoflush:
+        tx = Geo(name='Texas', abbrev='TX', path_parent=us, parents=[us])
+        GeoData(geo=tx, total_pop=60, urban_pop=50)
+        tx_level = GeoLevel(geo=tx, level='subdivision1', designation='state')
+        GeoID(level=tx_level, standard='FIPS', code='48')
+        travis = Geo(name='Travis County', path_parent=tx, parents=[tx, us])
+        GeoLevel(geo=travis, level='subdivision2', designation='county')
+        Geo(name='Lone Star State', path_parent=us, alias_targets=[tx])
+        us.data.total_pop = 160
+
+    counts = bulk_save_geos(session, Trackable.catalog_updates())
+    session.commit()
+
+    assert counts['geo'] == 3
+    assert counts['geo_data'] == 1
+    assert counts['geo_level'] == 2
+    assert counts['geo_id'] == 1
+    assert counts['geo_parent_child_association'] == 3
+    assert counts['geo_alias_association'] == 1
+
+    session.expire_all()
+    assert session.query(Geo).filter_by(
+        human_id='us/tx/travis_county').one() is travis
+    assert travis.path_parent is tx
+    assert set(travis.parents) == {tx, us}
+    assert set(us.children) == {tx, travis}
+    assert tx.levels['subdivision1'].ids['FIPS'].code == '48'
+    assert tx.data.total_pop == 60
+    assert us.data.total_pop == 160
+    assert [g.name for g in tx.aliases] == ['Lone Star State']
+    assert set(travis.ancestors()) == {tx, us}
+    assert session.query(geo_closure_table).count() == 3
+
+
+@pytest.mark.unit
+def test_merge_geo_files(session, tmpdir):
+    '''Tests geos loaded by batches of states are merged by natural key'''
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from intertwine.geos.models import (BaseGeoModel, Geo, GeoData, GeoID,
+                                        GeoLevel)
+    from intertwine.trackable import Trackable
+    from data.geos.geo_data_process import bulk_save_geos
+    from data.geos.geo_data_parallel import merge_geo_files
+
+    def load_base_geos(sub1keys):
+        us = Geo(name='United States', abbrev='U.S.')
+        GeoData(geo=us, total_pop=100, urban_pop=80)
+        GeoLevel(geo=us, level='country', designation='federal republic')
+        names = {'CA': 'California', 'TX': 'Texas'}
+        return {k: Geo(name=names[k], abbrev=k, path_parent=us, parents=[us])
+                for k in sub1keys}
+
+    def load_county(state, name, fips):
+        county = Geo(name=name, path_parent=state, parents=[state])
+        GeoData(geo=county, total_pop=10, urban_pop=9)
+        level = GeoLevel(geo=county, level='subdivision2',
+                         designation='county')
+        GeoID(level=level, standard='FIPS', code=fips)
+        return county
+
+    def emit_geo_file(number, sub1key, load):
+        path = str(tmpdir.join('geos_{}.db'.format(number)))
+        engine = create_engine('sqlite:///' + path)
+        BaseGeoModel.metadata.create_all(engine)
+        worker_session = sessionmaker(bind=engine)()
+        Trackable.clear_all()
+        load(load_base_geos((sub1key,))[sub1key])
+        bulk_save_geos(worker_session, Trackable.catalog_updates())
+        worker_session.commit()
+        worker_session.close()
+        engine.dispose()
+        return path
+
+    def load_tx(tx):
+        travis = load_county(tx, 'Travis County', '48453')
+        austin = Geo(name='Austin', path_parent=tx, parents=[travis])
+        GeoLevel(geo=austin, level='place', designation='city')
+
+    def load_ca(ca):
+        load_county(ca, 'Los Angeles County', '06037')
+
+    load_base_geos(('CA', 'TX'))
+    session.add(Geo['us'])
+    session.commit()
+
+    paths = [emit_geo_file(0, 'TX', load_tx), emit_geo_file(1, 'CA', load_ca)]
+    counts = merge_geo_files(session, paths)
+    session.commit()
+
+    assert counts == {'geo': 3, 'geo_level': 3, 'geo_id': 2, 'geo_data': 2,
+                      'geo_parent_child_association': 3,
+                      'geo_alias_association': 0}
+
+    Trackable.clear_all()
+    session.expire_all()
+    geos = session.query(Geo).order_by(Geo.id).all()
+    # Base geos are not duplicated and new geos are ordered by human_id
+    assert [g.human_id for g in geos] == [
+        'us', 'us/ca', 'us/tx', 'us/ca/los_angeles_county', 'us/tx/austin',
+        'us/tx/travis_county']
+    us, ca, tx, la, austin, travis = geos
+    assert la.path_parent is ca
+    assert travis.levels['subdivision2'].ids['FIPS'].code == '48453'
+    assert travis.data.total_pop == 10
+    assert us.data.total_pop == 100
+    assert set(austin.ancestors()) == {travis, tx, us}
+
+
+@pytest.mark.unit
+def test_load_geos_in_stages(tmpdir):
+    '''Tests staged geo loads are checkpointed and resumable'''
+    from sqlalchemy import create_engine, inspect
+    from sqlalchemy.orm import sessionmaker
+    from intertwine.geos.models import BaseGeoModel, Geo, GeoLevel
+    from intertwine.trackable import Trackable
+    from data.geos.geo_data_process import (GeoLoadStage, count_records,
+                                            load_geos_in_stages)
+
+    # Commits are not isolated by the session fixture, so use a new file
+    engine = create_engine('sqlite:///' + str(tmpdir.join('geos.db')))
+    BaseGeoModel.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    Trackable.clear_all()
+
+    names = {'CA': 'California', 'TX': 'Texas'}
+    failures = {'TX'}
+
+    def load_country(geo_session, session):
+        us = Geo(name='United States', abbrev='U.S.')
+        GeoLevel(geo=us, level='country', designation='federal republic')
+
+    def load_states(geo_session, session, sub1keys):
+        us = Geo['us']
+        for key in count_records(sub1keys):
+            if key in failures:
+                raise RuntimeError('Failed to load {}'.format(key))
+            Geo(name=names[key], abbrev=key, path_parent=us, parents=[us])
+
+    stages = (GeoLoadStage('country', load_country, False),
+              GeoLoadStage('subdivision1', load_states, True))
+
+    with pytest.raises(RuntimeError):
+        load_geos_in_stages(None, session, sub1keys=('TX', 'CA'),
+                            stages=stages)
+    # Stages and states loaded before the failure are committed
+    assert session.query(Geo).count() == 2
+
+    failures.clear()
+    stage_stats = load_geos_in_stages(None, session, resume=True,
+                                      sub1keys=('TX', 'CA'), stages=stages)
+    # Registered geos are not expired by commits while loading, but the
+    # session otherwise expires on commit as before
+    assert '_name' not in inspect(Geo['us']).unloaded
+    assert session.expire_on_commit
+    assert [g.human_id for g in session.query(Geo).order_by(Geo.id)] == [
+        'us', 'us/ca', 'us/tx']
+
+    country_stats, sub1_stats = stage_stats.values()
+    assert country_stats.created == 1
+    assert country_stats.records == 0
+    assert sub1_stats.key == 'TX'
+    assert sub1_stats.records == 2
+    assert sub1_stats.created == 2
+    assert sub1_stats.modified == 0
+    assert sub1_stats.seconds >= 0
+
+    # A completed load is skipped entirely upon resuming
+    stage_stats = load_geos_in_stages(None, session, resume=True,
+                                      stages=stages)
+    assert stage_stats['subdivision1'] == sub1_stats
+
+    session.close()
+    engine.dispose()
+    Trackable.clear_all()
+
+
+@pytest.mark.unit
+def test_rollup_geo_data(session):
+    '''Tests bulk rollups match aggregating data one parent at a time'''
+    from intertwine.geos.models import (Geo, GeoData, GeoLevel, PLACE,
+                                        SUBDIVISION2, CORE_AREA,
+                                        COMBINED_AREA)
+    from data.geos.geo_data_rollup import rollup_geo_data
+
+    def create_geo(name, level, data=None, children=()):
+        geo = Geo(name=name, children=list(children))
+        GeoLevel(geo=geo, level=level, designation=level)
+        if data:
+            GeoData(geo, *data)
+        return geo
+
+    travis = create_geo('Travis County', SUBDIVISION2,
+                        (1200000, 1100000, '30.3', '-97.7', 2600, 110))
+    williamson = create_geo('Williamson County', SUBDIVISION2,
+                            (590000, 500000, '30.6', '-97.6', 2900, 20))
+    bexar = create_geo('Bexar County', SUBDIVISION2,
+                       (2000000, 1900000, '29.4', '-98.5', 3200, 40))
+    austin = create_geo('Austin', PLACE,
+                        (950000, 950000, '30.25', '-97.75', 800, 20),
+                        children=[travis])
+    austin_area = create_geo('Austin Area', CORE_AREA,
+                             (1, 1, '0', '0', 1, 1),  # Stale data
+                             children=[travis, williamson, austin])
+    sa_area = create_geo('San Antonio Area', CORE_AREA,
+                         children=[bexar, austin])
+    texas_area = create_geo('Greater Texas Area', COMBINED_AREA,
+                            children=[austin_area, sa_area, bexar])
+    empty_area = create_geo('Empty Area', CORE_AREA)
+    for geo in (travis, williamson, bexar, austin, austin_area, sa_area,
+                texas_area, empty_area):
+        session.add(geo)
+    session.commit()
+
+    def combine(*geos):
+        return GeoData.combine_dequantized(g.data.dequantize() for g in geos)
+
+    expected_austin_area = combine(travis, williamson)
+    expected_sa_area = combine(bexar)
+
+    stats = rollup_geo_data(session)
+    session.expire_all()
+
+    assert [(s.level, s.created, s.updated) for s in stats] == [
+        (CORE_AREA, 1, 1), (COMBINED_AREA, 1, 0)]
+    assert austin_area.data.dequantize() == expected_austin_area
+    assert sa_area.data.dequantize() == expected_sa_area
+    # Parents rolled up earlier are current for later levels
+    assert texas_area.data.dequantize() == combine(austin_area, sa_area)
+    assert texas_area.data.total_pop == 1200000 + 590000 + 2000000
+    assert empty_area.data is None
+
+
+@pytest.mark.unit
+def test_verify_geo_data(session):
+    '''Tests verifying geo data reports mismatches, aliases, and orphans'''
+    import json
+    from intertwine.geos.models import (Geo, GeoData, GeoLevel, COUNTRY,
+                                        SUBDIVISION1, SUBDIVISION2,
+                                        geo_alias_association_table)
+    from data.geos.geo_data_verify import verify_geo_data
+
+    def create_geo(name, level=None, data=None, **kwds):
+        geo = Geo(name=name, **kwds)
+        if level:
+            GeoLevel(geo=geo, level=level, designation=level)
+        if data:
+            GeoData(geo, *data)
+        session.add(geo)
+        return geo
+
+    us = create_geo('United States', COUNTRY, (300, 250, '39', '-98', 9, 1))
+    tx = create_geo('Texas', SUBDIVISION1, (200, 150, '31', '-99', 6, 1),
+                    parents=[us])
+    create_geo('California', SUBDIVISION1, (101, 100, '37', '-119', 3, 0),
+               parents=[us])
+    create_geo('Travis County', SUBDIVISION2, (200, 150, '30', '-98', 6, 1),
+               parents=[tx])
+    lone_star = create_geo('Lone Star State', alias_targets=[tx])
+    tejas = create_geo('Tejas')
+    create_geo('Atlantis', SUBDIVISION1)
+    session.commit()
+    # Aliases of aliases are prevented by the ORM, so bypass it
+    session.execute(geo_alias_association_table.insert().values(
+        alias_target_id=lone_star.id, alias_id=tejas.id))
+
+    report = verify_geo_data(session)
+
+    assert json.loads(json.dumps(report)) == report
+    assert report['summary']['ok'] is False
+    assert report['summary']['geos'] == 7
+    assert [(m['parent'], m['field'], m['expected'], m['actual'])
+            for m in report['mismatches']] == [
+        ('united_states', 'total_pop', 301, 300)]
+    assert [(a['geo'], a['anomaly'], a['related'])
+            for a in report['alias_anomalies']] == [
+        ('tejas', 'alias_of_alias', 'lone_star_state')]
+    assert [(o['geo'], o['orphan']) for o in report['orphans']] == [
+        ('atlantis', 'unparented')]
+
+    # Mismatches within tolerance are not reported
+    report = verify_geo_data(session, relative_tolerance=0.01)
+    assert report['mismatches'] == []
+    report = verify_geo_data(session, tolerance=1)
+    assert report['mismatches'] == []
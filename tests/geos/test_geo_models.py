@@ -56,6 +56,60 @@ def test_geo_model_create(session, parent_name, parent_abbrev, child_name):
     assert child_from_db.parents.all()[0] is parent_from_db
 
 
+@pytest.mark.unit
+def test_geo_cached_displays(session):
+    '''Tests displays and URIs are cached and kept current'''
+    from intertwine.geos.models import Geo
+
+    us = Geo(name='United States', abbrev='U.S.')
+    tx = Geo(name='Texas', abbrev='TX', path_parent=us, parents=[us])
+    austin = Geo(name='Austin', path_parent=tx, parents=[tx])
+    ca = Geo(name='California', abbrev='CA', path_parent=us, parents=[us])
+    session.add(us)
+    session.commit()
+
+    assert austin.display(max_path=1, show_abbrev=False) == 'Austin, TX'
+    assert austin.display() == 'Austin, TX, U.S.'
+    assert us.display(show_The=True, show_abbrev=False,
+                      max_path=0) == 'The United States'
+    assert ca.display() == 'California (CA), U.S.'
+    assert austin.uri == Geo.form_uri(Geo.Key(austin.human_id))
+    cached_displays = austin._display_cache[1]
+    assert set(cached_displays) == {
+        Geo.DisplayArgs(show_abbrev=False, max_path=1), Geo.DisplayArgs()}
+    for args, display in cached_displays.items():
+        assert display == austin.derive_display(*args)
+
+    # Reloading unchanged geos (e.g. upon commit) keeps their displays
+    session.commit()
+    assert austin.display() == 'Austin, TX, U.S.'
+    assert austin._display_cache[1] is cached_displays
+
+    # Changes invalidate only the geo and its path children
+    ca_displays = ca._display_cache[1]
+    tx.abbrev = 'TEX'
+    us.uses_the = False
+    session.commit()
+
+    assert austin.human_id == 'us/tex/austin'
+    assert austin.uri == Geo.form_uri(Geo.Key('us/tex/austin'))
+    assert austin.display(max_path=1, show_abbrev=False) == 'Austin, TEX'
+    assert austin.display() == 'Austin, TEX, U.S.'
+    assert us.display(show_The=True, show_abbrev=False,
+                      max_path=0) == 'United States'
+    assert tx.jsonify()[tx.json_key()]['display'] == 'Texas, U.S.'
+    assert ca.display() == 'California (CA), U.S.'
+    assert ca._display_cache[1] is ca_displays
+
+    # Changes committed elsewhere are detected upon reloading
+    geo_table = Geo.__table__
+    session.execute(geo_table.update().where(geo_table.c.id == tx.id)
+                    .values(abbrev='TX'))
+    session.commit()
+    assert austin.display(max_path=1) == 'Austin, TX'
+    assert ca._display_cache[1] is ca_displays
+
+
 @pytest.mark.unit
 @pytest.mark.smoke
 def test_geo_data_model(session):
@@ -345,3 +399,173 @@ def test_geo_aliases(session):
     assert geo_alias_1.path_parent is geo
     assert geo_alias_2.path_parent is parent_geo
     assert geo_alias_3.path_parent is parent_geo
+
+
+@pytest.mark.unit
+def test_related_geos_by_level(session):
+    '''Tests related geos are ranked and counted by level in one query'''
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from intertwine.geos.models import Geo, GeoData, GeoLevel
+
+    parent_geo = Geo(name='Test Parent Geo', abbrev='TPG')
+    GeoData(geo=parent_geo, total_pop=10000, urban_pop=8000)
+    GeoLevel(geo=parent_geo, level='subdivision1', designation='state')
+
+    child_specs = (('Place A', 'place', 100), ('Place B', 'place', 400),
+                   ('Place C', 'place', 300), ('Place D', 'place', 200),
+                   ('County A', 'subdivision2', 1000),
+                   ('County B', 'subdivision2', 2000))
+    for name, level, total_pop in child_specs:
+        child_geo = Geo(name=name, path_parent=parent_geo,
+                        parents=[parent_geo])
+        GeoData(geo=child_geo, total_pop=total_pop, urban_pop=total_pop)
+        GeoLevel(geo=child_geo, level=level, designation=level)
+    session.add(parent_geo)
+    session.commit()
+    session.refresh(parent_geo)
+
+    base_q = parent_geo.children.join(Geo.data).join(Geo.levels)
+    levels = GeoLevel.DOWN
+
+    statements = []
+
+    def count_statement(*args, **kwds):
+        statements.append(args[2])
+
+    event.listen(Engine, 'before_cursor_execute', count_statement)
+    try:
+        related_geos = Geo.related_geos_by_level(base_q, levels, limit=2)
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count_statement)
+    assert len(statements) == 1
+
+    assert list(related_geos) == ['subdivision2', 'place']
+    county_geos, county_total = related_geos['subdivision2']
+    assert [g.name for g in county_geos] == ['County B', 'County A']
+    assert county_total == 2
+    place_geos, place_total = related_geos['place']
+    assert [g.name for g in place_geos] == ['Place B', 'Place C']
+    assert place_total == 4
+
+    unlimited = Geo.related_geos_by_level(base_q, levels)
+    assert [g.name for g in unlimited['place'][0]] == [
+        'Place B', 'Place C', 'Place D', 'Place A']
+
+    json_kwargs = dict(limit=2, depth=1, _json={}, nest=False)
+    windowed_json = parent_geo.jsonify_related_geos(Geo.CHILDREN,
+                                                    **json_kwargs)
+    assert windowed_json['place'][-1] == {'pagination': dict(
+        offset=0, limit=2, items=2, has_more=True, total=4)}
+    assert len(windowed_json['subdivision2']) == 2
+
+    offset_geos = Geo.related_geos_by_level(base_q, levels, 2, offset=1)
+    assert [g.name for g in offset_geos['place'][0]] == [
+        'Place C', 'Place D']
+    assert [g.name for g in offset_geos['subdivision2'][0]] == ['County A']
+
+    # Support is decided from the dialect, so SQLite < 3.25 falls back
+    sqlite_version = session.get_bind().dialect.dbapi.sqlite_version_info
+    assert Geo.supports_window_functions(session) is (
+        sqlite_version >= (3, 25, 0))
+
+    Geo.WINDOW_FUNCTIONS_SUPPORTED = False
+    try:
+        assert Geo.related_geos_by_level(base_q, levels, 2) == related_geos
+        assert Geo.related_geos_by_level(
+            base_q, levels, 2, offset=1) == offset_geos
+        assert parent_geo.jsonify_related_geos(
+            Geo.CHILDREN, **json_kwargs) == windowed_json
+    finally:
+        Geo.WINDOW_FUNCTIONS_SUPPORTED = None
+
+
+@pytest.mark.unit
+def test_geo_closure(session):
+    '''Tests hierarchy closure is maintained as parents/children change'''
+    from intertwine.geos.models import Geo, GeoLevel, geo_closure_table
+
+    def create_geo(name, level, parents=()):
+        geo = Geo(name=name, parents=list(parents))
+        GeoLevel(geo=geo, level=level, designation=level)
+        return geo
+
+    us = create_geo('United States', 'country')
+    tx = create_geo('Texas', 'subdivision1', [us])
+    travis = create_geo('Travis County', 'subdivision2', [tx])
+    cbsa = create_geo('Austin Area', 'core_area', [tx])
+    austin = create_geo('Austin', 'place', [travis, cbsa, tx])
+    session.add(us)
+    session.commit()
+
+    assert {g.name for g in austin.ancestors(max_depth=1)} == {
+        'Travis County', 'Austin Area', 'Texas'}
+    assert austin.ancestors().all()[-1] is us
+    assert austin.ancestors(level='subdivision1').all() == [tx]
+    assert us.descendants(level='place').all() == [austin]
+    assert {g.name for g in tx.descendants()} == {
+        'Travis County', 'Austin Area', 'Austin'}
+
+    depths = {(row.ancestor_id, row.descendant_id): row.depth
+              for row in session.execute(geo_closure_table.select())}
+    assert depths[(us.id, austin.id)] == 2  # Shortest path via Texas
+    assert depths[(tx.id, austin.id)] == 1
+    assert len(depths) == 9
+
+    # Moving a subtree refreshes closure for all descendants
+    mx = create_geo('Mexico', 'country')
+    tx.parents = [mx]
+    session.add(mx)
+    session.commit()
+    assert austin.ancestors(level='country').all() == [mx]
+    assert us.descendants().all() == []
+
+    # Removing a parent keeps ancestors reachable via other parents
+    austin.parents.remove(tx)
+    session.commit()
+    assert austin.ancestors(level='subdivision1').all() == [tx]
+    assert austin.ancestors(max_depth=1).count() == 2
+
+    session.delete(travis)
+    session.commit()
+    assert {g.name for g in austin.ancestors()} == {
+        'Austin Area', 'Texas', 'Mexico'}
+
+    session.execute(geo_closure_table.delete())
+    Geo.refresh_closure(session)
+    assert {g.name for g in mx.descendants()} == {
+        'Texas', 'Austin Area', 'Austin'}
+
+
+@pytest.mark.unit
+def test_geo_closure_backfill(session):
+    '''Tests closure is backfilled when created for existing geos'''
+    from intertwine.geos.models import BaseGeoModel, Geo, geo_closure_table
+
+    us = Geo(name='United States')
+    tx = Geo(name='Texas', parents=[us])
+    austin = Geo(name='Austin', parents=[tx])
+    session.add(us)
+    session.commit()
+
+    # As if upgrading a database that predates the closure
+    connection = session.connection()
+    geo_closure_table.drop(connection)
+    BaseGeoModel.metadata.create_all(connection)
+    assert austin.ancestors().all() == [tx, us]
+    assert us.descendants(max_depth=1).all() == [tx]
+
+
+@pytest.mark.unit
+def test_geo_data_timezones(session):
+    '''Tests timezone names are found for many geo data rows at once'''
+    from intertwine.geos.models import Geo, GeoData
+
+    austin_data = GeoData(geo=Geo(name='Austin'), total_pop=950000,
+                          urban_pop=950000, latitude=30.267153,
+                          longitude=-97.7430608)
+    unlocated_data = GeoData(geo=Geo(name='Nowhere'), total_pop=0,
+                             urban_pop=0)
+    tz_names = GeoData.find_timezone_names((austin_data, unlocated_data))
+    assert list(tz_names.items()) == [(austin_data, 'America/Chicago'),
+                                      (unlocated_data, None)]
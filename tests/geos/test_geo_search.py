@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+
+
+@pytest.mark.unit
+def test_geo_search_index(session, tmpdir):
+    '''Tests geo search index matches geos as find_matches queries do'''
+    from intertwine.geos import configure_search_index
+    from intertwine.geos.models import (Geo, GeoData, bump_geo_revision,
+                                        read_geo_revision)
+    from intertwine.geos.search import GeoSearchIndex
+    from intertwine.utils.enums import MatchType
+
+    def create_geo(name, total_pop, abbrev=None, path_parent=None):
+        geo = Geo(name=name, abbrev=abbrev, path_parent=path_parent)
+        GeoData(geo=geo, total_pop=total_pop, urban_pop=total_pop)
+        return geo
+
+    us = create_geo('United States', 320000000, abbrev='US')
+    tx = create_geo('Texas', 28000000, abbrev='TX', path_parent=us)
+    create_geo('Austin', 950000, path_parent=tx)
+    create_geo('West Lake Hills', 3000, path_parent=tx)
+    create_geo('Lakeway', 15000, path_parent=tx)
+    create_geo('Lake Travis', 20000, path_parent=tx)
+    ca = create_geo('California', 39000000, abbrev='CA', path_parent=us)
+    create_geo('Lake Forest', 80000, path_parent=ca)
+    create_geo('Austin Lake', 100, path_parent=ca)
+    session.add(us)
+    session.commit()
+
+    searches = [(string, match_type) for string in (
+        'lake', 'Lake', 'la', 'tx', 'T', 'austin', 'ay', 'ST', 'Texas',
+        'lake travis', 'austin, tx', 'lake, ca', 'zzz')
+        for match_type in MatchType]
+
+    expected_matches = {search: Geo.find_matches(*search)
+                        for search in searches}
+    assert expected_matches['lake', MatchType.BEST]  # Non-trivial
+
+    index = GeoSearchIndex.build(session)
+    assert len(index) == 9
+    GeoSearchIndex.install(index)
+    try:
+        for search in searches:
+            assert Geo.find_matches(*search) == expected_matches[search]
+
+        # Renames are indexed on commit, advancing the revision
+        revision = index.revision
+        lakeway = Geo['us/tx/lakeway']
+        lakeway.name = 'Lakeside'
+        session.commit()
+        assert index.revision == read_geo_revision(session) == revision + 1
+        assert index.find('lakeside') == ['us/tx/lakeside']
+        assert index.find('lakew') == []
+        assert (Geo.find_matches('lake', MatchType.STARTS_WITH) ==
+                Geo.query.filter(Geo.name.like('lake%'))
+                         .join(Geo.data).order_by(GeoData.total_pop.desc())
+                         .all())
+
+        # Snapshots round trip
+        snapshot = str(tmpdir.join('geo_search_index.json'))
+        index.save(snapshot)
+        loaded_index = GeoSearchIndex.load(snapshot)
+        assert len(loaded_index) == len(index)
+        for search in searches:
+            assert loaded_index.find(search[0], search[1]) == index.find(
+                search[0], search[1])
+
+        # Aliases rank with their most populous target
+        alias = Geo(name='Lone Star State', alias_targets=[tx])
+        session.add(alias)
+        session.commit()
+        assert index.find('lone', MatchType.CONTAINS) == [alias.human_id]
+        assert index.find('state', MatchType.CONTAINS) == [
+            us.human_id, alias.human_id]
+
+        session.delete(alias)
+        session.commit()
+        assert index.find('lone', MatchType.CONTAINS) == []
+        assert index.is_current(session)
+
+        # Geos committed via bulk writes render the index stale, so
+        # matching reverts to queries
+        geo_table = Geo.__table__
+        session.execute(geo_table.update()
+                        .where(geo_table.c.human_id == 'us/tx/austin')
+                        .values(name='Austin City'))
+        bump_geo_revision(session, bulk=True)
+        session.commit()
+        assert index.stale
+        assert not index.is_current(session)
+
+        # Stale indexes are rebuilt and replaced upon the next match
+        assert [g.name for g in Geo.find_matches('austin city')] == [
+            'Austin City']
+        assert Geo.search_index is not index
+        assert Geo.search_index.is_current(session)
+        assert Geo.search_index.find('austin c') == ['us/tx/austin']
+
+        # Stale snapshots are rebuilt, as are those of other versions
+        configure_search_index(dict(GEO_SEARCH_INDEX=True,
+                                    GEO_SEARCH_INDEX_SNAPSHOT=snapshot),
+                               session)
+        rebuilt_index = Geo.search_index
+        assert rebuilt_index.revision == read_geo_revision(session)
+        assert GeoSearchIndex.load(snapshot).revision == (
+            rebuilt_index.revision)
+        assert rebuilt_index.find('austin c') == ['us/tx/austin']
+        with open(snapshot, 'w') as snapshot_file:
+            snapshot_file.write('{"version": 1, "entries": []}')
+        configure_search_index(dict(GEO_SEARCH_INDEX=True,
+                                    GEO_SEARCH_INDEX_SNAPSHOT=snapshot),
+                               session)
+        assert len(Geo.search_index) == len(rebuilt_index)
+    finally:
+        GeoSearchIndex.install(None)
+
+
+@pytest.mark.unit
+def test_geo_search_index_reload(tmpdir):
+    '''Tests indexes are rebuilt once geos are committed elsewhere'''
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from intertwine.geos.models import (BaseGeoModel, Geo, bump_geo_revision,
+                                        read_geo_revision)
+    from intertwine.geos.search import GeoSearchIndex
+    from intertwine.trackable import Trackable
+
+    # Commits are not isolated by the session fixture, so use a new file
+    engine = create_engine('sqlite:///' + str(tmpdir.join('geos.db')))
+    BaseGeoModel.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    session, other_session = Session(), Session()
+    Trackable.clear_all()
+    try:
+        austin = Geo(name='Austin')
+        other_session.add(austin)
+        other_session.commit()
+
+        index = GeoSearchIndex.build(session)
+        assert index.revision == 1
+        assert index.current(session) is index
+
+        # As if committed by another process, so not applied to the index
+        other_session.execute(Geo.__table__.update().values(
+            name='Austin City'))
+        bump_geo_revision(other_session)
+        other_session.commit()
+        GeoSearchIndex.install(index)
+
+        index._checked_at = None  # As if REVISION_CHECK_SECONDS elapsed
+        rebuilt_index = index.current(session)
+        assert index.stale
+        assert rebuilt_index is Geo.search_index
+        assert rebuilt_index.revision == read_geo_revision(session) == 2
+        assert rebuilt_index.find('austin c') == ['austin']
+        # Replaced indexes are reloaded at most once per check interval
+        assert index.current(session) is None
+        assert rebuilt_index.current(session) is rebuilt_index
+    finally:
+        GeoSearchIndex.install(None)
+        session.close()
+        other_session.close()
+        engine.dispose()
+        Trackable.clear_all()
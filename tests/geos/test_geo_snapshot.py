@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+
+
+@pytest.mark.unit
+def test_geo_snapshot(session, tmpdir):
+    '''Tests geo snapshots serve the same reads as the ORM'''
+    from intertwine.geos.models import (Geo, GeoData, GeoID, GeoLevel,
+                                        CHILDREN, PARENTS, SUBDIVISION2, PLACE)
+    from intertwine.geos.snapshot import GeoSnapshot
+
+    def create_geo(name, total_pop, level, abbrev=None, path_parent=None,
+                   parents=()):
+        geo = Geo(name=name, abbrev=abbrev, path_parent=path_parent,
+                  parents=list(parents))
+        GeoData(geo=geo, total_pop=total_pop, urban_pop=total_pop // 2,
+                latitude=30.25, longitude=-97.75, land_area=100,
+                water_area=10)
+        GeoLevel(geo=geo, level=level, designation=level)
+        return geo
+
+    us = create_geo('United States', 320000000, 'country', abbrev='U.S.')
+    GeoID(level=us.levels['country'], standard='ISO_A2', code='US')
+    tx = create_geo('Texas', 28000000, 'subdivision1', abbrev='TX',
+                    path_parent=us, parents=[us])
+    travis = create_geo('Travis County', 1200000, SUBDIVISION2,
+                        path_parent=tx, parents=[tx])
+    create_geo('Austin', 950000, PLACE, path_parent=tx, parents=[travis])
+    create_geo('Lakeway', 15000, PLACE, path_parent=tx, parents=[travis])
+    create_geo('Pflugerville', 60000, PLACE, path_parent=tx,
+               parents=[travis])
+    Geo(name='Lone Star State', path_parent=us, alias_targets=[tx])
+    session.add(us)
+    session.commit()
+
+    path = str(tmpdir.join('geos.snapshot'))
+    assert GeoSnapshot.export(path, session) == 7
+
+    snapshot = GeoSnapshot.load(path)
+    try:
+        assert len(snapshot) == 7
+        assert 'us/tx/austin' in snapshot
+        assert 'us/tx/dallas' not in snapshot
+        with pytest.raises(KeyError):
+            snapshot['us/tx/dallas']
+
+        for geo in Geo.query:
+            snapshot_geo = snapshot[geo.human_id]
+            assert snapshot_geo.id == geo.id
+            assert snapshot_geo.name == geo.name
+            assert snapshot_geo.abbrev == geo.abbrev
+            path_parent = snapshot_geo.path_parent
+            assert (path_parent.human_id if path_parent else None) == (
+                geo.path_parent.human_id if geo.path_parent else None)
+            assert list(snapshot_geo.levels) == sorted(geo.levels)
+            if geo.data:
+                assert snapshot_geo.data.total_pop == geo.data.total_pop
+                assert snapshot_geo.data.latitude == geo.data.latitude
+                assert snapshot_geo.data.land_area == geo.data.land_area
+            else:
+                assert snapshot_geo.data is None
+
+            for relation in Geo.RELATIONS:
+                assert ({g.human_id for g in getattr(snapshot_geo, relation)}
+                        == {g.human_id for g in getattr(geo, relation)})
+            for relation, level in ((CHILDREN, PLACE), (CHILDREN, None),
+                                    (PARENTS, None)):
+                assert ([g.human_id for g in snapshot_geo.get_related_geos(
+                            relation, level=level)] ==
+                        [g.human_id for g in geo.get_related_geos(
+                            relation, level=level)])
+
+        # Related geos are ordered by population
+        assert [g.name for g in snapshot['us/tx/travis_county'].children] == [
+            'Austin', 'Pflugerville', 'Lakeway']
+        assert snapshot['us'].levels['country'].ids == {'ISO_A2': 'US'}
+        assert snapshot['us/lone_star_state'].alias_targets == [
+            snapshot['us/tx']]
+    finally:
+        snapshot.close()
+
+    with open(path, 'r+b') as snapshot_file:
+        snapshot_file.write(b'NOTGEOS!')
+    with pytest.raises(ValueError):
+        GeoSnapshot.load(path)
+
+
+@pytest.mark.unit
+def test_geo_snapshot_reads(session, tmpdir):
+    '''Tests Geo reads served via a snapshot match those via queries'''
+    from intertwine.geos import configure_snapshot
+    from intertwine.geos.models import (Geo, GeoData, GeoLevel, CHILDREN,
+                                        PLACE, SUBDIVISION2,
+                                        geo_revision_table)
+    from intertwine.geos.snapshot import GeoSnapshot
+    from intertwine.trackable import Trackable
+    from intertwine.utils.enums import MatchType
+
+    def create_geo(name, total_pop, level, abbrev=None, path_parent=None,
+                   parents=()):
+        geo = Geo(name=name, abbrev=abbrev, path_parent=path_parent,
+                  parents=list(parents))
+        GeoData(geo=geo, total_pop=total_pop, urban_pop=total_pop)
+        GeoLevel(geo=geo, level=level, designation=level)
+        return geo
+
+    us = create_geo('United States', 320000000, 'country', abbrev='US')
+    tx = create_geo('Texas', 28000000, 'subdivision1', abbrev='TX',
+                    path_parent=us, parents=[us])
+    travis = create_geo('Travis County', 1200000, SUBDIVISION2,
+                        path_parent=tx, parents=[tx])
+    for name, total_pop in (('Austin', 950000), ('West Lake Hills', 3000),
+                            ('Lakeway', 15000), ('Lake Travis', 20000)):
+        create_geo(name, total_pop, PLACE, path_parent=tx, parents=[travis])
+    ca = create_geo('California', 39000000, 'subdivision1', abbrev='CA',
+                    path_parent=us, parents=[us])
+    create_geo('Lake Forest', 80000, PLACE, path_parent=ca, parents=[ca])
+    Geo(name='Lone Star State', path_parent=us, alias_targets=[tx])
+    session.add(us)
+    session.commit()
+
+    searches = [(string, match_type) for string in (
+        'lake', 'Lake', 'la', 'tx', 'T', 'austin', 'ay', 'ST', 'Texas',
+        'lake travis', 'austin, tx', 'lake, ca', 'lake, lone star state',
+        'zzz') for match_type in MatchType]
+    # Alias relations are not dynamic, so cannot be queried
+    relations = (Geo.PARENTS, Geo.CHILDREN, Geo.PATH_CHILDREN)
+    related_geo_kwargs = [
+        dict(relation=relation, level=level, include_aliases=include_aliases)
+        for relation in relations for level in (None, PLACE)
+        for include_aliases in (False, True)]
+    json_kwargs = dict(limit=2, depth=1, _json={}, nest=False)
+
+    def read_geos():
+        geos = Geo.query.order_by(Geo.human_id).all()
+        return dict(
+            matches={search: Geo.find_matches(*search)
+                     for search in searches},
+            related_geos=[geo.get_related_geos(**kwargs) for geo in geos
+                          for kwargs in related_geo_kwargs],
+            json=[geo.jsonify_related_geos(relation, offset=offset,
+                                           **json_kwargs)
+                  for geo in geos for relation in relations
+                  for offset in (0, 1)])
+
+    expected = read_geos()
+    assert expected['matches']['lake', MatchType.BEST]  # Non-trivial
+
+    path = str(tmpdir.join('geos.snapshot'))
+    GeoSnapshot.export(path, session)
+    snapshot = GeoSnapshot.load(path)
+    GeoSnapshot.install(snapshot)
+    try:
+        assert snapshot.find('lake', MatchType.BEST) == [
+            'us/ca/lake_forest', 'us/tx/lake_travis', 'us/tx/lakeway',
+            'us/tx/west_lake_hills']
+        # Unscoped substring matches are left to queries
+        assert snapshot.find('ay', MatchType.CONTAINS) is None
+        assert read_geos() == expected
+
+        # Geos with pending changes are read via queries
+        create_geo('Pflugerville', 60000, PLACE, path_parent=tx,
+                   parents=[travis])
+        assert 'us/tx/pflugerville' not in snapshot
+        assert [g.name for g in travis.get_related_geos(CHILDREN)] == [
+            'Austin', 'Pflugerville', 'Lake Travis', 'Lakeway',
+            'West Lake Hills']
+
+        # Committing geos renders the snapshot stale, so reads query
+        session.commit()
+        assert snapshot.stale
+        assert not snapshot.is_current(session)
+        assert 'us/tx/pflugerville' in [
+            g.human_id for g in Geo.find_matches('pflugerville')]
+    finally:
+        GeoSnapshot.install(None)
+        snapshot.close()
+
+    GeoSnapshot.export(path, session)
+    snapshot = GeoSnapshot.load(path)
+    GeoSnapshot.install(snapshot)
+    try:
+        assert snapshot.is_current(session)
+        assert not snapshot.stale
+
+        # Geos renamed by another process are still returned, both
+        # before the revision is next checked and afterward
+        geo_table = Geo.__table__
+        session.execute(geo_table.update()
+                        .where(geo_table.c.human_id == 'us/tx/lakeway')
+                        .values(human_id='us/tx/lakeway_village'))
+        session.execute(geo_revision_table.update().values(
+            revision=geo_revision_table.c.revision + 1))
+        Trackable.clear_instances()
+        session.expire_all()
+        assert not snapshot.stale
+        assert 'us/tx/lakeway_village' in [
+            g.human_id for g in travis.get_related_geos(CHILDREN)]
+        assert snapshot.stale
+
+        snapshot._stale, snapshot._checked_at = False, None
+        assert not snapshot.is_current(session)
+        assert 'us/tx/lakeway_village' in [
+            g.human_id for g in Geo.find_matches('lake')]
+    finally:
+        GeoSnapshot.install(None)
+        snapshot.close()
+
+    # Stale snapshots are bypassed until exported again, whereupon they
+    # are replaced, as when exported by another process
+    configure_snapshot(dict(GEO_SNAPSHOT=path), session)
+    snapshot = Geo.snapshot
+    try:
+        assert snapshot.stale
+        assert snapshot.current(session) is None
+        assert travis._derive_snapshot_geo() is None
+
+        GeoSnapshot.export(path, session)
+        assert snapshot.current(session) is None  # Reloaded too recently
+        snapshot._reloaded_at = None  # As if REVISION_CHECK_SECONDS elapsed
+        assert travis._derive_snapshot_geo() is not None
+        reloaded_snapshot = Geo.snapshot
+        assert reloaded_snapshot is not snapshot
+        assert reloaded_snapshot.is_current(session)
+        assert 'us/tx/lakeway_village' in reloaded_snapshot
+        assert [g.human_id for g in travis.get_related_geos(CHILDREN)] == [
+            g.human_id for g in reloaded_snapshot['us/tx/travis_county']
+            .get_related_geos(CHILDREN)]
+    finally:
+        GeoSnapshot.install(None)
+        snapshot.close()
+    reloaded_snapshot.close()
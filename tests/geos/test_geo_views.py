@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import pytest
+
+
+@pytest.mark.unit
+def test_get_geo_by_human_id(session, client):
+    '''Tests geo views reconstruct geos from full multi-part human ids'''
+    import json
+
+    from intertwine.geos.models import Geo
+
+    us = Geo(name='United States', abbrev='US')
+    tx = Geo(name='Texas', abbrev='TX', path_parent=us, parents=[us])
+    Geo(name='Austin', path_parent=tx, parents=[tx])
+    Geo(name='Lone Star State', path_parent=us, alias_targets=[tx])
+    session.add(us)
+    session.commit()
+
+    url = 'http://localhost:5000/geos/us/tx/austin'
+    response = client.get(url, headers={'accept': 'application/json'})
+    assert response.status_code == 200
+    payload = json.loads(response.get_data(as_text=True))
+    assert payload['root'] == '/geos/us/tx/austin'
+
+    response = client.get('http://localhost:5000/geos/us/tx/dallas',
+                          headers={'accept': 'application/json'})
+    assert response.status_code == 400  # ResourceDoesNotExist
+
+    # Geo pages for aliases redirect to their targets before rendering
+    html_headers = {'accept': 'text/html'}
+    response = client.get('http://localhost:5000/geos/us/lone_star_state',
+                          headers=html_headers)
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/geos/us/tx')
+
+    response = client.get('http://localhost:5000/geos/us/tx/dallas',
+                          headers=html_headers)
+    assert response.status_code == 404
@@ -167,8 +167,10 @@ def test_aggregate_problem_connection_rating_model(session):
     session.add(ar1)
     session.commit()
 
-    ars = session.query(AggregateProblemConnectionRating).order_by(
-                        AggregateProblemConnectionRating.id).all()
+    # Inclusive aggregates are also maintained as ratings are written
+    ars = session.query(AggregateProblemConnectionRating).filter_by(
+        aggregation='strict').order_by(
+            AggregateProblemConnectionRating.id).all()
     assert len(ars) == 1
     assert ars[0] is ar1
     assert round(ar1.rating, 1) == 3.0
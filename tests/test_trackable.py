@@ -168,3 +168,215 @@ def test_trackable_indexability(session):
     # Unpacked 1-tuples can also be used to index from the database
     indexed_problem = Problem[problem_key.human_id]
     assert indexed_problem is problem
+
+
+@pytest.mark.unit
+def test_trackable_registry_policies():
+    '''Tests Trackable registry policies and stats'''
+    import gc
+    from intertwine.trackable.registry import (
+        LRURegistry, Registry, WeakRegistry, create_registry)
+
+    assert type(create_registry()) is Registry
+    assert type(create_registry(limit=2)) is LRURegistry
+    assert type(create_registry('weak')) is WeakRegistry
+    with pytest.raises(ValueError):
+        create_registry('fifo')
+
+    lru = create_registry('lru', limit=2)
+    lru['a'] = 1
+    lru['b'] = 2
+    assert lru['a'] == 1  # 'b' is now least recently used
+    lru['c'] = 3
+    assert 'b' not in lru
+    assert lru.get('b') is None
+    assert set(lru) == {'a', 'c'}
+    assert lru.stats == (LRURegistry.POLICY, 2, 2, 1, 1, 1)
+
+    class Referent(object):
+        pass
+
+    weak = create_registry('weak')
+    referent = Referent()
+    weak['r'] = referent
+    assert weak['r'] is referent
+    del referent
+    gc.collect()
+    assert 'r' not in weak
+    assert weak.evictions == 1
+
+
+@pytest.mark.unit
+def test_trackable_registry_eviction(session):
+    '''Tests evicted Trackable instances fail over to the database'''
+    from intertwine.problems.models import Problem
+    from intertwine.trackable import Trackable
+
+    Trackable.configure_registry(Problem, policy='lru', limit=2)
+    try:
+        problems = [Problem('Test Problem {}'.format(i)) for i in range(3)]
+        session.add_all(problems)
+        session.commit()
+
+        stats = Trackable.registry_stats(Problem)['Problem']
+        assert stats.size == 2
+        assert stats.evictions == 1
+
+        first_key = problems[0].derive_key()
+        assert Problem.tget(first_key, query_on_miss=False) is None
+        assert Problem[first_key] is problems[0]  # Queried & re-registered
+        assert Problem.tget(first_key, query_on_miss=False) is problems[0]
+
+        # Constructors and get_or_create_many reuse evicted rows
+        second_key = problems[1].derive_key()
+        assert Problem.tget(second_key, query_on_miss=False) is None
+        assert Problem('Test Problem 1') is problems[1]
+        Trackable.configure_registry(Problem, policy='lru', limit=1)
+        (first, created), = Problem.get_or_create_many(
+            [dict(name='Test Problem 0')], _query_on_miss=False)
+        assert first is problems[0]
+        assert created is False
+        assert session.query(Problem).count() == 3
+
+    finally:
+        Trackable.configure_registry(Problem)
+
+
+@pytest.mark.unit
+def test_trackable_register_existing_preload(session):
+    '''Tests preloading existing instances with keys built from columns'''
+    from intertwine.trackable import Trackable
+
+    classes = [cls for cls in Trackable._classes.values()
+               if not cls.__name__.startswith('Aggregate')]
+    instances = {}
+    for cls in classes:
+        builder = Builder(cls, optional=False)
+        inst = builder.build()
+        instances[cls.__name__] = inst
+        session.add(inst)
+    session.commit()
+
+    Trackable.clear_instances()
+    stats = Trackable.register_existing(session, *classes, preload=True)
+
+    for cls in classes:
+        inst = instances[cls.__name__]
+        assert stats[cls.__name__].count == session.query(cls).count()
+        assert stats[cls.__name__].seconds >= 0
+        # Derive key after commit, as persisted values may differ
+        assert cls.tget(inst.derive_key(), query_on_miss=False) is inst
+        for registered_key, registered in cls._instances.items():
+            assert registered.derive_key() == registered_key
+
+    with pytest.raises(TypeError):
+        Trackable.register_existing(session, preload=True, batch=10)
+
+
+@pytest.mark.unit
+def test_trackable_tget_many(session):
+    '''Tests Trackable get many (tget_many)'''
+    from intertwine.geos.models import Geo, GeoLevel
+    from intertwine.problems.models import Problem
+    from intertwine.trackable import Trackable
+
+    problems = [Problem('Test Problem {}'.format(i)) for i in range(3)]
+    geo = Geo('Test Geo')
+    geo_level = GeoLevel(geo=geo, level='place')
+    session.add_all(problems + [geo, geo_level])
+    session.commit()
+
+    keys = [p.derive_key() for p in problems]
+    missing_key = Problem.create_key(name='Missing Problem')
+    nada = 'nada'
+
+    tget_problems = Problem.tget_many(
+        [keys[2], missing_key, keys[0].human_id, keys[2]], default=nada)
+    assert tget_problems == [problems[2], nada, problems[0], problems[2]]
+
+    Trackable.clear_all()
+
+    tget_problems = Problem.tget_many(keys, query_on_miss=False)
+    assert tget_problems == [None, None, None]
+
+    # Misses are queried and then registered
+    tget_problems = Problem.tget_many(
+        [keys[1], missing_key, keys[0].human_id, keys[1]], default=nada)
+    assert tget_problems == [problems[1], nada, problems[0], problems[1]]
+    assert Problem.tget(keys[1], query_on_miss=False) is problems[1]
+    assert Problem.tget(keys[2], query_on_miss=False) is None
+
+    # Keys may contain related objects
+    Trackable.clear_instances(GeoLevel)
+    geo_level_key = GeoLevel.create_key(geo=geo, level='place')
+    assert GeoLevel.tget_many([geo_level_key]) == [geo_level]
+
+    # Get or create many
+    rv = Problem.get_or_create_many([
+        dict(name='Test Problem 2'), dict(name='New Problem'),
+        dict(name='New Problem')])
+    new_problem = rv[1][0]
+    assert rv == [(problems[2], False), (new_problem, True),
+                  (new_problem, False)]
+    assert new_problem.id is not None
+
+
+@pytest.mark.unit
+def test_trackable_retrieve(session):
+    '''Tests Trackable retrieve via a single query, with memo'''
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from intertwine.communities.models import Community
+    from intertwine.problems.models import ProblemConnection
+    from intertwine.trackable import Trackable
+
+    connection = Builder(ProblemConnection, optional=False).build()
+    community = Builder(Community, optional=False).build()
+    session.add_all((connection, community))
+    session.commit()
+
+    cases = []
+    for inst in (connection, community):
+        cls = inst.__class__
+        path, query = inst.deconstruct(named=False)
+        hyper_key = cls.reconstruct(path, query, retrieve=True, as_key=True)
+        cases.append((cls, path, query, hyper_key))
+
+    statements = []
+
+    def count_statements(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(Engine, 'before_cursor_execute', count_statements)
+    try:
+        for cls, path, query, hyper_key in cases:
+            Trackable.clear_all()
+            session.expunge_all()
+            del statements[:]
+
+            retrieved = cls.retrieve(hyper_key)
+            assert len(statements) == 1
+            assert retrieved.deconstruct(named=False) == (path, query)
+
+            # Instance and key components are registered
+            key = retrieved.derive_key()
+            assert cls.tget(key, query_on_miss=False) is retrieved
+            for component in key:
+                if hasattr(component, 'derive_key'):
+                    component_cls = component.__class__
+                    assert component_cls.tget(component.derive_key(),
+                                              query_on_miss=False) is component
+            assert len(statements) == 1
+
+            # Memo prevents resolving the same hyper key twice
+            Trackable.begin_memo()
+            try:
+                memoized = cls.retrieve(hyper_key)
+                assert cls.retrieve(hyper_key) is memoized is retrieved
+                assert cls.reconstitute(hyper_key) is retrieved
+            finally:
+                Trackable.end_memo()
+            assert len(statements) == 2
+
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count_statements)
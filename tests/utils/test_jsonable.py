@@ -105,3 +105,194 @@ def test_jsonify_depth2(session, problem_name, org_name, geo_name,
         assert geo_key in community_payload
 
     json.dumps(community_payload)
+
+
+@pytest.mark.unit
+def test_jsonify_plan(session):
+    '''Tests compiled jsonify plans are cached and evicted LRU'''
+    from intertwine.geos.models import Geo
+    from intertwine.utils.jsonable import Jsonable
+
+    geo = Geo(name='Austin')
+    session.add(geo)
+    session.commit()
+
+    plan = Geo.jsonify_plan({}, set(), False, 1, '')
+    assert Geo.jsonify_plan({}, set(), False, 1, '') is plan
+    assert [step.field for step in plan] == [
+        field for field, prop in Geo.fields().items()
+        if not getattr(prop, 'hide', False)]
+
+    config = {'.name': 1, '.path_parent': 0}
+    hidden_plan = Geo.jsonify_plan(config, {'abbrev'}, True, 2, '')
+    assert [step.field for step in hidden_plan] == ['name']
+
+    geo_json = geo.jsonify(config=config, hide={'abbrev'}, hide_all=True)
+    assert list(geo_json[geo_json[Geo.JSON_ROOT]]) == ['name']
+
+    cache_size = Jsonable.JSONIFY_PLAN_CACHE_SIZE
+    Jsonable.JSONIFY_PLAN_CACHE_SIZE = 2
+    try:
+        Jsonable._jsonify_plans.clear()
+        plan = Geo.jsonify_plan({}, set(), False, 1, '')
+        Geo.jsonify_plan({}, set(), False, 2, '')
+        Geo.jsonify_plan({}, set(), False, 1, '')  # Most recently used
+        Geo.jsonify_plan({}, set(), False, 3, '')  # Evicts depth 2
+        assert len(Jsonable._jsonify_plans) == 2
+        assert Geo.jsonify_plan({}, set(), False, 1, '') is plan
+    finally:
+        Jsonable.JSONIFY_PLAN_CACHE_SIZE = cache_size
+
+
+@pytest.mark.unit
+def test_eager_load_options(session):
+    '''Tests eager loading the object graph reached by jsonify'''
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from intertwine.geos.models import Geo, GeoData, GeoLevel
+
+    us = Geo(name='United States', abbrev='US')
+    tx = Geo(name='Texas', abbrev='TX', path_parent=us)
+    for geo, total_pop in ((us, 300000000), (tx, 25000000)):
+        GeoData(geo=geo, total_pop=total_pop, urban_pop=total_pop // 2)
+    GeoLevel(geo=us, level='country', designation='country')
+    GeoLevel(geo=tx, level='subdivision1', designation='state')
+    session.add_all((us, tx))
+    session.commit()
+
+    depth = 2
+    options = Geo.eager_load_options(depth=depth)
+    paths = {tuple(attr.key for attr in option.path)
+             for option in options}
+    assert any('_data' in path for path in paths)
+    assert any('_levels' in path for path in paths)
+    # Dynamic relationships are queries, so they are never eager loaded
+    assert not any('_aliases' in path or 'parents' in path
+                   for path in paths)
+
+    hidden_options = Geo.eager_load_options(
+        config={'.data': 0}, hide={'levels'})
+    assert not any(attr.key in {'_data', '_levels'}
+                   for option in hidden_options for attr in option.path)
+
+    expected_json = tx.jsonify(depth=depth)
+    session.expunge_all()
+    tx = session.query(Geo).filter_by(human_id='us/tx').one()
+
+    statements = []
+
+    def count_statement(*args, **kwds):
+        statements.append(args[2])
+
+    assert tx.eager_load(depth=depth) is tx
+    event.listen(Engine, 'before_cursor_execute', count_statement)
+    try:
+        assert tx.data.total_pop == 25000000
+        assert tx.path_parent.data.total_pop == 300000000
+        assert list(tx.path_parent.levels) == ['country']
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count_statement)
+    assert not statements
+
+    assert tx.jsonify(depth=depth) == expected_json
+
+
+@pytest.mark.unit
+def test_iterjsonify(session):
+    '''Tests streamed JSON matches jsonify, including entry order'''
+    from collections import OrderedDict
+    from intertwine.geos.models import Geo, GeoData, GeoLevel
+    from intertwine.utils.jsonable import Jsonable
+
+    us = Geo(name='United States', abbrev='US')
+    tx = Geo(name='Texas', abbrev='TX', path_parent=us, parents=[us])
+    ca = Geo(name='California', abbrev='CA', path_parent=us, parents=[us])
+    austin = Geo(name='Austin', path_parent=tx, parents=[tx])
+    for geo, total_pop in ((us, 300000000), (tx, 25000000),
+                           (ca, 39000000), (austin, 900000)):
+        GeoData(geo=geo, total_pop=total_pop, urban_pop=total_pop // 2)
+    GeoLevel(geo=us, level='country', designation='country')
+    GeoLevel(geo=tx, level='subdivision1', designation='state')
+    GeoLevel(geo=ca, level='subdivision1', designation='state')
+    GeoLevel(geo=austin, level='place', designation='city')
+    session.add(us)
+    session.commit()
+
+    def load(json_string):
+        return json.loads(json_string, object_pairs_hook=OrderedDict)
+
+    for depth in (1, 2, 3):
+        expected = load(json.dumps(us.jsonify(depth=depth)))
+        chunks = list(us.iterjsonify(depth=depth))
+        assert len(chunks) > 1
+        streamed = load(''.join(chunks))
+        assert list(streamed) == list(expected)
+        assert streamed == expected
+
+    geos = [ca, austin, tx]
+    kwarg_map = {object: dict(depth=2, limit=-1)}
+    expected = load(json.dumps(Jsonable.jsonify_value(geos, kwarg_map)))
+    streamed = load(''.join(Jsonable.iterjsonify_value(geos, kwarg_map)))
+    assert list(streamed) == list(expected)
+    assert streamed == expected
+
+
+@pytest.mark.unit
+def test_jsonify_pagination(session):
+    '''Tests dynamic relationships are paged by offset and cursor'''
+    from intertwine.problems.models import Problem, ProblemConnection
+    from intertwine.utils.jsonable import InvalidCursor
+
+    problem = Problem('Test Problem')
+    connections = [
+        ProblemConnection('causal', Problem('Test Driver {}'.format(i)),
+                          problem)
+        for i in range(3)]
+    session.add_all(connections)
+    session.commit()
+    connection_keys = [c.json_key() for c in connections]
+
+    def page(**json_kwargs):
+        drivers = problem.jsonify(limit=2, **json_kwargs)[
+            problem.json_key()]['drivers']
+        return drivers[:-1], drivers[-1][Problem.JSON_PAGINATION]
+
+    drivers, pagination = page()
+    assert drivers == connection_keys[:2]
+    assert pagination['has_more'] is True
+    assert 'total' not in pagination  # no count query unless requested
+
+    next_drivers, next_pagination = page(
+        cursor=pagination['next_cursor'])
+    assert next_drivers == connection_keys[2:]
+    assert next_pagination['has_more'] is False
+    assert 'next_cursor' not in next_pagination
+
+    drivers, pagination = page(offset=1, count=True)
+    assert drivers == connection_keys[1:]
+    assert pagination == dict(offset=1, limit=2, items=2, has_more=False,
+                              total=3)
+
+    with pytest.raises(InvalidCursor):
+        page(cursor='invalid')
+    with pytest.raises(InvalidCursor):
+        page(cursor=Problem.form_cursor('.name', 1))
+
+
+@pytest.mark.unit
+def test_jsonify_invalid_cursor_response(session, client):
+    '''Tests invalid cursors in query strings are client errors'''
+    from intertwine.problems.models import Problem
+
+    problem = Problem('Test Problem')
+    session.add(problem)
+    session.commit()
+
+    url = 'http://localhost:5000' + problem.uri
+    headers = {'accept': 'application/json'}
+    for cursor in ('invalid', Problem.form_cursor('.name', 1)):
+        response = client.get(url, headers=headers,
+                              query_string={'cursor': cursor})
+        assert response.status_code == 400
+        error = json.loads(response.get_data(as_text=True))['error']
+        assert error['type'] == 'InvalidCursor'
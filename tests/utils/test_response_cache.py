@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import pytest
+
+from intertwine.utils.response_cache import ResponseCache
+
+
+@pytest.mark.unit
+def test_response_cache_eviction_and_invalidation():
+    '''Tests response cache LRU eviction, TTL, and URI invalidation'''
+    cache = ResponseCache(limit=2)
+    key1 = ResponseCache.create_key('/geos/us', dict(depth=1, hide={'a'}))
+    key2 = ResponseCache.create_key('/geos/us/tx', {})
+    key3 = ResponseCache.create_key('/geos/us/ca', {})
+
+    # Normalized kwargs yield equal keys
+    assert key1 == ResponseCache.create_key(
+        '/geos/us', dict(hide={'a'}, depth=1))
+
+    cache.set(key1, b'{}', {'/geos/us'})
+    cache.set(key2, b'{}', {'/geos/us/tx', '/geos/us'})
+    assert cache.get(key1).etag == ResponseCache.derive_etag(b'{}')
+    cache.set(key3, b'{}', {'/geos/us/ca'})
+    assert cache.get(key2) is None  # least recently used
+    assert cache.stats.evictions == 1
+
+    cache.invalidate({'/geos/us'})
+    assert cache.get(key1) is None
+    assert cache.get(key3) is not None
+    assert cache.stats.invalidations == 1
+
+    # Responses rendered before an invalidation are not stored
+    generation = cache.generation
+    cache.invalidate({'/geos/us/ca'})
+    cache.set(key1, b'{}', {'/geos/us'}, generation)
+    assert len(cache) == 0
+
+    expired = ResponseCache(ttl=0)
+    expired.set(key1, b'{}', {'/geos/us'})
+    assert expired.get(key1) is None
+
+
+@pytest.mark.unit
+def test_cached_problem_json(session, client):
+    '''Tests problem JSON is cached, revalidated, and invalidated'''
+    from intertwine.problems.models import Problem
+
+    problem = Problem(name='Test Problem')
+    session.add(problem)
+    session.commit()
+
+    url = 'http://localhost:5000' + problem.uri
+    headers = {'accept': 'application/json'}
+    ResponseCache.install(ResponseCache())
+    try:
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+        assert ResponseCache.installed.stats.misses == 1
+
+        response = client.get(url, headers=dict(
+            headers, **{'If-None-Match': etag}))
+        assert response.status_code == 304
+        assert ResponseCache.installed.stats.hits == 1
+
+        # Trackable updates invalidate the cached response
+        Problem(name='Test Problem', definition='A test problem')
+        assert len(ResponseCache.installed) == 0
+        response = client.get(url, headers=dict(
+            headers, **{'If-None-Match': etag}))
+        assert response.status_code == 200
+        assert response.headers['ETag'] != etag
+    finally:
+        ResponseCache.install(None)
+
+
+@pytest.mark.unit
+def test_response_cache_new_rows_and_other_processes(session, client):
+    '''Tests new rows clear cached responses, but only in this process'''
+    import time
+
+    from intertwine.problems.models import Problem
+
+    problem = Problem(name='Test Problem')
+    session.add(problem)
+    session.commit()
+
+    url = 'http://localhost:5000' + problem.uri
+    headers = {'accept': 'application/json'}
+    key = ResponseCache.create_key(problem.uri, {})
+    # Cache of another process, which invalidation does not reach
+    other_cache = ResponseCache(ttl=60)
+    other_cache.set(key, b'{}', {problem.uri})
+    ResponseCache.install(ResponseCache())
+    try:
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        assert len(ResponseCache.installed) == 1
+
+        # New rows may change responses rendering none of them (e.g.
+        # rows added via foreign keys), so they clear all entries
+        session.add(Problem(name='Unrelated Problem'))
+        session.commit()
+        assert len(ResponseCache.installed) == 0
+
+        # Other processes serve stale responses until they expire
+        entry = other_cache.get(key)
+        assert entry is not None
+        assert entry.expires <= time.time() + other_cache.ttl
+    finally:
+        ResponseCache.install(None)
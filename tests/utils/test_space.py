@@ -194,3 +194,71 @@ def test_geo_location_combine(session, lat1, lon1, wt1, lat2, lon2, wt2,
         (geo_location3.values, wt3))
 
     assert GeoLocation(*sequentially_combined_coordinates) == coordinates_check
+
+    # Combine dequantized integers, with weights in any integer units
+    combined_dequantized = GeoLocation.combine_dequantized(
+        *((geo_location.dequantize(), int(Decimal(wt) * 10 ** 7))
+          for geo_location, wt in ((geo_location1, wt1),
+                                   (geo_location2, wt2),
+                                   (geo_location3, wt3))))
+
+    assert all(isinstance(c, int) for c in combined_dequantized)
+    assert (GeoLocation(*combined_dequantized, requantize=True) ==
+            coordinates_check)
+
+
+@pytest.mark.unit
+def test_weighted_centroid():
+    '''Test WeightedCentroid rounds half even and handles zero weights'''
+    from intertwine.utils.quantized import divide_half_even
+    from intertwine.utils.space import WeightedCentroid
+
+    assert [divide_half_even(n, 2) for n in (-3, -1, 1, 3, 5)] == [
+        -2, 0, 0, 2, 2]
+    assert divide_half_even(7, -2) == -4
+    assert divide_half_even(10, 3) == 3
+
+    centroid = WeightedCentroid()
+    with pytest.raises(ZeroDivisionError):
+        centroid.coordinates
+    centroid.add(100, -200, 0)
+    centroid.add(301, -400, 0)
+    assert centroid.coordinates == (200, -300)  # Unweighted mean
+    centroid.add(10, 20, 3)
+    assert centroid.coordinates == (10, 20)
+    centroid.add(20, 30, 1)
+    assert centroid.coordinates == GeoLocation.Coordinates(12, 22)
+
+
+@pytest.mark.unit
+def test_geo_location_timezones(session):
+    '''Test timezone lookups share a finder and are memoized'''
+    from mock import patch
+
+    austin = GeoLocation('30.267153', '-97.7430608')
+    new_york = GeoLocation('40.7127753', '-74.0059728')
+
+    tz_finder = GeoLocation.timezone_finder()
+    assert GeoLocation.timezone_finder() is tz_finder
+    assert austin.timezone_name == 'America/Chicago'
+    assert austin.timezone.name == 'America/Chicago'
+
+    GeoLocation._timezone_names.clear()
+    with patch.object(GeoLocation, '_find_timezone_name',
+                      wraps=GeoLocation._find_timezone_name) as find_timezone_name:
+        tz_names = GeoLocation.find_timezone_names(
+            [austin, new_york, ('30.267153', '-97.7430608'), austin])
+        assert tz_names == ['America/Chicago', 'America/New_York',
+                            'America/Chicago', 'America/Chicago']
+        assert find_timezone_name.call_count == 2
+
+        assert new_york.timezone_name == 'America/New_York'
+        assert find_timezone_name.call_count == 2
+
+    cache_size = GeoLocation.TIMEZONE_CACHE_SIZE
+    GeoLocation.TIMEZONE_CACHE_SIZE = 1
+    try:
+        GeoLocation.find_timezone_names([austin, new_york])
+        assert list(GeoLocation._timezone_names) == [new_york.dequantize()]
+    finally:
+        GeoLocation.TIMEZONE_CACHE_SIZE = cache_size